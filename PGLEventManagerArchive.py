@@ -0,0 +1,196 @@
+import gzip
+import heapq
+import json
+import logging
+import os
+import zlib
+from datetime import datetime
+from itertools import chain, islice
+from urllib.parse import quote, unquote
+
+
+class PGLEventManagerArchive:
+    """Cold archive of the journeys and emergencies the retention job moved out of the database.
+    Rows are kept per table, device and month in <directory>/<table>/<device_id>/<YYYY-MM>.ndjson.gz,
+    one json list per row in the column order of the table, with the datetime in ISO 8601.
+    Every append adds a new gzip member to the end of the file, so files are only ever appended to
+    and can be read with any gzip tool. A member cut short by a crash is skipped when reading.
+    The rows of a file are ordered by id. Rows with an id below the last one of the month's file go to a new
+    file of the month, <YYYY-MM>.<n>.ndjson.gz, so files can be read a row at a time and merged by id.
+    Rows that were archived but not yet deleted when the job stopped are archived again by the next run,
+    read drops the duplicates by id."""
+
+    __logger = logging.getLogger("PGL.archive")
+
+    __MONTH_FORMAT = "%Y-%m"
+    __SUFFIX = ".ndjson.gz"
+    # zlib window bits of a gzip member, and the bytes every member starts with
+    __GZIP_WBITS = 16 + zlib.MAX_WBITS
+    __GZIP_MAGIC = b"\x1f\x8b\x08"
+    # bytes read from a file at a time
+    __READ_SIZE = 64 * 1024
+
+    def __init__(self, directory: str) -> None:
+        self.__directory = directory
+        self.__last_ids = {}        # path -> highest id in the file, of the files appended to
+
+    # append rows of table (id, datetime, ..., device_id) to the files of their device and month
+    # the files are synced to disk before append returns, so the rows can be deleted from the database
+    def append(self, table: str, rows: list[tuple]) -> None:
+        files = {}
+        for row in rows:
+            key = (row[-1], row[1].strftime(self.__MONTH_FORMAT))
+            files.setdefault(key, []).append(row)
+
+        for (device_id, month), file_rows in files.items():
+            directory = os.path.join(self.__directory, table, quote(device_id, safe=""))
+            os.makedirs(directory, exist_ok=True)
+            file_rows.sort(key=lambda row: row[0])
+            path = self.__appendPath(directory, month, file_rows[0][0])
+            lines = "".join(json.dumps([row[0], row[1].isoformat(" "), *row[2:]]) + "\n"
+                            for row in file_rows)
+            with open(path, "ab") as f:
+                f.write(gzip.compress(lines.encode("utf-8")))
+                f.flush()
+                os.fsync(f.fileno())
+            self.__last_ids[path] = file_rows[-1][0]
+
+    # archived rows of table for device_id with a datetime between start and end and an id above after,
+    # ordered by id. The rows are read from the files as they are iterated, so a caller that stops early
+    # doesn't read the rest, and files of months outside start and end are not read at all
+    def read(self, table: str, device_id: str, start: datetime | None = None, end: datetime | None = None,
+             after: int | None = None):
+        directory = os.path.join(self.__directory, table, quote(device_id, safe=""))
+        if not os.path.isdir(directory):
+            return
+
+        first = start.strftime(self.__MONTH_FORMAT) if start is not None else None
+        last = end.strftime(self.__MONTH_FORMAT) if end is not None else None
+        files = []
+        for name in sorted(os.listdir(directory)):
+            month = name.removesuffix(self.__SUFFIX).split(".")[0]
+            if month == name or (first is not None and month < first) or (last is not None and month > last):
+                continue
+            files.append(self.__readFile(os.path.join(directory, name), start, end, after))
+
+        last_id = None
+        for row in heapq.merge(*files, key=lambda row: row[0]):
+            if row[0] != last_id:
+                last_id = row[0]
+                yield row
+
+    # device_ids that have archived rows of table
+    def devices(self, table: str) -> list[str]:
+        directory = os.path.join(self.__directory, table)
+        if not os.path.isdir(directory):
+            return []
+        return [unquote(name) for name in sorted(os.listdir(directory))]
+
+    # file of month in directory that rows starting at first_id are appended to: the month's last file,
+    # or a new one if that has rows with an id from first_id on
+    def __appendPath(self, directory: str, month: str, first_id: int) -> str:
+        runs = sorted(int(name[len(month) + 1:-len(self.__SUFFIX)] or 0) for name in os.listdir(directory)
+                      if name.startswith(month) and name.endswith(self.__SUFFIX))
+        run = runs[-1] if runs else 0
+        path = self.__runPath(directory, month, run)
+        if path not in self.__last_ids and os.path.exists(path):
+            self.__last_ids[path] = max((row[0] for row in self.__readFile(path)), default=None)
+        last_id = self.__last_ids.get(path)
+        if last_id is not None and first_id <= last_id:
+            path = self.__runPath(directory, month, run + 1)
+        return path
+
+    def __runPath(self, directory: str, month: str, run: int) -> str:
+        return os.path.join(directory, (f"{month}.{run}" if run else month) + self.__SUFFIX)
+
+    # rows of an archive file with a datetime between start and end and an id above after, read a member at
+    # a time. A member cut short by a crash is skipped: its rows are still in the database, and reading goes
+    # on at the next member, which the next append started behind it.
+    # The gzip trailer has the crc32 of a member, so only complete members are read
+    def __readFile(self, path: str, start: datetime | None = None, end: datetime | None = None,
+                   after: int | None = None):
+        with open(path, "rb") as f:
+            offset = 0
+            while True:
+                text, next_offset = self.__readMember(f, offset)
+                if text is None:
+                    if next_offset is None:
+                        break
+                    self.__logger.warning("Skipping a damaged member at offset %d of archive file %s", offset, path)
+                    next_offset = self.__findMember(f, offset + 1)
+                    if next_offset is None:
+                        break
+                else:
+                    for line in text.decode("utf-8").splitlines():
+                        row = json.loads(line)
+                        if after is not None and row[0] <= after:
+                            continue
+                        row[1] = datetime.fromisoformat(row[1])
+                        if (start is None or row[1] >= start) and (end is None or row[1] <= end):
+                            yield tuple(row)
+                offset = next_offset
+
+    # decompressed data of the member at offset and the offset behind it
+    # returns (None, None) at the end of the file and (None, offset) if the member is damaged
+    def __readMember(self, f, offset: int) -> tuple[bytes | None, int | None]:
+        f.seek(offset)
+        member = zlib.decompressobj(self.__GZIP_WBITS)
+        parts = []
+        read = 0
+        while not member.eof:
+            data = f.read(self.__READ_SIZE)
+            if not data:
+                return None, (offset if read else None)
+            read += len(data)
+            try:
+                parts.append(member.decompress(data))
+            except zlib.error:
+                return None, offset
+        return b"".join(parts), offset + read - len(member.unused_data)
+
+    # offset of the first member that starts at or after offset, None if there is none
+    def __findMember(self, f, offset: int) -> int | None:
+        overlap = len(self.__GZIP_MAGIC) - 1
+        f.seek(offset)
+        while True:
+            data = f.read(self.__READ_SIZE)
+            index = data.find(self.__GZIP_MAGIC)
+            if index >= 0:
+                return offset + index
+            if len(data) <= overlap:
+                return None
+            offset += len(data) - overlap
+            f.seek(offset)
+
+
+class PGLEventManagerArchiveResult:
+    """Result of selectEvents with archived rows in front of the rows of the database.
+    The archived rows are an iterable of rows in the layout of the cursor's rows, ordered by id, which is only
+    read as far as the result is fetched. If ordered is set the cursor's rows are ordered by id too, and both
+    are merged by id, so keyset pagination keeps working."""
+
+    # rows read from the cursor at a time
+    __FETCH_SIZE = 500
+
+    def __init__(self, cursor, archived, ordered: bool = False) -> None:
+        self.__cursor = cursor
+        self.description = cursor.description
+        if ordered:
+            self.__rows = heapq.merge(archived, self.__cursorRows(), key=lambda row: row[0])
+        else:
+            self.__rows = chain(archived, self.__cursorRows())
+
+    def fetchmany(self, size: int = 1) -> list:
+        return list(islice(self.__rows, size))
+
+    def fetchall(self) -> list:
+        return list(self.__rows)
+
+    def close(self) -> None:
+        self.__cursor.close()
+
+    def __cursorRows(self):
+        rows = self.__cursor.fetchmany(self.__FETCH_SIZE)
+        while rows:
+            yield from rows
+            rows = self.__cursor.fetchmany(self.__FETCH_SIZE)
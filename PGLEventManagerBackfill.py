@@ -0,0 +1,34 @@
+"""Rebuilds the hourly/daily rollups served on PGL/request/get_stats from all journeys and emergencies in the
+database and in the archive of the retention job. The rollups are kept up to date as events are stored, so this is
+only needed once for a database that has events from before the rollups were added. Stop the event manager while
+it runs:
+
+    python PGLEventManagerBackfill.py --archive archive --backend mysql --database PGL"""
+
+import argparse
+
+from PGLEventManagerLogging import setupLogging
+from PGLEventManagerModel import PGLEventManagerModel
+from PGLEventManagerStorage import addStorageArguments, storageArguments
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the rollups of PGLEventManager")
+    parser.add_argument("--archive", default="archive", help="archive directory of the retention job")
+    addStorageArguments(parser)
+    args = parser.parse_args()
+
+    log_listener = setupLogging()
+    model = PGLEventManagerModel(**storageArguments(args), archive_path=args.archive)
+    model.connectDB()
+    try:
+        counts = model.backfillRollups()
+    finally:
+        model.disconnectDB()
+        log_listener.stop()
+
+    print(f"Rolled up {counts['journey']} journeys and {counts['emergency']} emergencies")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""Offline benchmark of the controller and model hot paths.
+Drives PGLEventManagerController through an in-process stand-in for the MQTT client, so no broker is needed,
+against a local store (a temporary SQLite database unless told otherwise). For every request topic it delivers
+a burst of messages and measures the throughput (messages/sec until the last message is handled and written)
+and the p50/p99 latency of the model handler. Results are written as JSON, and can be compared with an
+earlier result file to spot regressions:
+
+    python PGLEventManagerBenchmark.py --output after.json --baseline before.json"""
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+from datetime import datetime, timedelta
+from random import Random
+from threading import Condition, Lock
+from time import perf_counter, sleep
+
+from paho.mqtt.client import MQTTMessage
+
+from PGLEventManagerController import PGLEventManagerController
+from PGLEventManagerModel import PGLEventManagerModel
+from PGLEventManagerStorage import addStorageArguments
+
+
+class PGLBenchmarkClient:
+    """In-process stand-in for the paho MQTT client used by the controller.
+    deliver hands a message straight to the controller's on_message callback, published responses are counted."""
+
+    def __init__(self) -> None:
+        self.on_message = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.__lock = Lock()
+        self.published = 0
+
+    def connect(self, *args, **kwargs) -> None:
+        pass
+
+    def disconnect(self, *args, **kwargs) -> None:
+        pass
+
+    def loop_start(self) -> None:
+        pass
+
+    def loop_stop(self) -> None:
+        pass
+
+    def subscribe(self, *args, **kwargs) -> None:
+        pass
+
+    def unsubscribe(self, *args, **kwargs) -> None:
+        pass
+
+    def publish(self, topic: str, payload=None, *args, **kwargs) -> None:
+        with self.__lock:
+            self.published += 1
+
+    # deliver a message on topic to the controller, like the paho network loop does
+    def deliver(self, topic: str, payload: str | bytes) -> None:
+        message = MQTTMessage(topic=topic.encode("utf-8"))
+        message.payload = payload.encode("utf-8") if isinstance(payload, str) else payload
+        self.on_message(self, None, message)
+
+
+class PGLBenchmarkModel(PGLEventManagerModel):
+    """Model that records the latency of the handler of every benchmarked topic."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.__condition = Condition()
+        self.__latencies = {}       # topic -> handler latencies in seconds
+
+    # call handler with payload and record how long it took under topic
+    def __timed(self, topic: str, handler, payload: str):
+        start = perf_counter()
+        try:
+            return handler(payload)
+        finally:
+            elapsed = perf_counter() - start
+            with self.__condition:
+                self.__latencies.setdefault(topic, []).append(elapsed)
+                self.__condition.notify_all()
+
+    def storeDevice(self, device_id: str) -> None:
+        return self.__timed("new_device", super().storeDevice, device_id)
+
+    def storeUser(self, credentials: str) -> str:
+        return self.__timed("store_user", super().storeUser, credentials)
+
+    def storeProduct(self, payload: str) -> str:
+        return self.__timed("store_product", super().storeProduct, payload)
+
+    def storeJourney(self, payload: str) -> None:
+        return self.__timed("store_event", super().storeJourney, payload)
+
+    def storeEmergency(self, payload: str) -> None:
+        return self.__timed("emergency", super().storeEmergency, payload)
+
+    def getJourneys(self, payload: str):
+        return self.__timed("get_events", super().getJourneys, payload)
+
+    def validateUser(self, credentials: str) -> str:
+        return self.__timed("valid_user", super().validateUser, credentials)
+
+    # wait until count handlers of topic have returned. Returns False on timeout
+    def waitFor(self, topic: str, count: int, timeout: float) -> bool:
+        with self.__condition:
+            return self.__condition.wait_for(lambda: len(self.__latencies.get(topic, ())) >= count, timeout)
+
+    # recorded handler latencies of topic, sorted
+    def latencies(self, topic: str) -> list[float]:
+        with self.__condition:
+            return sorted(self.__latencies.get(topic, ()))
+
+
+class PGLEventManagerBenchmark:
+    """Benchmark of PGLEventManagerController with a PGLBenchmarkModel, see the module docstring.
+    Topics are benchmarked in an order that builds up the data the later topics need:
+    users, devices and products first, then events and emergencies, then the requests that read them."""
+
+    __REQUEST_TOPIC = "PGL/request"
+    __DATETIME_FORMAT = "%m/%d/%Y, %H:%M:%S"
+
+    # seconds to wait for a topic's messages to be handled
+    __TIMEOUT = 600
+
+    def __init__(self, messages: int = 2000, users: int = 100, devices: int = 200, worker_count: int = 4,
+                 backend: str = "sqlite", database: str | None = None, host: str = "localhost",
+                 user: str = "PGL", password: str = "PGL", batch_size: int = 100,
+                 batch_latency: float = 0.05, cache_size: int = 1024, credential_cache_size: int = 0,
+                 seed: int = 0) -> None:
+        self.__messages = messages
+        self.__users = users
+        self.__devices = devices
+        self.__worker_count = worker_count
+        self.__backend = backend
+        self.__database = database
+        self.__host = host
+        self.__user = user
+        self.__password = password
+        self.__batch_size = batch_size
+        self.__batch_latency = batch_latency
+        self.__cache_size = cache_size
+        self.__credential_cache_size = credential_cache_size
+        self.__random = Random(seed)
+        self.__seed = seed
+
+    # run the benchmark and return the results
+    def run(self) -> dict:
+        started = datetime.now().isoformat(timespec="seconds")
+        with tempfile.TemporaryDirectory() as directory:
+            database = self.__database
+            if database is None:
+                database = os.path.join(directory, "PGL.db") if self.__backend == "sqlite" else "PGLBenchmark"
+
+            model = PGLBenchmarkModel(self.__host, database, self.__user, self.__password,
+                                      batch_size=self.__batch_size, batch_latency=self.__batch_latency,
+                                      cache_size=self.__cache_size,
+                                      credential_cache_size=self.__credential_cache_size,
+                                      backend=self.__backend)
+            client = PGLBenchmarkClient()
+            controller = PGLEventManagerController(self.__host, model, worker_count=self.__worker_count,
+                                                   mqtt_client=client)
+
+            controller.startListening()
+            try:
+                topics = {topic: self.__runTopic(model, client, topic, payloads)
+                          for topic, payloads in self.__workload()}
+            finally:
+                controller.stopListening()
+
+        return {"started": started,
+                "python": platform.python_version(),
+                "config": {"messages": self.__messages,
+                           "users": self.__users,
+                           "devices": self.__devices,
+                           "worker_count": self.__worker_count,
+                           "backend": self.__backend,
+                           "batch_size": self.__batch_size,
+                           "batch_latency": self.__batch_latency,
+                           "cache_size": self.__cache_size,
+                           "credential_cache_size": self.__credential_cache_size,
+                           "seed": self.__seed},
+                "topics": topics,
+                "responses": client.published,
+                "cache": json.loads(model.getCacheStats())}
+
+    # (topic, payloads) of every benchmarked topic, in the order they are run
+    def __workload(self):
+        usernames = [f"benchuser{i}" for i in range(self.__users)]
+        device_ids = [f"benchdevice{i}" for i in range(self.__devices)]
+
+        # every other user is a resident, who can only have one product
+        yield "store_user", [f"{username};pass;{'resident' if i % 2 else 'caregiver'};"
+                             for i, username in enumerate(usernames)]
+        yield "new_device", device_ids
+        yield "store_product", [f"{device_id};{usernames[i % self.__users]};"
+                                for i, device_id in enumerate(device_ids)]
+
+        start = datetime(2024, 1, 1)
+        timestamps = [(start + timedelta(seconds=i)).strftime(self.__DATETIME_FORMAT)
+                      for i in range(self.__messages)]
+        yield "store_event", [f"{timestamp};{self.__random.randint(0, 10000)};{self.__random.randint(0, 3000)};"
+                              f"{self.__random.choice(device_ids)};" for timestamp in timestamps]
+        yield "emergency", [f"{timestamp};{self.__random.randint(0, 10000)};{self.__random.choice(device_ids)};"
+                            for timestamp in timestamps]
+
+        yield "get_events", [f"{self.__random.choice(usernames)};" for _ in range(self.__messages)]
+        # every other request has a wrong password
+        yield "valid_user", [f"{self.__random.choice(usernames)};{'pass' if i % 2 else 'wrong'};benchmark;"
+                             for i in range(self.__messages)]
+
+    # deliver payloads on topic and measure how long the controller takes to handle them
+    def __runTopic(self, model: PGLBenchmarkModel, client: PGLBenchmarkClient, topic: str, payloads: list) -> dict:
+        start = perf_counter()
+        for payload in payloads:
+            client.deliver(f"{self.__REQUEST_TOPIC}/{topic}", payload)
+
+        # requests coalesced with an identical request in flight are not handled by the model.
+        # They are counted as they are delivered, so the count is final here
+        coalesced = model.getMetrics().snapshot()["coalesced"].get(f"{self.__REQUEST_TOPIC}/{topic}", 0)
+        if not model.waitFor(topic, len(payloads) - coalesced, self.__TIMEOUT):
+            raise TimeoutError(f"{topic} messages were not handled within {self.__TIMEOUT} s")
+        # rows still waiting in the batch are part of the work
+        while model.batchTimeout() is not None:
+            sleep(0.001)
+        elapsed = perf_counter() - start
+
+        latencies = model.latencies(topic)
+        return {"messages": len(payloads),
+                "coalesced": coalesced,
+                "seconds": elapsed,
+                "msgs_per_sec": len(payloads) / elapsed,
+                "p50_ms": self.__percentile(latencies, 50) * 1000,
+                "p99_ms": self.__percentile(latencies, 99) * 1000,
+                "max_ms": latencies[-1] * 1000}
+
+    # nearest-rank percentile of sorted values
+    def __percentile(self, values: list[float], percentile: float) -> float:
+        rank = max(1, -(-len(values) * percentile // 100))
+        return values[int(rank) - 1]
+
+
+# print the results, next to the baseline results if given
+# warns if the baseline was run with a different config, as the results are then not comparable
+def printResults(results: dict, baseline: dict | None = None) -> None:
+    if baseline is not None:
+        config, baseline_config = results["config"], baseline.get("config", {})
+        changed = [f"{key} {baseline_config.get(key, '-')} -> {config.get(key, '-')}"
+                   for key in {**baseline_config, **config} if baseline_config.get(key) != config.get(key)]
+        if changed:
+            print(f"Warning: the baseline was run with a different config: {', '.join(changed)}")
+
+    print(f"{'topic':<14}{'msgs/sec':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for topic, result in results["topics"].items():
+        line = f"{topic:<14}{result['msgs_per_sec']:>12.1f}{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+
+        before = None if baseline is None else baseline["topics"].get(topic)
+        if before is not None:
+            line += (f"   msgs/sec {result['msgs_per_sec'] / before['msgs_per_sec'] - 1:+.1%}"
+                     f", p99 {result['p99_ms'] / before['p99_ms'] - 1:+.1%}")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of PGLEventManager")
+    parser.add_argument("--messages", type=int, default=2000,
+                        help="messages per event and request topic")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    addStorageArguments(parser, "sqlite", "a temporary SQLite database by default")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--batch-latency", type=float, default=0.05)
+    parser.add_argument("--cache-size", type=int, default=1024)
+    parser.add_argument("--credential-cache-size", type=int, default=0,
+                        help="cache validateUser results, valid_user then measures cache hits")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json", help="file the JSON results are written to")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    benchmark = PGLEventManagerBenchmark(messages=args.messages, users=args.users, devices=args.devices,
+                                         worker_count=args.workers, backend=args.backend,
+                                         database=args.database, host=args.host, user=args.user,
+                                         password=args.password, batch_size=args.batch_size,
+                                         batch_latency=args.batch_latency, cache_size=args.cache_size,
+                                         credential_cache_size=args.credential_cache_size,
+                                         seed=args.seed)
+    results = benchmark.run()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    printResults(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import hmac
+import os
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class PGLEventManagerCache:
+    """Size-bounded LRU cache of serialized getJourneys/getEmergencies responses.
+    Entries belong to a username and are invalidated when one of the user's devices gets new data,
+    or when a device is linked to the user."""
+
+    def __init__(self, max_entries: int) -> None:
+        self.__max_entries = max_entries
+        self.__lock = Lock()
+        self.__entries = OrderedDict()      # key -> (username, value), least recently used first
+        self.__user_keys = {}               # username -> keys of the user's entries
+        self.__device_users = {}            # device_id -> usernames linked to the device
+        self.__generations = {}             # username -> number of invalidations of the user
+
+        # counters
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__invalidations = 0
+
+    # return the cached value for key, or None on a miss
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            return entry[1]
+
+    # record the devices linked to username before its data is queried
+    # returns the generation that has to be passed to put
+    def track(self, username: str, device_ids) -> int:
+        with self.__lock:
+            for device_id in device_ids:
+                self.__device_users.setdefault(device_id, set()).add(username)
+            return self.__generations.get(username, 0)
+
+    # store value for key. The value is dropped if the user was invalidated since track was called,
+    # as it might have been computed from data that is already outdated
+    def put(self, key, username: str, generation: int, value) -> None:
+        with self.__lock:
+            if self.__generations.get(username, 0) != generation:
+                return
+
+            self.__entries[key] = (username, value)
+            self.__entries.move_to_end(key)
+            self.__user_keys.setdefault(username, set()).add(key)
+
+            # evict least recently used entries
+            while len(self.__entries) > self.__max_entries:
+                old_key, (old_username, _) = self.__entries.popitem(last=False)
+                self.__user_keys[old_username].discard(old_key)
+                self.__evictions += 1
+
+    # drop all entries of the users linked to device_id
+    def invalidateDevice(self, device_id: str) -> None:
+        with self.__lock:
+            for username in self.__device_users.get(device_id, ()):
+                self.__invalidate(username)
+
+    # drop all entries of username
+    def invalidateUser(self, username: str) -> None:
+        with self.__lock:
+            self.__invalidate(username)
+
+    # must be called with __lock held
+    def __invalidate(self, username: str) -> None:
+        self.__generations[username] = self.__generations.get(username, 0) + 1
+        for key in self.__user_keys.pop(username, ()):
+            del self.__entries[key]
+            self.__invalidations += 1
+
+    # hit/miss/eviction counters and current size
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"size": len(self.__entries),
+                    "max_entries": self.__max_entries,
+                    "hits": self.__hits,
+                    "misses": self.__misses,
+                    "evictions": self.__evictions,
+                    "invalidations": self.__invalidations}
+
+
+class PGLEventManagerCredentialCache:
+    """Size-bounded LRU cache of validateUser results that expire after a time to live.
+    Valid credentials are kept for ttl seconds. A failed attempt is kept per username for negative_ttl seconds,
+    whatever the password was, so a burst of attempts with different wrong passwords or an unknown username is
+    answered from the cache, at the cost of refusing a correct password that isn't cached yet until it expires.
+    Failed attempts have their own LRU of at most max_failures usernames, so they never evict valid credentials.
+    Passwords are never stored: valid credentials are keyed by the username and an HMAC-SHA256 digest of the
+    password, salted with a random key that only lives in this process. Entries of a user are invalidated when it
+    is stored."""
+
+    # max_failures is max_entries if it is not given
+    def __init__(self, max_entries: int, ttl: float = 300, negative_ttl: float = 5,
+                 max_failures: int | None = None) -> None:
+        self.__max_entries = max_entries
+        self.__max_failures = max_failures if max_failures is not None else max_entries
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__salt = os.urandom(32)
+        self.__lock = Lock()
+        # valid credentials, (username, digest) -> expiry time, least recently used first
+        self.__entries = OrderedDict()
+        # failed attempts, username -> expiry time, least recently used first
+        self.__failures = OrderedDict()
+        self.__user_keys = {}               # username -> keys of the user's entries
+        self.__generations = {}             # username -> number of invalidations of the user
+
+        # counters
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__invalidations = 0
+
+    # cached result of validating password for username: True, False, or None on a miss
+    # valid credentials are looked up first, so a user whose password is cached can log in while someone
+    # else is guessing, and the failed attempts of the username after that
+    def get(self, username: str, password: str) -> bool | None:
+        key = (username, self.__digest(password))
+        now = monotonic()
+        with self.__lock:
+            expiry = self.__entries.get(key)
+            if expiry is not None and expiry <= now:
+                self.__remove(key)
+                expiry = None
+            if expiry is not None:
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+                return True
+
+            expiry = self.__failures.get(username)
+            if expiry is not None and expiry <= now:
+                del self.__failures[username]
+                expiry = None
+            if expiry is not None:
+                self.__failures.move_to_end(username)
+                self.__hits += 1
+                return False
+
+            self.__misses += 1
+            return None
+
+    # call before the credentials of username are validated
+    # returns the generation that has to be passed to put
+    def track(self, username: str) -> int:
+        with self.__lock:
+            return self.__generations.get(username, 0)
+
+    # store the result of validating password for username. The result is dropped if the user was
+    # invalidated since track was called, as it might be outdated
+    def put(self, username: str, password: str, generation: int, valid: bool) -> None:
+        key = (username, self.__digest(password))
+        now = monotonic()
+        with self.__lock:
+            if self.__generations.get(username, 0) != generation:
+                return
+
+            if not valid:
+                self.__failures[username] = now + self.__negative_ttl
+                self.__failures.move_to_end(username)
+                while len(self.__failures) > self.__max_failures:
+                    self.__failures.popitem(last=False)
+                    self.__evictions += 1
+                return
+
+            self.__failures.pop(username, None)
+            self.__entries[key] = now + self.__ttl
+            self.__entries.move_to_end(key)
+            self.__user_keys.setdefault(username, set()).add(key)
+
+            # evict least recently used entries
+            while len(self.__entries) > self.__max_entries:
+                self.__remove(next(iter(self.__entries)))
+                self.__evictions += 1
+
+    # drop all entries of username
+    def invalidateUser(self, username: str) -> None:
+        with self.__lock:
+            self.__generations[username] = self.__generations.get(username, 0) + 1
+            if self.__failures.pop(username, None) is not None:
+                self.__invalidations += 1
+            for key in self.__user_keys.pop(username, ()):
+                del self.__entries[key]
+                self.__invalidations += 1
+
+    # hit/miss/eviction counters, number of valid credentials and of usernames with a failed attempt
+    def stats(self) -> dict:
+        with self.__lock:
+            return {"size": len(self.__entries),
+                    "max_entries": self.__max_entries,
+                    "failures": len(self.__failures),
+                    "max_failures": self.__max_failures,
+                    "hits": self.__hits,
+                    "misses": self.__misses,
+                    "evictions": self.__evictions,
+                    "invalidations": self.__invalidations}
+
+    def __digest(self, password: str) -> bytes:
+        return hmac.digest(self.__salt, password.encode("utf-8"), "sha256")
+
+    # must be called with __lock held
+    def __remove(self, key: tuple) -> None:
+        del self.__entries[key]
+        user_keys = self.__user_keys[key[0]]
+        user_keys.discard(key)
+        if not user_keys:
+            del self.__user_keys[key[0]]
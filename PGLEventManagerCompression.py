@@ -0,0 +1,56 @@
+"""Compression of large responses, negotiated through MQTT v5 user properties.
+A request opts in with the user property 'accept-encoding', a comma separated list of the encodings the client
+can decode ('zstd', 'zlib'). Responses of at least the controller's compression_threshold bytes are then
+compressed with the first encoding the manager supports, in the order zstd, zlib, and carry the user property
+'content-encoding' with the encoding used and the content type 'application/json'. Smaller responses, and
+responses to requests without the property, are sent as plain json without properties.
+zstd is only available when the zstandard package is installed; zlib is always available."""
+
+import zlib
+
+# zstandard is used for the zstd encoding when it is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ACCEPT_ENCODING = "accept-encoding"
+CONTENT_ENCODING = "content-encoding"
+CONTENT_TYPE = "application/json"
+
+# encodings the manager can compress with, in order of preference
+ENCODINGS = ("zstd", "zlib") if zstandard is not None else ("zlib",)
+
+
+# encoding of the responses to a request with the given user properties ((name, value) pairs),
+# None if the request doesn't accept any encoding the manager supports
+def negotiateEncoding(user_properties) -> str | None:
+    accepted = set()
+    for name, value in user_properties:
+        if name.lower() == ACCEPT_ENCODING:
+            accepted.update(encoding.strip().lower() for encoding in value.split(","))
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    match encoding:
+        case "zstd":
+            return zstandard.ZstdCompressor().compress(data)
+        case "zlib":
+            return zlib.compress(data)
+        case _:
+            raise ValueError(f'Unknown encoding: {encoding}')
+
+
+# decompress a response with its content-encoding. Used by the clients of the manager
+def decompress(data: bytes, encoding: str) -> bytes:
+    match encoding:
+        case "zstd":
+            return zstandard.ZstdDecompressor().decompress(data)
+        case "zlib":
+            return zlib.decompress(data)
+        case _:
+            raise ValueError(f'Unknown encoding: {encoding}')
@@ -1,9 +1,21 @@
 from paho.mqtt.client import Client as MqttClient, MQTTMessage
-from threading import Event, Thread
-from queue import Empty, Queue
-import warnings
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from paho.mqtt.subscribeoptions import SubscribeOptions
+from threading import Event, Lock, Thread
+from queue import Empty
+from struct import error as StructError
+from time import monotonic, perf_counter
+from zlib import crc32
+import json
+import logging
+import os
 
+from PGLEventManagerCompression import CONTENT_ENCODING, CONTENT_TYPE, compress, negotiateEncoding
+from PGLEventManagerLogging import PAYLOAD, topicLogger
 from PGLEventManagerModel import PGLEventManagerModel
+from PGLEventManagerQueue import PGLEventManagerQueue
+from PGLEventManagerWireFormat import EMERGENCY_HEADER, JOURNEY_HEADER, decodeEmergency, decodeJourney
 
 
 class PGLEventManagerController:
@@ -14,11 +26,16 @@ class PGLEventManagerController:
     # different MQTT topics
     # READ: Right now we publish on the '__RESPONSE_VALIDATE_TOPIC' topic both when explicitly reque(logging in),
     # and when trying to create a new user (check for duplicates).
+    __logger = logging.getLogger("PGL.controller")
+
     __MAIN_TOPIC = "PGL"
     __REQUEST_TOPICS = f"{__MAIN_TOPIC}/request/#"
     # this is the events that the PI publishes to
     __REQUEST_STORE_EVENT_IN_DB_TOPIC = f'{__MAIN_TOPIC}/request/store_event'
     __REQUEST_EMERGENCY_TOPIC = f'{__MAIN_TOPIC}/request/emergency'
+    # binary encoded versions of the two topics above (see PGLEventManagerWireFormat)
+    __REQUEST_STORE_EVENT_BIN_TOPIC = f'{__MAIN_TOPIC}/request/store_event_bin'
+    __REQUEST_EMERGENCY_BIN_TOPIC = f'{__MAIN_TOPIC}/request/emergency_bin'
 
     # these are the events that the web should request on
     __REQUEST_STORE_USER_IN_DB_TOPIC = f'{__MAIN_TOPIC}/request/store_user'
@@ -27,29 +44,142 @@ class PGLEventManagerController:
     __REQUEST_GET_EMERGENCIES_TOPIC = f'{__MAIN_TOPIC}/request/get_emergencies'
     __REQUEST_VALIDATE_USER_TOPIC = f'{__MAIN_TOPIC}/request/valid_user'
     __REQUEST_NEW_DEVICE_TOPIC = f'{__MAIN_TOPIC}/request/new_device'
+    __REQUEST_CACHE_STATS_TOPIC = f'{__MAIN_TOPIC}/request/cache_stats'
+    __REQUEST_GET_STATS_TOPIC = f'{__MAIN_TOPIC}/request/get_stats'
 
     __RESPONSE_SEND_EVENTS_TOPIC = f'{__MAIN_TOPIC}/response/send_events'
     __RESPONSE_VALIDATE_TOPIC = f'{__MAIN_TOPIC}/response/valid'
     __RESPONSE_EMERGENCY_TOPIC = f'{__MAIN_TOPIC}/response/emergency'
+    __RESPONSE_CACHE_STATS_TOPIC = f'{__MAIN_TOPIC}/response/cache_stats'
+    __RESPONSE_SEND_STATS_TOPIC = f'{__MAIN_TOPIC}/response/send_stats'
+    # runtime metrics, published every stats_interval seconds
+    __RESPONSE_STATS_TOPIC = f'{__MAIN_TOPIC}/response/stats'
+    # requests rejected because the manager is overloaded, and invalid read requests, are answered on this topic,
+    # per user or device
+    __RESPONSE_ERROR_TOPIC = f'{__MAIN_TOPIC}/response/error'
+    # managers in a shared subscription group publish the changes of their model on this topic
+    # for the other managers of the group (see PGLEventManagerModel.setChangeListener), and the retention job
+    # publishes the devices whose events it archived
+    __SYNC_TOPIC = f'{__MAIN_TOPIC}/sync'
+
+    # request topics the manager handles. Messages on other topics under PGL/request are counted and logged under
+    # __UNKNOWN_TOPIC, so a client can't create a metrics series and a logger for every topic it makes up
+    __KNOWN_TOPICS = frozenset((__REQUEST_STORE_EVENT_IN_DB_TOPIC, __REQUEST_EMERGENCY_TOPIC,
+                                __REQUEST_STORE_EVENT_BIN_TOPIC, __REQUEST_EMERGENCY_BIN_TOPIC,
+                                __REQUEST_STORE_USER_IN_DB_TOPIC, __REQUEST_CREATE_PRODUCT_TOPIC,
+                                __REQUEST_GET_EVENTS_TOPIC, __REQUEST_GET_EMERGENCIES_TOPIC,
+                                __REQUEST_VALIDATE_USER_TOPIC, __REQUEST_NEW_DEVICE_TOPIC,
+                                __REQUEST_CACHE_STATS_TOPIC, __REQUEST_GET_STATS_TOPIC))
+    __UNKNOWN_TOPIC = f'{__MAIN_TOPIC}/request/unknown'
+
+    # journeys from the PIs, which the drop_oldest overload policy may drop. Emergencies are never dropped
+    __TELEMETRY_TOPICS = frozenset((__REQUEST_STORE_EVENT_IN_DB_TOPIC, __REQUEST_STORE_EVENT_BIN_TOPIC))
+
+    # read requests that are coalesced: a request arriving while an identical request (same topic and payload)
+    # is queued or being handled is not handled again, as the response of the first one is published on the
+    # response topic of the user, which answers both
+    __COALESCED_TOPICS = frozenset((__REQUEST_GET_EVENTS_TOPIC, __REQUEST_GET_EMERGENCIES_TOPIC,
+                                    __REQUEST_GET_STATS_TOPIC))
 
-    def __init__(self, mqtt_host: str, model: PGLEventManagerModel, mqtt_port: int = 1883) -> None:
-        self.__subscriber_thread = Thread(target=self.__worker,
-                                          daemon=True)
+    # scheduling lanes of the worker queues and their default weights, in order of priority (see PGLEventManagerQueue)
+    # the emergency lane is urgent: it is served whenever it has messages, before the weighted lanes
+    # messages on topics that are not listed go in the reads lane
+    __URGENT_LANE = "emergency"
+    __LANE_WEIGHTS = {"auth": 8, "ingest": 4, "reads": 1}
+    __TOPIC_LANES = {__REQUEST_EMERGENCY_TOPIC: "emergency",
+                     __REQUEST_EMERGENCY_BIN_TOPIC: "emergency",
+                     __REQUEST_VALIDATE_USER_TOPIC: "auth",
+                     __REQUEST_STORE_USER_IN_DB_TOPIC: "auth",
+                     __REQUEST_STORE_EVENT_IN_DB_TOPIC: "ingest",
+                     __REQUEST_STORE_EVENT_BIN_TOPIC: "ingest",
+                     __REQUEST_NEW_DEVICE_TOPIC: "ingest",
+                     __REQUEST_CREATE_PRODUCT_TOPIC: "ingest"}
+
+    # worker_count is the number of worker threads, each with its own queue and pooled database connection.
+    # Messages are sharded over the queues by device_id or username, so messages for the same
+    # device or user are handled in order while different devices are handled in parallel
+    # mqtt_client replaces the paho client, e.g. with the in-process client of PGLEventManagerBenchmark
+    # the model's metrics are published on PGL/response/stats every stats_interval seconds and, if
+    # stats_file is given, written to that file in the Prometheus text format (for node_exporter's textfile collector)
+    # queue_size bounds every worker queue (0 is unbounded). overload_policy decides what happens to messages
+    # arriving at a full queue: "block", "drop_oldest" or "reject" (see PGLEventManagerQueue)
+    # lane_weights overrides the weights of the auth, ingest and reads lanes, and one of them is served ahead of
+    # its weight once its oldest message has waited max_lane_wait seconds
+    # drain_timeout is the default number of seconds stopListening waits for the queued messages to be handled
+    # share_group subscribes to the request topics through the MQTT v5 shared subscription
+    # $share/<share_group>/PGL/request/#, so the broker hands every request to one manager of the group.
+    # The managers of a group tell each other about new users, products and events on PGL/sync every
+    # sync_interval seconds, so their indexes and caches stay current
+    # responses to get_events, get_emergencies and get_stats of at least compression_threshold bytes are compressed
+    # if the request accepts it (see PGLEventManagerCompression). None disables compression
+    def __init__(self, mqtt_host: str, model: PGLEventManagerModel, mqtt_port: int = 1883,
+                 worker_count: int = 1, mqtt_client: MqttClient | None = None,
+                 stats_interval: float = 10, stats_file: str | None = None,
+                 queue_size: int = 0, overload_policy: str = "block",
+                 lane_weights: dict[str, int] | None = None, max_lane_wait: float = 1.0,
+                 drain_timeout: float = 30, share_group: str | None = None,
+                 sync_interval: float = 0.1, compression_threshold: int | None = 4096) -> None:
+        self.__worker_count = worker_count
+        self.__subscriber_threads = [Thread(target=self.__worker,
+                                            args=(i,),
+                                            daemon=True)
+                                     for i in range(worker_count)]
         self.__stop___worker = Event()
-        self.__events_queue = Queue()
+        # set by stopListening, messages that arrive after it are refused
+        self.__draining = Event()
+        self.__drain_timeout = drain_timeout
+        self.__refused = 0
+        # queue items are (time of arrival, message)
+        self.__overload_policy = overload_policy
+        lanes = {**self.__LANE_WEIGHTS, **(lane_weights or {})}
+        self.__events_queues = [PGLEventManagerQueue(lanes, queue_size, overload_policy,
+                                                     lambda item: item[1].topic in self.__TELEMETRY_TOPICS,
+                                                     max_lane_wait, self.__URGENT_LANE)
+                                for _ in range(worker_count)]
         self.__PGLmodel = model
 
+        self.__compression_threshold = compression_threshold
+
+        # coalesced requests that are queued or being handled, (topic, payload, encoding) -> message
+        self.__in_flight_lock = Lock()
+        self.__in_flight = {}
+
+        # loggers of the request topics, by topic
+        self.__topic_loggers = {}
+
+        # runtime metrics, shared with the model
+        self.__metrics = model.getMetrics()
+        self.__metrics.setQueueProbe(self.__queueStats)
+        self.__stats_interval = stats_interval
+        self.__stats_file = stats_file
+        self.__stats_thread = Thread(target=self.__statsWorker, daemon=True)
+
+        # shared subscription and the changes of the model that are not yet published on the sync topic
+        self.__share_group = share_group
+        if share_group is None:
+            self.__subscription = self.__REQUEST_TOPICS
+        else:
+            self.__subscription = f'$share/{share_group}/{self.__REQUEST_TOPICS}'
+            model.setChangeListener(self.__recordChange)
+        self.__sync_interval = sync_interval
+        self.__changes_lock = Lock()
+        self.__changes = {}     # (kind, fields) -> None, in the order of the changes
+        self.__sync_thread = Thread(target=self.__syncWorker, daemon=True)
+
         # mqtt parameters and callback methods
         self.__mqtt_host = mqtt_host
         self.__mqtt_port = mqtt_port
-        self.__mqtt_client = MqttClient(reconnect_on_failure=True, protocol=5)
+        if mqtt_client is None:
+            mqtt_client = MqttClient(reconnect_on_failure=True, protocol=5)
+        self.__mqtt_client = mqtt_client
         self.__mqtt_client.on_message = self.__onMessage
         self.__mqtt_client.on_connect = self.__onConnect
         self.__mqtt_client.on_disconnect = self.__onDisconnect
 
     # connect the model to address and start the subscriber_thread
     def startListening(self) -> None:
-        self.__PGLmodel.connectDB()  # connect to database
+        self.__PGLmodel.connectDB(
+            pool_size=self.__worker_count)  # connect to database
 
         self.__mqtt_client.connect(host=self.__mqtt_host,  # connect to mqtt
                                    port=self.__mqtt_port,
@@ -57,29 +187,71 @@ class PGLEventManagerController:
 
         self.__mqtt_client.loop_start()  # start loop
         self.__mqtt_client.subscribe(
-            self.__REQUEST_TOPICS)  # subscribe to all topics
-        self.__subscriber_thread.start()  # start subscriber thread (listens for mqtt)
+            self.__subscription)  # subscribe to all topics
+        # the changes of the other managers in the group and of the retention job, not the ones this manager publishes
+        self.__mqtt_client.subscribe(
+            self.__SYNC_TOPIC, options=SubscribeOptions(qos=1, noLocal=True))
+        if self.__share_group is not None:
+            self.__sync_thread.start()
+        for subscriber_thread in self.__subscriber_threads:
+            subscriber_thread.start()  # start subscriber threads (listens for mqtt)
+        self.__stats_thread.start()
+
+    # stop subscriber threads and disconnect the model, without losing the messages that are already queued:
+    # stop accepting messages, wait up to timeout seconds (drain_timeout if None) for the queued messages to be
+    # handled, let the workers finish the message they are handling and write the pending batch.
+    # Messages still queued at the deadline are abandoned.
+    # Returns the number of messages that were drained and abandoned
+    def stopListening(self, timeout: float | None = None) -> dict:
+        if timeout is None:
+            timeout = self.__drain_timeout
+        started = monotonic()
+        deadline = started + timeout
 
-    # stop subscriber thread and disconnect the model
-    def stopListening(self) -> None:
+        # stop accepting messages. Messages the broker sent before the unsubscribe arrived are refused
+        self.__draining.set()
+        self.__mqtt_client.unsubscribe(self.__subscription)
+        queued = sum(events_queue.stats()["depth"] for events_queue in self.__events_queues)
 
-        # Disconnect from MQTT when events queue is empty
-        while not self.__events_queue.empty():
-            pass
+        # wait for the workers to handle the queued messages, including the ones they are handling now
+        for events_queue in self.__events_queues:
+            events_queue.join(max(0.0, deadline - monotonic()))
 
-        # stop subscriber thread
+        # stop subscriber threads and wait for them to finish the current message
         self.__stop___worker.set()
+        for events_queue in self.__events_queues:
+            events_queue.close()
+        for subscriber_thread in self.__subscriber_threads:
+            subscriber_thread.join()
+        # clearing wakes up a message blocked on a full queue, which is put in the queue after it,
+        # so the queues are cleared again once the mqtt loop has stopped
+        abandoned = sum(events_queue.clear() for events_queue in self.__events_queues)
+        self.__stats_thread.join()
+        # write what is left of the pending batch
+        self.__PGLmodel.flushBatch(force=True)
+        if self.__share_group is not None:
+            self.__sync_thread.join()
+            self.__publishChanges()
         self.__mqtt_client.loop_stop()                          # stop mqtt loop
-        # unsubscribe from all topics
-        self.__mqtt_client.unsubscribe(self.__REQUEST_TOPICS)
+        abandoned += sum(events_queue.clear() for events_queue in self.__events_queues)
         self.__mqtt_client.disconnect()                         # disconnect from mqtt
 
         # Disconnect from the database
         self.__PGLmodel.disconnectDB()
 
+        result = {"drained": queued - abandoned, "abandoned": abandoned + self.__refused}
+        if result["abandoned"]:
+            self.__logger.warning("Stopped after %.1f s: drained %d messages, abandoned %d (%d refused while draining)",
+                                  monotonic() - started, result["drained"], result["abandoned"],
+                                  self.__refused)
+        else:
+            self.__logger.info("Stopped after %.1f s: drained %d messages",
+                               monotonic() - started, result["drained"])
+        return result
+
     # callback method that is called when __mqtt_client is connected
     def __onConnect(self, client, userdata, flags, rc, _) -> None:
-        print("MQTT client connected")
+        self.__logger.info("MQTT client connected")
 
     # callback method that is called when __mqtt_client is disconnected
     def __onDisconnect(self, client, userdata, rc, _) -> None:
@@ -88,6 +260,10 @@ class PGLEventManagerController:
             self.__REQUEST_STORE_EVENT_IN_DB_TOPIC, "", retain=True)
         self.__mqtt_client.publish(
             self.__REQUEST_EMERGENCY_TOPIC, "", retain=True)
+        self.__mqtt_client.publish(
+            self.__REQUEST_STORE_EVENT_BIN_TOPIC, "", retain=True)
+        self.__mqtt_client.publish(
+            self.__REQUEST_EMERGENCY_BIN_TOPIC, "", retain=True)
         self.__mqtt_client.publish(
             self.__REQUEST_STORE_USER_IN_DB_TOPIC, "", retain=True)
         self.__mqtt_client.publish(
@@ -100,33 +276,220 @@ class PGLEventManagerController:
             self.__REQUEST_VALIDATE_USER_TOPIC, "", retain=True)
         self.__mqtt_client.publish(
             self.__REQUEST_NEW_DEVICE_TOPIC, "", retain=True)
-        print("MQTT client disconnected")
+        self.__mqtt_client.publish(
+            self.__REQUEST_CACHE_STATS_TOPIC, "", retain=True)
+        self.__mqtt_client.publish(
+            self.__REQUEST_GET_STATS_TOPIC, "", retain=True)
+        self.__logger.info("MQTT client disconnected")
+
+    # key that decides which worker handles a message
+    # PI messages are keyed by device_id, web requests by username
+    def __shardKey(self, message: MQTTMessage) -> bytes:
+        match message.topic:
+            case self.__REQUEST_STORE_EVENT_BIN_TOPIC:
+                return message.payload[JOURNEY_HEADER.size:]
+            case self.__REQUEST_EMERGENCY_BIN_TOPIC:
+                return message.payload[EMERGENCY_HEADER.size:]
+
+        fields = message.payload.split(b';')
+        match message.topic:
+            case self.__REQUEST_STORE_EVENT_IN_DB_TOPIC if len(fields) > 3:
+                return fields[3].strip()
+            case self.__REQUEST_EMERGENCY_TOPIC if len(fields) > 2:
+                return fields[2].strip()
+            case self.__REQUEST_CREATE_PRODUCT_TOPIC if len(fields) > 1:
+                return fields[1]
+            case _:
+                return fields[0].strip()
+
+    # topic that the metrics and logger of a message on topic are kept under: topic itself if the manager handles it,
+    # __UNKNOWN_TOPIC otherwise
+    def __knownTopic(self, topic: str) -> str:
+        return topic if topic in self.__KNOWN_TOPICS else self.__UNKNOWN_TOPIC
+
+    # logger of a request topic (see PGLEventManagerLogging), of a topic returned by __knownTopic
+    def __topicLogger(self, topic: str) -> logging.Logger:
+        logger = self.__topic_loggers.get(topic)
+        if logger is None:
+            logger = self.__topic_loggers.setdefault(topic, topicLogger(topic))
+        return logger
 
     # callback method that is called whenever a message arrives on a topic that '__mqtt_client' subscribes to
     def __onMessage(self, client, userdata, message: MQTTMessage) -> None:
+        topic = self.__knownTopic(message.topic)
         if message.payload == b'':
-            print("Empty MQTT message received")
+            self.__topicLogger(topic).debug("Empty MQTT message received")
+        elif message.topic == self.__SYNC_TOPIC:
+            self.__applyChanges(message.payload)
+        elif self.__draining.is_set():
+            # stopListening has started, the message would not be handled
+            self.__refused += 1
+            self.__metrics.countDropped(topic, "draining")
+            self.__topicLogger(topic).debug("MQTT message refused while draining")
+        elif message.topic in self.__COALESCED_TOPICS and not self.__admit(message):
+            # an identical request is in flight, its response answers this one
+            self.__metrics.countMessage(topic)
+            self.__metrics.countCoalesced(topic)
+            self.__topicLogger(topic).debug(
+                "Request coalesced with the identical request in flight: %r", message.payload, extra=PAYLOAD)
         else:
-            # put message in queue
-            self.__events_queue.put(message)
-            print(f'MQTT Message received with payload: {message.payload}')
+            # put message in the queue of the worker that owns its device or user
+            shard_key = self.__shardKey(message)
+            shard = crc32(shard_key) % self.__worker_count
+            self.__metrics.countMessage(topic)
+            lane = self.__TOPIC_LANES.get(message.topic, "reads")
+            dropped = self.__events_queues[shard].offer((monotonic(), message), lane)
+            self.__topicLogger(topic).debug(
+                "MQTT message received with payload: %r", message.payload, extra=PAYLOAD)
+
+            # the queue was full
+            if dropped is not None:
+                _, dropped_message = dropped
+                self.__release(dropped_message)
+                dropped_topic = self.__knownTopic(dropped_message.topic)
+                self.__metrics.countDropped(dropped_topic, self.__overload_policy)
+                if dropped_message is message and self.__overload_policy == "reject":
+                    user = shard_key.decode("utf-8", "replace")
+                    self.__mqtt_client.publish(f'{self.__RESPONSE_ERROR_TOPIC}/{user}/response',
+                                               json.dumps({"error": "overloaded", "topic": message.topic}))
+                self.__topicLogger(dropped_topic).warning(
+                    "Queue %d full, %s message (%s)", shard,
+                    "rejected" if self.__overload_policy == "reject" else "dropped", self.__overload_policy)
+
+    # encoding the responses to a request are compressed with if they are large, None if they are not compressed
+    def __responseEncoding(self, message: MQTTMessage) -> str | None:
+        properties = getattr(message, "properties", None)
+        if self.__compression_threshold is None or properties is None:
+            return None
+        return negotiateEncoding(getattr(properties, "UserProperty", ()))
 
-    # __worker is the method that the __subscriber_thread runs
+    # requests are identical if they get the same response: the same topic, payload and encoding
+    def __coalescingKey(self, message: MQTTMessage) -> tuple:
+        return message.topic, message.payload, self.__responseEncoding(message)
+
+    # register a coalesced request as in flight. Returns False if an identical request is in flight already
+    def __admit(self, message: MQTTMessage) -> bool:
+        key = self.__coalescingKey(message)
+        with self.__in_flight_lock:
+            if key in self.__in_flight:
+                return False
+            self.__in_flight[key] = message
+            return True
+
+    # the request is no longer in flight, identical requests arriving from now on are handled again.
+    # Called right before the response is published, so requests coalesced with it arrived before the response
+    def __release(self, message: MQTTMessage) -> None:
+        key = self.__coalescingKey(message)
+        with self.__in_flight_lock:
+            if self.__in_flight.get(key) is message:
+                del self.__in_flight[key]
+
+    # answer an invalid read request on the error topic of its user, so the client doesn't wait for a response
+    # the request is released first, so identical requests arriving later are handled again
+    def __publishInvalid(self, message: MQTTMessage, err: Exception) -> None:
+        self.__release(message)
+        user = message.payload.split(b';', 1)[0].decode("utf-8", "replace")
+        self.__mqtt_client.publish(f'{self.__RESPONSE_ERROR_TOPIC}/{user}/response',
+                                   json.dumps({"error": "invalid request", "topic": message.topic,
+                                               "reason": str(err)}))
+
+    # publish the result of getJourneys/getEmergencies on topic
+    # data is either a single json document (str or bytes) or, for paginated requests, a generator
+    # of json chunks that are published one at a time as they are read from the database
+    def __publishEvents(self, topic: str, data, encoding: str | None = None) -> None:
+        if isinstance(data, (str, bytes)):
+            self.__publishResponse(topic, data, encoding)
+        else:
+            for chunk in data:
+                self.__publishResponse(topic, chunk, encoding)
+
+    # publish a json response on topic, compressed with encoding if it is at least __compression_threshold bytes.
+    # A compressed response says so in its content-encoding user property
+    def __publishResponse(self, topic: str, data: str | bytes, encoding: str | None) -> None:
+        if encoding is not None:
+            payload = data.encode("utf-8") if isinstance(data, str) else data
+            if len(payload) >= self.__compression_threshold:
+                properties = Properties(PacketTypes.PUBLISH)
+                properties.ContentType = CONTENT_TYPE
+                properties.UserProperty = (CONTENT_ENCODING, encoding)
+                self.__mqtt_client.publish(topic, compress(payload, encoding), properties=properties)
+                return
+        self.__mqtt_client.publish(topic, data)
+
+    # change listener of the model, the change is published by the __sync_thread
+    def __recordChange(self, kind: str, fields: tuple) -> None:
+        with self.__changes_lock:
+            self.__changes[(kind, fields)] = None
+
+    # publish the recorded changes on the sync topic, as a json list of [kind, fields]
+    def __publishChanges(self) -> None:
+        with self.__changes_lock:
+            changes, self.__changes = self.__changes, {}
+        if changes:
+            self.__mqtt_client.publish(self.__SYNC_TOPIC, json.dumps(list(changes)), qos=1)
+
+    # apply the changes another manager of the group, or the retention job, published on the sync topic
+    def __applyChanges(self, payload: bytes) -> None:
+        try:
+            for kind, fields in json.loads(payload):
+                self.__PGLmodel.applyChange(kind, fields)
+        except (ValueError, TypeError) as err:
+            self.__logger.warning("Invalid changes on %s: %s", self.__SYNC_TOPIC, err)
+
+    # __syncWorker is the method that the __sync_thread runs
+    # publishes the recorded changes every __sync_interval seconds until the workers are stopped
+    def __syncWorker(self) -> None:
+        while not self.__stop___worker.wait(self.__sync_interval):
+            self.__publishChanges()
+
+    # depth and age in seconds of the oldest message of every worker queue and its lanes
+    def __queueStats(self) -> list[dict]:
+        return [events_queue.stats() for events_queue in self.__events_queues]
+
+    # __statsWorker is the method that the __stats_thread runs
+    # publishes the metrics every __stats_interval seconds until the workers are stopped
+    def __statsWorker(self) -> None:
+        while not self.__stop___worker.wait(self.__stats_interval):
+            self.__mqtt_client.publish(
+                self.__RESPONSE_STATS_TOPIC, json.dumps(self.__metrics.snapshot()))
+
+            if self.__stats_file is not None:
+                # write to a temporary file first, so readers never see a partial file
+                temporary_file = f'{self.__stats_file}.tmp'
+                try:
+                    with open(temporary_file, 'w') as f:
+                        f.write(self.__metrics.toPrometheus())
+                    os.replace(temporary_file, self.__stats_file)
+                except OSError as err:
+                    self.__logger.error("Failed to write metrics to %s: %s", self.__stats_file, err)
+
+    # __worker is the method that the __subscriber_threads run
     # listens for MQTT events
-    # empties __events_queue
-    def __worker(self) -> None:
-        print("Subscriber_thread __worker started")
+    # empties the __events_queues entry with the given index using its own database connection
+    def __worker(self, index: int) -> None:
+        self.__logger.info("Subscriber_thread __worker %d started", index)
+        events_queue = self.__events_queues[index]
+        self.__PGLmodel.acquireConnection()
         while not self.__stop___worker.is_set():
             try:
                 # pull message from events queue
-                # timeout indicates that we stop trying to dequeue after 1 s
+                # timeout indicates that we stop trying to dequeue after 1 s,
+                # or earlier if the model has a pending batch that is due
                 # throws 'Empty' exception if timeout
-                mqtt_message: MQTTMessage = self.__events_queue.get(timeout=1)
-            # if queue empty return
+                batch_timeout = self.__PGLmodel.batchTimeout()
+                timeout = 1 if batch_timeout is None else min(1, batch_timeout)
+                lane, (arrived_at, mqtt_message) = events_queue.get(timeout=timeout)
+            # if queue empty flush the pending batch if its deadline has passed
             except Empty:
-                pass
+                try:
+                    self.__PGLmodel.flushBatch()
+                except Exception:
+                    self.__logger.exception("Failed to flush the pending batch in __worker %d", index)
             # if the pull was succesful, handle the message to corresponding topic
             else:
+                handling_started = perf_counter()
+                topic = self.__knownTopic(mqtt_message.topic)
+                logger = self.__topicLogger(topic)
                 try:
                     mqtt_message_topic = mqtt_message.topic
                     match mqtt_message_topic:
@@ -139,6 +502,11 @@ class PGLEventManagerController:
                             event_string = mqtt_message.payload.decode("utf-8")
                             self.__PGLmodel.storeJourney(event_string)
 
+                        # store binary encoded journey from PI in database
+                        case self.__REQUEST_STORE_EVENT_BIN_TOPIC:
+                            self.__PGLmodel.storeJourneyRecord(
+                                *decodeJourney(mqtt_message.payload))
+
                         # store product in database (from web request)
                         # publishes to indicate if product is stored succesfully, either 'VALID' or 'INVALID'
                         case self.__REQUEST_CREATE_PRODUCT_TOPIC:
@@ -147,7 +515,7 @@ class PGLEventManagerController:
                                 event_string)
                             self.__mqtt_client.publish(
                                 f'{self.__RESPONSE_VALIDATE_TOPIC}/{user}/response', success)
-                            print(f'Stored product: {success}')
+                            logger.debug("Stored product: %s", success)
 
                         # store user in database (from web request)
                         # publishes to indicate if user is stored succesfully, either 'VALID' or 'INVALID'
@@ -157,17 +525,19 @@ class PGLEventManagerController:
                                 event_string)
                             self.__mqtt_client.publish(
                                 f'{self.__RESPONSE_VALIDATE_TOPIC}/{user}/response', succ)
-                            print(f'Validated user: {succ}')
+                            logger.debug("Stored user: %s", succ)
 
                         # return all journies from database for given user
                         case self.__REQUEST_GET_EVENTS_TOPIC:
                             # retrieve data from database using the model
                             user = mqtt_message.payload.decode("utf-8")
                             data, user = self.__PGLmodel.getJourneys(user)
+                            self.__release(mqtt_message)
                             # publish the data on the proper topic
-                            self.__mqtt_client.publish(
-                                f"{self.__RESPONSE_SEND_EVENTS_TOPIC}/{user}/response", data)
-                            print("Published data")
+                            self.__publishEvents(
+                                f"{self.__RESPONSE_SEND_EVENTS_TOPIC}/{user}/response", data,
+                                self.__responseEncoding(mqtt_message))
+                            logger.debug("Published events")
 
                         # validate a user
                         case self.__REQUEST_VALIDATE_USER_TOPIC:
@@ -176,7 +546,7 @@ class PGLEventManagerController:
                                 credentials)
                             self.__mqtt_client.publish(
                                 f'{self.__RESPONSE_VALIDATE_TOPIC}/{user}/response', validity)
-                            print(f'Validated user: {validity}')
+                            logger.debug("Validated user: %s", validity)
 
                         # store emergency message in database from pi
                         case self.__REQUEST_EMERGENCY_TOPIC:
@@ -184,19 +554,63 @@ class PGLEventManagerController:
                             self.__PGLmodel.storeEmergency(
                                 event_string)
 
+                        # store binary encoded emergency from pi in database
+                        case self.__REQUEST_EMERGENCY_BIN_TOPIC:
+                            self.__PGLmodel.storeEmergencyRecord(
+                                *decodeEmergency(mqtt_message.payload))
+
                         # return all emergencies from database for given user
                         case self.__REQUEST_GET_EMERGENCIES_TOPIC:
                             payload = mqtt_message.payload.decode("utf-8")
                             data, user = self.__PGLmodel.getEmergencies(
                                 payload)
+                            self.__release(mqtt_message)
+                            self.__publishEvents(
+                                f'{self.__RESPONSE_EMERGENCY_TOPIC}/{user}/response', data,
+                                self.__responseEncoding(mqtt_message))
+                            logger.debug("Published emergencies")
+
+                        # return the hourly/daily stats of the user's devices from the rollups
+                        case self.__REQUEST_GET_STATS_TOPIC:
+                            payload = mqtt_message.payload.decode("utf-8")
+                            data, user = self.__PGLmodel.getStats(payload)
+                            self.__release(mqtt_message)
+                            self.__publishResponse(
+                                f'{self.__RESPONSE_SEND_STATS_TOPIC}/{user}/response', data,
+                                self.__responseEncoding(mqtt_message))
+                            logger.debug("Published stats")
+
+                        # return the counters of the model's result cache
+                        case self.__REQUEST_CACHE_STATS_TOPIC:
                             self.__mqtt_client.publish(
-                                f'{self.__RESPONSE_EMERGENCY_TOPIC}/{user}/response', data)
-                            print("Published emergencies")
+                                self.__RESPONSE_CACHE_STATS_TOPIC, self.__PGLmodel.getCacheStats())
 
                         case _:
                             # not the right topic
-                            warnings.warn(
-                                f'Message recieved on unkown topic: {mqtt_message.topic}')
+                            logger.warning("Message received on unknown topic: %s", mqtt_message_topic)
+
+                    # write the pending batch if it is full or its deadline has passed
+                    self.__PGLmodel.flushBatch()
+
+                except (ValueError, StructError) as err:
+                    logger.warning("Invalid request: %s", err)
+                    self.__metrics.countError(topic)
+                    if mqtt_message.topic in self.__COALESCED_TOPICS:
+                        self.__publishInvalid(mqtt_message, err)
+                # any other error fails this request only, the worker keeps serving its queue
+                except Exception:
+                    logger.exception("Error occured in __worker")
+                    self.__metrics.countError(topic)
+                finally:
+                    # a request that failed has to be released too
+                    if mqtt_message.topic in self.__COALESCED_TOPICS:
+                        self.__release(mqtt_message)
+                    self.__metrics.observeHandler(
+                        topic, perf_counter() - handling_started)
+                    # time from arrival until the message is handled, for emergencies until they are in the database
+                    self.__metrics.observeLane(lane, monotonic() - arrived_at)
+                    events_queue.taskDone()
 
-                except KeyError:
-                    print(f'Error occured in __worker: {KeyError}')
+        # write pending rows on this worker's connection before returning it to the pool
+        self.__PGLmodel.flushBatch(force=True)
+        self.__PGLmodel.releaseConnection()
@@ -0,0 +1,52 @@
+"""Streaming export of the journey or emergency history of a user's devices, or of one device, as newline
+delimited JSON: an object per row with the columns of the table, ordered by id and with the datetime in ISO 8601.
+Rows are read from the database a chunk at a time and written as they are read, so histories of any size can be
+exported. The output can be imported again with PGLEventManagerImport:
+
+    python PGLEventManagerExport.py --username user1 --output user1_journeys.ndjson --backend mysql --database PGL"""
+
+import argparse
+import sys
+from time import perf_counter
+
+from PGLEventManagerLogging import setupLogging
+from PGLEventManagerModel import PGLEventManagerModel
+from PGLEventManagerStorage import addStorageArguments, storageArguments
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export journeys or emergencies of PGLEventManager as json lines")
+    parser.add_argument("--username", help="export the devices of this user")
+    parser.add_argument("--device", help="export this device (of the user, if --username is given)")
+    parser.add_argument("--table", choices=["journey", "emergency"], default="journey")
+    parser.add_argument("--from", dest="start", type=PGLEventManagerModel.parseDatetime,
+                        help="first datetime to export")
+    parser.add_argument("--to", dest="end", type=PGLEventManagerModel.parseDatetime,
+                        help="last datetime to export")
+    parser.add_argument("--output", help="file to write, standard output by default")
+    addStorageArguments(parser)
+    args = parser.parse_args()
+    if args.username is None and args.device is None:
+        parser.error("--username or --device is required")
+
+    log_listener = setupLogging()
+    model = PGLEventManagerModel(**storageArguments(args))
+    model.connectDB()
+    out = open(args.output, "w", encoding="utf-8") if args.output is not None else sys.stdout
+    started = perf_counter()
+    try:
+        count = model.exportEvents(args.table, out, args.username, args.device, args.start, args.end)
+    except ValueError as err:
+        sys.exit(f"Export failed: {err}")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        model.disconnectDB()
+        log_listener.stop()
+    elapsed = max(perf_counter() - started, 1e-6)
+
+    print(f"Exported {count} {args.table} rows in {elapsed:.1f} s ({count / elapsed:.0f} rows/sec)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Bulk import of journey and emergency history, e.g. when migrating a site, instead of replaying it one MQTT
+message at a time. Reads files in the shapes of the files in testfiles/ and of the export:
+- .json: a list of rows ([id, datetime, rtt, tt, device_id, ...] for journeys, [id, datetime, et, device_id, ...]
+  for emergencies), a list of objects with the column names, or a {"columns": [...], "rows": [...]} response
+- .ndjson: a row or object per line, like PGLEventManagerExport writes
+- .csv: rows in the column order above, or with a header line of column names
+Rows are stored in transactions of thousands of rows and unknown devices are created once. Rows with the same
+id and device in several files (the files in testfiles/ overlap) are imported once. For a directory all its
+files are imported, and the table of a file follows from its name (emergencies_*.json) unless --table is given:
+
+    python PGLEventManagerImport.py testfiles --backend mysql --database PGL
+
+Stop the event manager while importing, or restart it afterwards, as it caches responses."""
+
+import argparse
+import csv
+import json
+import logging
+import os
+from datetime import datetime
+from itertools import chain
+from time import perf_counter
+
+from PGLEventManagerLogging import setupLogging
+from PGLEventManagerModel import PGLEventManagerModel
+from PGLEventManagerStorage import addStorageArguments, storageArguments
+
+# value columns of the tables, between the datetime and the device_id
+VALUE_COLUMNS = {"journey": ("rtt", "tt"), "emergency": ("et",)}
+EXTENSIONS = (".json", ".ndjson", ".jsonl", ".csv")
+
+
+# the records of a file: lists in the column order of the table or objects with the column names
+def readRecords(path: str):
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, newline="", encoding="utf-8") as f:
+        if extension == ".csv":
+            reader = csv.reader(f)
+            first = next(reader, None)
+            if first is None:
+                return
+            if "datetime" in first:
+                yield from (dict(zip(first, row)) for row in reader)
+            else:
+                yield first
+                yield from reader
+
+        elif extension in (".ndjson", ".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+        else:
+            document = json.load(f)
+            if isinstance(document, dict) and "columns" in document:
+                yield from (dict(zip(document["columns"], row)) for row in document["rows"])
+            elif isinstance(document, dict):
+                yield from document.get("data", ())
+            else:
+                yield from document
+
+
+# (id in the source, row for PGLEventManagerModel.importEvents) of a record of table
+def toRow(table: str, record) -> tuple:
+    values = VALUE_COLUMNS[table]
+    if isinstance(record, dict):
+        source_id = record.get(f"{table}_id")
+        fields = [record["datetime"], *(record[column] for column in values), record["device_id"]]
+    else:
+        source_id = record[0]
+        fields = list(record[1:len(values) + 3])
+        if len(fields) < len(values) + 2:
+            raise ValueError(f"expected at least {len(values) + 3} columns, got {len(record)}")
+
+    timestamp = fields[0]
+    if not isinstance(timestamp, datetime):
+        timestamp = PGLEventManagerModel.parseDatetime(str(timestamp))
+    return source_id, (timestamp, *(str(value) for value in fields[1:-1]), str(fields[-1]).strip())
+
+
+def tableOf(path: str) -> str:
+    return "emergency" if os.path.basename(path).lower().startswith("emergenc") else "journey"
+
+
+class PGLEventManagerImport:
+    """Reads the files of an import, see the module docstring. Counts the rows that were skipped
+    because they were invalid or imported already."""
+
+    __logger = logging.getLogger("PGL.import")
+
+    def __init__(self, dedupe: bool = True) -> None:
+        self.__seen = set() if dedupe else None    # (table, source id, device_id) of the imported rows
+        self.invalid = 0
+        self.duplicates = 0
+
+    # the rows of table in the files, for PGLEventManagerModel.importEvents
+    def rows(self, table: str, paths: list[str]):
+        return chain.from_iterable(self.__fileRows(table, path) for path in paths)
+
+    def __fileRows(self, table: str, path: str):
+        for number, record in enumerate(readRecords(path), 1):
+            try:
+                source_id, row = toRow(table, record)
+            except (ValueError, KeyError, IndexError, TypeError) as err:
+                self.invalid += 1
+                self.__logger.warning("Skipping invalid row %d of %s: %s", number, path, err)
+                continue
+
+            if self.__seen is not None and source_id is not None:
+                key = (table, source_id, row[-1])
+                if key in self.__seen:
+                    self.duplicates += 1
+                    continue
+                self.__seen.add(key)
+            yield row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import journeys and emergencies into PGLEventManager")
+    parser.add_argument("paths", nargs="+", help="files, or directories of files, to import")
+    parser.add_argument("--table", choices=["journey", "emergency"],
+                        help="table of all files, by default emergency for files named emergencies_* and journey otherwise")
+    parser.add_argument("--keep-duplicates", action="store_true",
+                        help="import rows with the same id and device in several files more than once")
+    addStorageArguments(parser)
+    args = parser.parse_args()
+
+    files = {"journey": [], "emergency": []}
+    for path in args.paths:
+        if os.path.isdir(path):
+            paths = sorted(os.path.join(path, name) for name in os.listdir(path)
+                           if name.lower().endswith(EXTENSIONS))
+        else:
+            paths = [path]
+        for file in paths:
+            files[args.table or tableOf(file)].append(file)
+
+    log_listener = setupLogging()
+    model = PGLEventManagerModel(**storageArguments(args))
+    model.connectDB()
+    reader = PGLEventManagerImport(dedupe=not args.keep_duplicates)
+    counts = {}
+    started = perf_counter()
+    try:
+        for table, paths in files.items():
+            counts[table] = model.importEvents(table, reader.rows(table, paths)) if paths else 0
+    finally:
+        model.disconnectDB()
+        log_listener.stop()
+    elapsed = max(perf_counter() - started, 1e-6)
+
+    total = sum(counts.values())
+    print(f"Imported {counts['journey']} journeys and {counts['emergency']} emergencies from "
+          f"{sum(len(paths) for paths in files.values())} files in {elapsed:.1f} s ({total / elapsed:.0f} rows/sec)")
+    if reader.duplicates or reader.invalid:
+        print(f"Skipped {reader.duplicates} duplicate and {reader.invalid} invalid rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+from threading import Lock
+
+
+class PGLEventManagerIndex:
+    """In-memory index of the users and products tables: username -> (user_id, usertype) and the
+    devices of every user. It is loaded when the model connects and kept current by the model as it
+    stores users and products, so resolving a username and checking which devices a user owns
+    don't need a query."""
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__users = {}           # username -> (user_id, usertype)
+        self.__user_devices = {}    # user_id -> device_ids linked to the user
+
+    # replace the index with users (user_id, username, usertype) and products (device_id, user_id)
+    def load(self, users: list[tuple], products: list[tuple]) -> None:
+        with self.__lock:
+            self.__users = {username: (user_id, usertype) for user_id, username, usertype in users}
+            self.__user_devices = {}
+            for device_id, user_id in products:
+                self.__link(device_id, user_id)
+
+    def addUser(self, user_id: int, username: str, usertype: str) -> None:
+        with self.__lock:
+            self.__users[username] = (user_id, usertype)
+
+    def addProduct(self, device_id: str, user_id: int) -> None:
+        with self.__lock:
+            self.__link(device_id, user_id)
+
+    # (user_id, usertype) of username, None if the user is not in the index
+    def user(self, username: str) -> tuple | None:
+        with self.__lock:
+            return self.__users.get(username)
+
+    # device_ids linked to the user with user_id, sorted
+    def userDevices(self, user_id: int) -> list[str]:
+        with self.__lock:
+            return sorted(self.__user_devices.get(user_id, ()))
+
+    # True if device_id is linked to the user with user_id
+    def owns(self, user_id: int, device_id: str) -> bool:
+        with self.__lock:
+            return device_id in self.__user_devices.get(user_id, ())
+
+    # number of users and products in the index
+    def size(self) -> tuple[int, int]:
+        with self.__lock:
+            return len(self.__users), sum(len(devices) for devices in self.__user_devices.values())
+
+    # must be called with __lock held
+    def __link(self, device_id: str, user_id: int) -> None:
+        self.__user_devices.setdefault(user_id, set()).add(device_id)
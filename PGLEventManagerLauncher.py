@@ -0,0 +1,66 @@
+"""Starts a number of event manager processes that share the requests, to use more than one core.
+The managers subscribe through an MQTT v5 shared subscription of the same group, so the broker hands every
+request to one of them instead of to all. Run the launcher with the same group on more hosts to spread the
+managers over hosts. Every process gets its own spool file (PGL.<n>.spool), the other configuration is shared:
+
+    python PGLEventManagerLauncher.py --processes 4 --backend mysql --mqtt-host broker.local --group PGL
+
+Every client of the broker that subscribes with the same group gets a share of the requests, so on a public
+broker (like the default test.mosquitto.org) pick a group name no other deployment uses, or better, run your own.
+
+Ctrl+C stops all managers, each draining its queues like a single manager does."""
+
+import argparse
+import multiprocessing
+import os
+
+from PGLEventManagerMain import main as runManager
+from PGLEventManagerStorage import BACKENDS
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start PGLEventManager processes that share the requests")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="number of manager processes, the number of cores by default")
+    parser.add_argument("--group", default="PGL", help="shared subscription group of the managers")
+    parser.add_argument("--mqtt-host", default="test.mosquitto.org", help="MQTT broker of the managers")
+    parser.add_argument("--mqtt-port", type=int, default=1883)
+    parser.add_argument("--workers", type=int, default=4, help="worker threads per process")
+    parser.add_argument("--backend", choices=BACKENDS, default="mysql")
+    parser.add_argument("--overload-policy", choices=["block", "drop_oldest", "reject"], default="block")
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--no-spool", action="store_true", help="write events to the database directly")
+    args = parser.parse_args()
+
+    # spawn, so the processes start the same way on every platform and don't inherit threads of the launcher
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for n in range(args.processes):
+        kwargs = {"worker_count": args.workers,
+                  "backend": args.backend,
+                  "overload_policy": args.overload_policy,
+                  "log_level": args.log_level,
+                  "spool_path": None if args.no_spool else f"PGL.{n}.spool",
+                  "share_group": args.group,
+                  "mqtt_host": args.mqtt_host,
+                  "mqtt_port": args.mqtt_port}
+        process = context.Process(target=runManager, kwargs=kwargs, name=f"PGLEventManager-{n}")
+        process.start()
+        processes.append(process)
+    print(f"Started {len(processes)} managers in group {args.group} on {args.mqtt_host}:{args.mqtt_port}")
+
+    # Ctrl+C reaches the managers too, which stop by themselves
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+    for process in processes:
+        if process.exitcode:
+            print(f"{process.name} exited with code {process.exitcode}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Logging of the event manager.
+All loggers are children of the 'PGL' logger: 'PGL.controller', 'PGL.model', 'PGL.storage' and one logger per
+request topic, 'PGL.topic.<topic>' (e.g. 'PGL.topic.store_event'), whose level can be set per topic.
+setupLogging attaches a QueueHandler to the 'PGL' logger, so the threads that log only put the record in a queue,
+and a QueueListener thread writes the records out. Payloads of received messages are logged at DEBUG level,
+sampled and rate limited per topic by PGLEventManagerPayloadFilter."""
+
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from threading import Lock
+from time import monotonic
+
+ROOT_LOGGER = "PGL"
+TOPIC_LOGGER = f"{ROOT_LOGGER}.topic"
+
+# passed as extra to mark records that log a message payload
+PAYLOAD = {"payload": True}
+
+
+# logger of a request topic, e.g. 'PGL/request/store_event' -> 'PGL.topic.store_event'
+def topicLogger(topic: str) -> logging.Logger:
+    return logging.getLogger(f"{TOPIC_LOGGER}.{topic.rsplit('/', 1)[-1]}")
+
+
+class PGLEventManagerPayloadFilter(logging.Filter):
+    """Samples and rate limits the payload records (logged with extra=PAYLOAD) of every logger:
+    only every sample_every-th payload record passes, and at most rate_limit of those per second.
+    Other records always pass."""
+
+    def __init__(self, sample_every: int = 1, rate_limit: float = 10) -> None:
+        super().__init__()
+        self.__sample_every = max(1, sample_every)
+        self.__rate_limit = rate_limit
+        self.__lock = Lock()
+        self.__loggers = {}     # logger name -> [payload records seen, start of the window, records passed in the window]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "payload", False):
+            return True
+
+        with self.__lock:
+            state = self.__loggers.setdefault(record.name, [0, monotonic(), 0])
+            state[0] += 1
+            if state[0] % self.__sample_every:
+                return False
+
+            now = monotonic()
+            if now - state[1] >= 1:
+                state[1] = now
+                state[2] = 0
+            if state[2] >= self.__rate_limit:
+                return False
+            state[2] += 1
+            return True
+
+
+# log all records of the 'PGL' loggers through a background thread
+# level is the level of the 'PGL' logger, topic_levels sets the level per topic name (e.g. {"store_event": "WARNING"})
+# payloads are sampled and rate limited per topic, see PGLEventManagerPayloadFilter
+# handler writes the records out, a StreamHandler to stderr by default
+# returns the started QueueListener, which has to be stopped to write out the last records
+def setupLogging(level: int | str = logging.INFO, topic_levels: dict[str, int | str] | None = None,
+                 payload_sample_every: int = 1, payload_rate_limit: float = 10,
+                 handler: logging.Handler | None = None) -> QueueListener:
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s"))
+
+    records = SimpleQueue()
+    queue_handler = QueueHandler(records)
+    queue_handler.addFilter(PGLEventManagerPayloadFilter(payload_sample_every, payload_rate_limit))
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    for topic, topic_level in (topic_levels or {}).items():
+        logging.getLogger(f"{TOPIC_LOGGER}.{topic}").setLevel(topic_level)
+
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    return listener
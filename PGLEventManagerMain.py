@@ -2,14 +2,34 @@ from threading import Event
 import keyboard
 from PGLEventManagerModel import PGLEventManagerModel
 from PGLEventManagerController import PGLEventManagerController
+from PGLEventManagerLogging import setupLogging
+from PGLEventManagerStorage import defaultDatabase
 from time import sleep
 
 
-def main():
+# worker_count is the number of worker threads (and pooled database connections) of the controller
+# backend is the storage backend of the model: "mysql" or "sqlite" (stores the database in the file PGL.db)
+# overload_policy decides what happens to messages when a worker queue is full: "block", "drop_oldest" or "reject"
+# log_level is the level of all loggers, topic_levels overrides it per request topic, e.g. {"store_event": "DEBUG"}
+# spool_path is the file journeys and emergencies are spooled to before they are written to the database, None disables the spool
+# share_group makes the manager one of a group that shares the requests, see PGLEventManagerLauncher
+# mqtt_host and mqtt_port are the address of the MQTT broker
+def main(worker_count: int = 4, backend: str = "mysql", overload_policy: str = "block",
+         log_level: str = "INFO", topic_levels: dict[str, str] | None = None,
+         spool_path: str | None = "PGL.spool", share_group: str | None = None,
+         mqtt_host: str = "test.mosquitto.org", mqtt_port: int = 1883):
     print("Press 'x' to terminate")
-
-    model = PGLEventManagerModel("localhost", "PGL", "PGL", "PGL")
-    controller = PGLEventManagerController("test.mosquitto.org", model)
+    log_listener = setupLogging(log_level, topic_levels)
+
+    database = defaultDatabase(backend)
+    model = PGLEventManagerModel("localhost", database, "PGL", "PGL",
+                                 batch_size=100, batch_latency=0.05, cache_size=1024,
+                                 credential_cache_size=10000, backend=backend, spool_path=spool_path,
+                                 archive_path="archive")
+    controller = PGLEventManagerController(mqtt_host, model, mqtt_port=mqtt_port,
+                                           worker_count=worker_count,
+                                           queue_size=10000, overload_policy=overload_policy,
+                                           share_group=share_group)
 
     controller.startListening()
 
@@ -21,6 +41,7 @@ def main():
     except KeyboardInterrupt:
         print("Exiting")
         controller.stopListening()
+        log_listener.stop()
 
 
 if __name__ == "__main__":
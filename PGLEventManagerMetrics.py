@@ -0,0 +1,180 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+
+class PGLEventManagerHistogram:
+    """Latency histogram with fixed bucket bounds in seconds, exported like a Prometheus histogram.
+    Not thread safe, PGLEventManagerMetrics guards its histograms with its lock."""
+
+    # upper bounds of the buckets, the last bucket (+Inf) takes everything above
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self) -> None:
+        self.__counts = [0] * (len(self.BUCKETS) + 1)
+        self.__sum = 0.0
+        self.__count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.__counts[bisect_left(self.BUCKETS, seconds)] += 1
+        self.__sum += seconds
+        self.__count += 1
+
+    # cumulative count of every bucket by its upper bound, as in the Prometheus format
+    def snapshot(self) -> dict:
+        buckets = {}
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS + ("+Inf",), self.__counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"count": self.__count, "sum": self.__sum, "buckets": buckets}
+
+
+class PGLEventManagerMetrics:
+    """Runtime metrics of the event manager.
+    The controller counts messages and errors per topic, records how long the handler of each message took
+    and reports the depth of its queues and the age of their oldest message through a queue probe.
+    The model records the duration of its database queries per model method.
+    A snapshot is available as a dict (published as json on PGL/response/stats) and in the Prometheus text format."""
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__messages = {}            # topic -> messages received
+        self.__errors = {}              # topic -> messages that failed
+        self.__dropped = {}             # (topic, overload policy) -> messages dropped or rejected by a full queue
+        self.__coalesced = {}           # topic -> requests answered by an identical request in flight
+        self.__handler_latency = {}     # topic -> PGLEventManagerHistogram
+        self.__lane_latency = {}        # scheduling lane -> PGLEventManagerHistogram
+        self.__query_latency = {}       # model method -> PGLEventManagerHistogram
+        self.__query_errors = {}        # model method -> queries that raised
+
+        # function returning the stats of every queue: {"depth", "oldest_age", "lanes": {lane: {"depth", "oldest_age"}}}
+        self.__queue_probe = None
+
+    def countMessage(self, topic: str) -> None:
+        with self.__lock:
+            self.__messages[topic] = self.__messages.get(topic, 0) + 1
+
+    def countError(self, topic: str) -> None:
+        with self.__lock:
+            self.__errors[topic] = self.__errors.get(topic, 0) + 1
+
+    # count a message on topic that was dropped or rejected by the overload policy of a full queue
+    def countDropped(self, topic: str, policy: str) -> None:
+        with self.__lock:
+            self.__dropped[(topic, policy)] = self.__dropped.get((topic, policy), 0) + 1
+
+    # count a request on topic that was absorbed by an identical request that was queued or being handled
+    def countCoalesced(self, topic: str) -> None:
+        with self.__lock:
+            self.__coalesced[topic] = self.__coalesced.get(topic, 0) + 1
+
+    # record how long the handler of a message on topic took
+    def observeHandler(self, topic: str, seconds: float) -> None:
+        with self.__lock:
+            self.__handler_latency.setdefault(
+                topic, PGLEventManagerHistogram()).observe(seconds)
+
+    # record the time from arrival until handled of a message in a scheduling lane
+    def observeLane(self, lane: str, seconds: float) -> None:
+        with self.__lock:
+            self.__lane_latency.setdefault(
+                lane, PGLEventManagerHistogram()).observe(seconds)
+
+    # record how long a query made by the model method took
+    def observeQuery(self, method: str, seconds: float, failed: bool = False) -> None:
+        with self.__lock:
+            self.__query_latency.setdefault(
+                method, PGLEventManagerHistogram()).observe(seconds)
+            if failed:
+                self.__query_errors[method] = self.__query_errors.get(method, 0) + 1
+
+    # time the queries made in the with block for method
+    @contextmanager
+    def timeQuery(self, method: str):
+        start = perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.observeQuery(method, perf_counter() - start, failed)
+
+    def setQueueProbe(self, probe) -> None:
+        self.__queue_probe = probe
+
+    def snapshot(self) -> dict:
+        # the probe takes the queue locks, so it is called without holding ours
+        queues = [] if self.__queue_probe is None else self.__queue_probe()
+
+        with self.__lock:
+            return {"messages": dict(self.__messages),
+                    "errors": dict(self.__errors),
+                    "dropped": [{"topic": topic, "policy": policy, "count": count}
+                                for (topic, policy), count in self.__dropped.items()],
+                    "coalesced": dict(self.__coalesced),
+                    "handler_latency": {topic: histogram.snapshot()
+                                        for topic, histogram in self.__handler_latency.items()},
+                    "lane_latency": {lane: histogram.snapshot()
+                                     for lane, histogram in self.__lane_latency.items()},
+                    "query_latency": {method: histogram.snapshot()
+                                      for method, histogram in self.__query_latency.items()},
+                    "query_errors": dict(self.__query_errors),
+                    "queues": queues}
+
+    # snapshot in the Prometheus text exposition format
+    def toPrometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = []
+
+        # label values escaped as the exposition format requires
+        def label(value) -> str:
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def counter(name: str, help_text: str, label_name: str, values: dict) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in values.items():
+                lines.append(f'{name}{{{label_name}="{label(key)}"}} {value}')
+
+        def histogram(name: str, help_text: str, label_name: str, histograms: dict) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, value in histograms.items():
+                for bound, count in value["buckets"].items():
+                    lines.append(f'{name}_bucket{{{label_name}="{label(key)}",le="{bound}"}} {count}')
+                lines.append(f'{name}_sum{{{label_name}="{label(key)}"}} {value["sum"]}')
+                lines.append(f'{name}_count{{{label_name}="{label(key)}"}} {value["count"]}')
+
+        # queue gauges, per queue and lane
+        def gauge(name: str, help_text: str, key: str) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for index, queue in enumerate(snapshot["queues"]):
+                for lane, value in queue["lanes"].items():
+                    lines.append(f'{name}{{queue="{index}",lane="{label(lane)}"}} {value[key]}')
+
+        counter("pgl_messages_total", "Messages received per topic.",
+                "topic", snapshot["messages"])
+        counter("pgl_errors_total", "Messages per topic whose handler failed.",
+                "topic", snapshot["errors"])
+        lines.append("# HELP pgl_dropped_total Messages dropped or rejected by a full queue per topic and policy.")
+        lines.append("# TYPE pgl_dropped_total counter")
+        for dropped in snapshot["dropped"]:
+            lines.append(f'pgl_dropped_total{{topic="{label(dropped["topic"])}",policy="{label(dropped["policy"])}"}} '
+                         f'{dropped["count"]}')
+        counter("pgl_coalesced_total", "Requests per topic answered by an identical request in flight.",
+                "topic", snapshot["coalesced"])
+        histogram("pgl_handler_latency_seconds", "Time taken to handle a message per topic.",
+                  "topic", snapshot["handler_latency"])
+        histogram("pgl_lane_latency_seconds", "Time from arrival until handled of a message per scheduling lane.",
+                  "lane", snapshot["lane_latency"])
+        histogram("pgl_query_latency_seconds", "Duration of database queries per model method.",
+                  "method", snapshot["query_latency"])
+        counter("pgl_query_errors_total", "Database queries that failed per model method.",
+                "method", snapshot["query_errors"])
+        gauge("pgl_queue_depth", "Messages waiting in each worker queue lane.", "depth")
+        gauge("pgl_queue_oldest_age_seconds", "Age of the oldest message waiting in each worker queue lane.",
+              "oldest_age")
+        return "\n".join(lines) + "\n"
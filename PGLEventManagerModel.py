@@ -1,369 +1,934 @@
-import mysql.connector as mysql
+import heapq
 import json
+import logging
+from datetime import datetime
+from itertools import islice
+from threading import Lock
+from time import monotonic
+
+from PGLEventManagerArchive import PGLEventManagerArchive, PGLEventManagerArchiveResult
+from PGLEventManagerCache import PGLEventManagerCache, PGLEventManagerCredentialCache
+from PGLEventManagerIndex import PGLEventManagerIndex
+from PGLEventManagerMetrics import PGLEventManagerMetrics
+from PGLEventManagerSpool import PGLEventManagerSpool, PGLEventManagerSpoolReplayer
+from PGLEventManagerStorage import PGLEventManagerStorage, createStorage
+
+# orjson is used for encoding responses when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class PGLEventManagerModel:
-    """Model to store timestamp events in mysql database.
-    The model handles all interaction with the database. """
-
-    # table names
-    __USERS_TABLE_NAME = "users"
-    __JOURNEY_TABLE_NAME = "journey"
-    __PRODUCT_TABLE_NAME = "products"
-    __DEVICES_TABLE_NAME = "devices"
-    __EMERGENCY_TABLE_NAME = "emergency"
-
-    # table descriptions
-    __USERS_TABLE_DESCRIPTION: str = """users 
-                                       (user_id int NOT NULL AUTO_INCREMENT,
-                                        username VARCHAR(320) UNIQUE NOT NULL,
-                                        password VARCHAR(255) NOT NULL, 
-                                        usertype VARCHAR(30) NOT NULL, 
-                                        PRIMARY KEY(user_id) )"""
-
-    __JOURNEY_TABLE_DESCRIPTION: str = """journey 
-                                        (journey_id int NOT NULL AUTO_INCREMENT, 
-                                        datetime VARCHAR(30) NOT NULL, 
-                                        rtt VARCHAR(30) NOT NULL, 
-                                        tt  VARCHAR(30),
-                                        device_id VARCHAR(255) NOT NULL,
-                                        PRIMARY KEY (journey_id),
-                                        FOREIGN KEY (device_id) REFERENCES devices(device_id))"""
-
-    __EMERGENCY_TABLE_DESCRIPTION: str = """emergency
-                                        (emergency_id int NOT NULL AUTO_INCREMENT,
-                                        datetime VARCHAR(30) NOT NULL,
-                                        et VARCHAR(30) NOT NULL,
-                                        device_id VARCHAR(255) NOT NULL,
-                                        PRIMARY KEY (emergency_id),
-                                        FOREIGN KEY (device_id) REFERENCES devices(device_id))"""
-
-    __PRODUCTS_TABLE_DESCRIPTION: str = """products (
-                                            device_id VARCHAR(255) NOT NULL,
-                                            user_id int NOT NULL,
-                                            PRIMARY KEY (device_id, user_id),
-                                            FOREIGN KEY (device_id) REFERENCES devices(device_id),
-                                            FOREIGN KEY (user_id) REFERENCES users(user_id))"""
-
-    __DEVICES_TABLE_DESCRIPTION: str = """devices
-                                          (device_id VARCHAR(255) NOT NULL,
-                                          PRIMARY KEY (device_id)) """
-
-    __TABLE_DESCRIPTIONS = [__USERS_TABLE_DESCRIPTION, __JOURNEY_TABLE_DESCRIPTION,
-                            __PRODUCTS_TABLE_DESCRIPTION, __DEVICES_TABLE_DESCRIPTION, __EMERGENCY_TABLE_DESCRIPTION]
-
-    def __init__(self, host, database: str, user: str, password: str) -> None:
-        self.__host = host
-        self.__database_name = database
-        self.__user = user
-        self.__password = password
-        self.__PGL_db_connection = None
-
-    def connectDB(self) -> None:
-        # establish database connection
+    """Model to store timestamp events in a database.
+    The model handles all interaction with the database through a storage backend
+    (see PGLEventManagerStorage), which holds the connections and the SQL. """
+
+    __logger = logging.getLogger("PGL.model")
+
+    # format of the timestamps sent by the PIs, also used for timestamps in responses
+    __DATETIME_FORMAT = "%m/%d/%Y, %H:%M:%S"
+
+    # spooled records are the fields of a journey or emergency row separated by __SPOOL_SEPARATOR,
+    # starting with the kind of the record and the timestamp in ISO 8601
+    __SPOOL_JOURNEY = "J"
+    __SPOOL_EMERGENCY = "E"
+    __SPOOL_SEPARATOR = "\x1f"
+    # records replayed per transaction
+    __SPOOL_BATCH_SIZE = 500
+    # seconds to wait for the spool to be written to the database before a read and at disconnect
+    __SPOOL_DRAIN_TIMEOUT = 5
+
+    # rows read at a time when the rollups are rebuilt
+    __BACKFILL_CHUNK_SIZE = 10000
+    # rows moved to the archive per transaction by the retention job
+    __ARCHIVE_CHUNK_SIZE = 5000
+    # rows inserted per transaction by importEvents, and read at a time by exportEvents
+    __IMPORT_CHUNK_SIZE = 5000
+    __EXPORT_CHUNK_SIZE = 1000
+
+    # batch_size > 1 enables the batching writer: journeys and emergencies are buffered and
+    # written with executemany in a single transaction when batch_size rows are pending or
+    # when the oldest pending row is batch_latency seconds old
+    # cache_size > 0 enables an LRU cache of that many getJourneys/getEmergencies responses
+    # backend selects the storage backend: "mysql" (a MySQL/MariaDB server at host), "sqlite" (a local
+    # SQLite file, database is its path, host/user/password are ignored) or a PGLEventManagerStorage instance
+    # metrics receives the query timings, a new PGLEventManagerMetrics is created if none is given
+    # spool_path enables the spool: journeys and emergencies are appended to a memory-mapped file of spool_size
+    # bytes at that path and written to the database by a replay thread (see PGLEventManagerSpool).
+    # spool_sync flushes every record to disk
+    # archive_path is the directory of the archive the retention job moves old events to (see archiveEvents),
+    # which get_events/get_emergencies requests can include
+    # credential_cache_size > 0 enables a cache of that many validateUser results, valid ones are kept for
+    # credential_ttl seconds and invalid ones for credential_negative_ttl seconds
+    def __init__(self, host, database: str, user: str, password: str,
+                 batch_size: int = 1, batch_latency: float = 0.05, cache_size: int = 0,
+                 backend: str | PGLEventManagerStorage = "mysql",
+                 metrics: PGLEventManagerMetrics | None = None,
+                 spool_path: str | None = None, spool_size: int = 64 * 1024 * 1024,
+                 spool_sync: bool = False, archive_path: str | None = None,
+                 credential_cache_size: int = 0, credential_ttl: float = 300,
+                 credential_negative_ttl: float = 5) -> None:
+        self.__storage = createStorage(
+            backend, host, database, user, password)
+        self.__metrics = metrics if metrics is not None else PGLEventManagerMetrics()
+
+        # batching writer state
+        self.__batch_size = batch_size
+        self.__batch_latency = batch_latency
+        self.__batch_lock = Lock()      # guards the pending rows, never held while writing to the database
+        self.__flush_lock = Lock()      # held while a batch is written
+        self.__pending_journeys = []
+        self.__pending_emergencies = []
+        self.__batch_deadline = None
+
+        # device registry: device_ids known to exist in the devices table
+        self.__known_devices = set()
+
+        # users and the devices linked to them
+        self.__index = PGLEventManagerIndex()
+
+        # cache of serialized responses, invalidated by writes to the user's devices
+        self.__result_cache = PGLEventManagerCache(
+            cache_size) if cache_size > 0 else None
+
+        # cache of validateUser results, invalidated when the user is stored
+        self.__credential_cache = PGLEventManagerCredentialCache(
+            credential_cache_size, credential_ttl, credential_negative_ttl) if credential_cache_size > 0 else None
+
+        # durable spool of journeys and emergencies, replayed into the database once connected
+        self.__spool = PGLEventManagerSpool(
+            spool_path, spool_size, spool_sync) if spool_path is not None else None
+        self.__spool_replayer = None
+
+        # cold archive of old journeys and emergencies
+        self.__archive = PGLEventManagerArchive(
+            archive_path) if archive_path is not None else None
+
+        # called with the changes other managers on the same database have to apply, see setChangeListener
+        self.__change_listener = None
+
+    # pool_size is the number of connections that can be acquired by worker threads
+    # the spool replayer gets a connection of its own on top of those
+    def connectDB(self, pool_size: int = 1) -> None:
+        self.__storage.connect(pool_size + (1 if self.__spool is not None else 0))
         try:
-            self.__PGL_db_connection = mysql.connect(host=self.__host,
-                                                     user=self.__user,
-                                                     password=self.__password)
-
-            self.__PGL_db_connection.cursor().execute(
-                f"USE {self.__database_name}")
-            print("Connected to database succesfully")
-
-        except mysql.Error as err:
-            # If the database doesn't exist, then create it.
-            if err.errno == mysql.errorcode.ER_BAD_DB_ERROR:
-                print("Database does not exist. Will be created.")
-                self.__createDatabase()
-                print(f"Database {self.__database_name} created successfully.")
-            else:
-                print(f'Failed connecting to database with error: {err}')
+            self.__loadDevices()
+            self.__loadIndex()
+        except self.__storage.Error as err:
+            self.__logger.error("Failed to load devices and users from database with error: %s", err)
+
+        if self.__spool is not None:
+            self.__spool.open()
+            self.__logger.info("Opened spool with %d bytes to replay", self.__spool.pending())
+            self.__spool_replayer = PGLEventManagerSpoolReplayer(self.__spool, self.__replaySpool,
+                                                                 self.__SPOOL_BATCH_SIZE,
+                                                                 thread_setup=self.acquireConnection,
+                                                                 thread_teardown=self.releaseConnection)
+            self.__spool_replayer.start()
 
     # disconnect from the database
+    # records that could not be replayed within __SPOOL_DRAIN_TIMEOUT stay in the spool for the next start
     def disconnectDB(self) -> None:
-        self.__PGL_db_connection.disconnect()
-        print("Disconnected from database")
-
-    # creates database with parameters from __init__
-    def __createDatabase(self) -> None:
-        cursor = self.__PGL_db_connection.cursor()
-
+        if self.__spool_replayer is not None:
+            self.__spool_replayer.stop(self.__SPOOL_DRAIN_TIMEOUT)
+            self.__spool_replayer = None
+            self.__logger.info("Closed spool with %d bytes left to replay", self.__spool.pending())
+            self.__spool.close()
+        self.__storage.disconnect()
+        self.__logger.info("Disconnected from database")
+
+    # take a connection for the calling thread
+    # all queries made by this thread use that connection until it is released
+    def acquireConnection(self) -> None:
+        self.__storage.acquireConnection()
+
+    # return the calling thread's connection
+    def releaseConnection(self) -> None:
+        self.__storage.releaseConnection()
+
+    # metrics the model records its query timings in, shared with the controller
+    def getMetrics(self) -> PGLEventManagerMetrics:
+        return self.__metrics
+
+    # listener is called with (kind, fields) for every change that managers sharing the database have to apply
+    # to their index and caches (see applyChange):
+    # ("device", (device_id,)) once new events of a device are written,
+    # ("user", (user_id, username, usertype)) and ("product", (device_id, user_id, username)) once they are stored
+    def setChangeListener(self, listener) -> None:
+        self.__change_listener = listener
+
+    # apply a change made by another manager on the same database, as passed to its change listener
+    def applyChange(self, kind: str, fields) -> None:
+        match kind:
+            case "device":
+                self.__invalidateDevice(fields[0])
+            case "user":
+                user_id, username, usertype = fields
+                self.__index.addUser(user_id, username, usertype)
+                if self.__credential_cache is not None:
+                    self.__credential_cache.invalidateUser(username)
+            case "product":
+                device_id, user_id, username = fields
+                self.__index.addProduct(device_id, user_id)
+                if self.__result_cache is not None:
+                    self.__result_cache.invalidateUser(username)
+            case _:
+                raise ValueError(f'Unknown change: {kind}')
+
+    def __notify(self, kind: str, fields: tuple) -> None:
+        if self.__change_listener is not None:
+            self.__change_listener(kind, fields)
+
+    # drop the cached responses of the devices that got the written journeys and emergencies and tell the listener
+    # this happens after the write is committed, so a read that ran during the write doesn't keep its result
+    # cached, and other managers don't cache a result from before it
+    def __invalidateWritten(self, journeys: list, emergencies: list) -> None:
+        for device_id in {row[-1] for row in journeys} | {row[-1] for row in emergencies}:
+            self.__invalidateDevice(device_id)
+            self.__notify("device", (device_id,))
+
+    # parse a timestamp sent by a PI or given in a request, also used by the import and export
+    # accepts the PI format ('%m/%d/%Y, %H:%M:%S') and ISO 8601. Raises ValueError otherwise
+    @classmethod
+    def parseDatetime(cls, text: str) -> datetime:
+        text = text.strip()
         try:
-            # create database
-            cursor.execute(
-                f"CREATE DATABASE {self.__database_name} DEFAULT CHARACTER SET 'utf8'")
-        except mysql.Error as err:
-            # catch error
-            print(f"Failed to create database with error: {err}")
-
-        else:
-            # move cursor to work in this database
-            cursor.execute(f'USE {self.__database_name}')
-
-            # create tables
-            for table in self.__TABLE_DESCRIPTIONS:
-                cursor.execute(f"CREATE TABLE {table}")
-
-        cursor.close()
-        self.__PGL_db_connection = self.__database_name
-
-    # check if user exists in database
-    # returns True if user exists, False otherwise
-    def __userExists(self, username) -> bool:
-        # retrieves the count of rows with the given username
-        cursor = self.__PGL_db_connection.cursor()
-        query = f'SELECT COUNT(username) FROM {self.__USERS_TABLE_NAME} WHERE username = "{username}";'
-        cursor.execute(query)
-        user_count = cursor.fetchone()[0]
-        if user_count == 0:
-            return False
-        else:
-            return True
-
-    # check if device exists in database
-    # returns True if device exists, False otherwise
-    def __deviceExists(self, device_id) -> bool:
-        # retrieves the count of rows with the given device_id
-        cursor = self.__PGL_db_connection.cursor()
-        query = f'SELECT COUNT(device_id) FROM {self.__DEVICES_TABLE_NAME} WHERE device_id = "{device_id}";'
-        cursor.execute(query)
-        device_count = cursor.fetchone()[0]
-        if device_count == 0:
-            return False
-        else:
-            return True
+            return datetime.strptime(text, cls.__DATETIME_FORMAT)
+        except ValueError:
+            return datetime.fromisoformat(text)
+
+    # load the users and products into the index
+    def __loadIndex(self) -> None:
+        with self.__metrics.timeQuery("loadIndex"):
+            self.__index.load(self.__storage.loadUsers(), self.__storage.loadProducts())
+        users, products = self.__index.size()
+        self.__logger.info("Loaded %d users and %d products from DB", users, products)
+
+    # (user_id, usertype) of username, None if the user doesn't exist
+    # a user that is not in the index (stored by another manager on the same database) is read from the database
+    # method is the model method the query timings are recorded under
+    def __resolveUser(self, username: str, method: str) -> tuple | None:
+        user = self.__index.user(username)
+        if user is not None:
+            return user
+
+        with self.__metrics.timeQuery(method):
+            user = self.__storage.selectUser(username)
+            if user is None:
+                return None
+            device_ids = self.__storage.selectUserDevices(user[0])
+        self.__index.addUser(user[0], username, user[1])
+        for device_id in device_ids:
+            self.__index.addProduct(device_id, user[0])
+        return user
+
+    # user_id of username, all devices linked to the user and the devices a request selects:
+    # device_id if it is given and linked to the user, otherwise all of them
+    # the user_id is None and the device lists are empty if the user doesn't exist
+    def __requestDevices(self, username: str, device_id: str | None, method: str) -> tuple:
+        user = self.__resolveUser(username, method)
+        if user is None:
+            return None, [], []
+        device_ids = self.__index.userDevices(user[0])
+        if device_id is None:
+            return user[0], device_ids, device_ids
+        return user[0], device_ids, [device_id] if device_id in device_ids else []
+
+    # load all device_ids from the devices table into the device registry
+    def __loadDevices(self) -> None:
+        with self.__metrics.timeQuery("connectDB"):
+            self.__known_devices = self.__storage.loadDevices()
+        self.__logger.info("Loaded %d devices from DB", len(self.__known_devices))
+
+    # drop cached responses of the users linked to device_id, as the device gets new data
+    def __invalidateDevice(self, device_id: str) -> None:
+        if self.__result_cache is not None:
+            self.__result_cache.invalidateDevice(device_id)
+
+    # make sure the device exists before rows referencing it are inserted
+    # only goes to the database for devices that are not in the registry
+    def __ensureDevice(self, device_id: str) -> None:
+        if device_id not in self.__known_devices:
+            self.__logger.info("Device: %s not known. Will be created.", device_id)
+            self.storeDevice(device_id)
 
 # region Store data in database
     # store a new device in the database with the given device_id
+    # the insert is idempotent, so concurrent creators of the same device do not race
     def storeDevice(self, device_id: str) -> None:
+        if device_id in self.__known_devices:
+            self.__logger.debug("Device already exists in DB")
+            return
+
         try:
-            if not self.__deviceExists(device_id):
-                cursor = self.__PGL_db_connection.cursor()
-                query = f'INSERT INTO {self.__DEVICES_TABLE_NAME} (device_id) VALUES ("{device_id}")'
-                cursor.execute(query)
-                self.__PGL_db_connection.commit()
-                print("Stored device in DB")
-                cursor.close()
-            else:
-                print("Device already exists in DB")
+            with self.__metrics.timeQuery("storeDevice"):
+                self.__storage.insertDevice(device_id)
+            self.__known_devices.add(device_id)
+            self.__logger.debug("Stored device in DB")
 
-        except mysql.Error as err:
-            print(f'Failed to insert into database with error: {err}')
+        except self.__storage.Error as err:
+            self.__logger.error("Failed to insert into database with error: %s", err)
 
-    # store a new journey in the database with the given payload
+    # store a new journey in the database with the given payload 'datetime;rtt;tt;device;'
     def storeJourney(self, payload: str) -> None:
         try:
-            cursor = self.__PGL_db_connection.cursor()
-            val = tuple(payload.split(';')[:-1])
+            val = payload.split(';')[:-1]
+            timestamp = self.parseDatetime(val[0])
+        except ValueError as err:
+            self.__logger.warning("Invalid timestamp in journey: %s", err)
+            return
+        self.storeJourneyRecord(timestamp, val[1], val[2], val[3].strip())
+
+    # store a new journey in the database from its decoded fields
+    def storeJourneyRecord(self, timestamp: datetime, rtt, tt, device_id: str) -> None:
+        try:
+            val = (timestamp, rtt, tt, device_id)
+            # cached responses are dropped right away, so they don't miss the journey while it is pending,
+            # and again once it is written
+            self.__invalidateDevice(device_id)
 
-            # check if device exists in database and create it if it doesn't
-            device = val[3].strip()
-            if not self.__deviceExists(device):
-                print(
-                    f"Device: {device} does not exist in DB. Will be created.")
-                self.storeDevice(device)
+            # with the spool enabled the replayer stores the journey
+            if self.__appendToSpool(self.__SPOOL_JOURNEY, val):
+                return
+
+            # create device if it is not known yet
+            self.__ensureDevice(device_id)
+
+            # buffer journey if the batching writer is enabled
+            if self.__batch_size > 1:
+                self.__addToBatch(val)
+                return
 
             # store journey in database
-            query = f"INSERT INTO {self.__JOURNEY_TABLE_NAME} (datetime, rtt, tt, device_id) VALUES (%s, %s, %s, %s)"
-            cursor.execute(query, val)
-            self.__PGL_db_connection.commit()
-            print("Stored event in DB")
-            cursor.close()
+            with self.__metrics.timeQuery("storeJourney"):
+                self.__storage.insertEvents([val], [])
+            self.__invalidateWritten([val], [])
+            self.__logger.debug("Stored event in DB")
 
-        except mysql.Error as err:
-            print(f'Failed to insert journey into database with error: {err}')
+        except self.__storage.Error as err:
+            self.__logger.error("Failed to insert journey into database with error: %s", err)
 
-    # store a new emergency in the database with the given payload
+    # store a new emergency in the database with the given payload 'datetime;et;device;'
     def storeEmergency(self, payload: str) -> None:
         try:
-            cursor = self.__PGL_db_connection.cursor()
-            val = tuple(payload.split(';')[:-1])
+            val = payload.split(';')[:-1]
+            timestamp = self.parseDatetime(val[0])
+        except ValueError as err:
+            self.__logger.warning("Invalid timestamp in emergency: %s", err)
+            return
+        self.storeEmergencyRecord(timestamp, val[1], val[2].strip())
+
+    # store a new emergency in the database from its decoded fields
+    # emergencies are not spooled, so they don't wait behind the spooled journeys. The spool only takes an
+    # emergency that can't be written, and the replayer writes it once the database is back
+    def storeEmergencyRecord(self, timestamp: datetime, et, device_id: str) -> None:
+        try:
+            val = (timestamp, et, device_id)
+            # dropped again once the emergency is written
+            self.__invalidateDevice(device_id)
 
-            # check if device exists in database and create it if it doesn't
-            device = val[2].strip()
-            if not self.__deviceExists(device):
-                print(
-                    f"Device: {device} does not exist in DB. Will be created.")
-                self.storeDevice(device)
+            # create device if it is not known yet
+            self.__ensureDevice(device_id)
+
+            # with the batching writer enabled, the emergency is written right away together with
+            # the pending journeys, as emergencies must not wait for the batch deadline
+            if self.__batch_size > 1 and self.__spool is None:
+                self.__addToBatch(val, emergency=True)
+                self.flushBatch(force=True)
+                return
 
             # store emergency in database
-            query = f"INSERT INTO {self.__EMERGENCY_TABLE_NAME} (datetime, et, device_id) VALUES (%s, %s, %s)"
-            cursor.execute(query, val)
-            self.__PGL_db_connection.commit()
-            print("Stored emergency in DB")
-            cursor.close()
+            try:
+                with self.__metrics.timeQuery("storeEmergency"):
+                    self.__storage.insertEvents([], [val])
+            except self.__storage.Error as err:
+                if self.__appendToSpool(self.__SPOOL_EMERGENCY, val):
+                    self.__logger.warning("Failed to insert emergency, spooled it for replay: %s", err)
+                    return
+                raise
+            self.__invalidateWritten([], [val])
+            self.__logger.debug("Stored emergency in DB")
+
+        except self.__storage.Error as err:
+            self.__logger.error("Failed to insert emergency into database with error: %s", err)
+
+    # append a journey or emergency row to the spool
+    # returns False if the spool is disabled or full, in which case the row has to be written directly
+    def __appendToSpool(self, kind: str, row: tuple) -> bool:
+        if self.__spool is None:
+            return False
+
+        timestamp, *fields = row
+        record = self.__SPOOL_SEPARATOR.join(
+            [kind, timestamp.isoformat(), *(str(field) for field in fields)])
+        if self.__spool.append(record.encode("utf-8")):
+            return True
+        self.__logger.warning("Spool is full, writing to the database directly")
+        return False
+
+    # write spooled records to the database in a single transaction, called by the spool replayer
+    # if the transaction fails, the rows are written one at a time: rows the database rejects are logged and
+    # skipped, so they don't hold up the rows behind them. Any other error (e.g. of the connection) is raised,
+    # so the records are replayed again once the database is back
+    def __replaySpool(self, records: list[bytes]) -> None:
+        journeys = []
+        emergencies = []
+        for record in records:
+            try:
+                kind, timestamp, *fields = record.decode("utf-8").split(self.__SPOOL_SEPARATOR)
+                row = (datetime.fromisoformat(timestamp), *fields)
+            except ValueError as err:
+                self.__logger.error("Skipping invalid spooled record %r: %s", record, err)
+                continue
+            if kind == self.__SPOOL_JOURNEY:
+                journeys.append(row)
+            else:
+                emergencies.append(row)
+
+        # the devices are created here, so storing a record does not depend on the database
+        for device_id in {row[-1] for row in journeys + emergencies}:
+            self.__ensureDevice(device_id)
 
-        except mysql.Error as err:
-            print(f'Failed to insert emergency into database with error: {err}')
+        try:
+            with self.__metrics.timeQuery("replaySpool"):
+                self.__storage.insertEvents(journeys, emergencies)
+        except self.__storage.Error as err:
+            self.__logger.warning("Failed to replay %d events and %d emergencies, "
+                                  "replaying them one at a time: %s", len(journeys), len(emergencies), err)
+            journeys = [row for row in journeys if self.__replayRow(row, [row], [])]
+            emergencies = [row for row in emergencies if self.__replayRow(row, [], [row])]
+        # also drops a result cached by a read whose drain timed out
+        self.__invalidateWritten(journeys, emergencies)
+        self.__logger.debug("Replayed %d events and %d emergencies from the spool",
+                            len(journeys), len(emergencies))
+
+    # write a single row of a failed replay. Returns False if the database rejected the row, which is then skipped
+    # errors that are not about the row are raised, so the replayer retries the records
+    def __replayRow(self, row: tuple, journeys: list, emergencies: list) -> bool:
+        try:
+            with self.__metrics.timeQuery("replaySpool"):
+                self.__storage.insertEvents(journeys, emergencies)
+            return True
+        except self.__storage.RowError as err:
+            self.__logger.error("Skipping spooled row %r rejected by the database: %s", row, err)
+            return False
+
+    # append a journey or emergency row to its pending batch and flush if the batch is full
+    # the batch is looked up under the lock, as flushBatch replaces it with a new list
+    def __addToBatch(self, row: tuple, emergency: bool = False) -> None:
+        with self.__batch_lock:
+            if emergency:
+                self.__pending_emergencies.append(row)
+            else:
+                self.__pending_journeys.append(row)
+            if self.__batch_deadline is None:
+                self.__batch_deadline = monotonic() + self.__batch_latency
+        self.flushBatch()
+
+    # seconds until the pending batch has to be flushed. Returns None if nothing is pending
+    def batchTimeout(self) -> float | None:
+        with self.__batch_lock:
+            if self.__batch_deadline is None:
+                return None
+            return max(0.0, self.__batch_deadline - monotonic())
+
+    # write all pending journeys and emergencies in a single transaction
+    # unless force is set, this only happens when the batch is full or its deadline has passed.
+    # With force set, this also waits until the spool is written to the database
+    # the pending rows are swapped out under the batch lock and written under the flush lock only, so workers
+    # can add rows while a batch is written. A forced flush waits for a batch that is being written
+    def flushBatch(self, force: bool = False) -> None:
+        if force and self.__spool_replayer is not None:
+            self.__spool_replayer.drain(self.__SPOOL_DRAIN_TIMEOUT)
+
+        if not force:
+            with self.__batch_lock:
+                if not self.__batchDue():
+                    return
+
+        with self.__flush_lock:
+            with self.__batch_lock:
+                if self.__batch_deadline is None:
+                    return
+                # another flush may have written the batch while this one waited for the flush lock
+                if not force and not self.__batchDue():
+                    return
+                journeys, self.__pending_journeys = self.__pending_journeys, []
+                emergencies, self.__pending_emergencies = self.__pending_emergencies, []
+                self.__batch_deadline = None
+
+            self.__writeBatch(journeys, emergencies)
+
+    # whether the pending batch is full or its deadline has passed. Must be called with the batch lock held
+    def __batchDue(self) -> bool:
+        if self.__batch_deadline is None:
+            return False
+        pending_count = len(self.__pending_journeys) + \
+            len(self.__pending_emergencies)
+        return pending_count >= self.__batch_size or monotonic() >= self.__batch_deadline
+
+    # write a batch in a single transaction
+    # if the transaction fails, the rows are written one at a time, so a row the database rejects
+    # only loses that row instead of the whole batch
+    def __writeBatch(self, journeys: list, emergencies: list) -> None:
+        try:
+            with self.__metrics.timeQuery("flushBatch"):
+                self.__storage.insertEvents(journeys, emergencies)
+        except self.__storage.Error as err:
+            self.__logger.warning("Failed to insert batch of %d events and %d emergencies, "
+                                  "inserting them one at a time: %s", len(journeys), len(emergencies), err)
+            journeys = [row for row in journeys if self.__writeRow(row, [row], [])]
+            emergencies = [row for row in emergencies if self.__writeRow(row, [], [row])]
+
+        self.__invalidateWritten(journeys, emergencies)
+        self.__logger.debug("Stored batch of %d events and %d emergencies in DB",
+                            len(journeys), len(emergencies))
+
+    # write a single row of a failed batch. Returns False if the database rejected it
+    def __writeRow(self, row: tuple, journeys: list, emergencies: list) -> bool:
+        try:
+            with self.__metrics.timeQuery("flushBatch"):
+                self.__storage.insertEvents(journeys, emergencies)
+            return True
+        except self.__storage.Error as err:
+            self.__logger.error("Failed to insert %r into database with error: %s", row, err)
+            return False
 
     # store a new user in the database with the given credentials
     def storeUser(self, credentials: str) -> str:
         try:
-            cursor = self.__PGL_db_connection.cursor()
             val = tuple(credentials.split(';')[:-1])
             username = val[0]
 
             # if no duplicates, insert in table
-            if not self.__userExists(username):
-                cursor.reset()
-                query = f"INSERT INTO {self.__USERS_TABLE_NAME} (username, password, usertype) VALUES (%s, %s, %s)"
-                cursor.execute(query, val)
-                self.__PGL_db_connection.commit()
-                print("Stored user in DB")
-                cursor.close()
+            if self.__resolveUser(username, "storeUser") is None:
+                with self.__metrics.timeQuery("storeUser"):
+                    user_id = self.__storage.insertUser(*val[:3])
+                self.__index.addUser(user_id, username, val[2])
+                self.__notify("user", (user_id, username, val[2]))
+                self.__logger.debug("Stored user in DB")
+                # drop the cached results of attempts from before the user existed
+                if self.__credential_cache is not None:
+                    self.__credential_cache.invalidateUser(username)
                 return 'VALID', username
 
             # user already exists
             else:
-                cursor.reset()
-                cursor.close()
-                print("Duplicate user not stored")
+                self.__logger.debug("Duplicate user not stored")
                 return 'INVALID', username
 
-        except mysql.Error as err:
-            print(f'Failed to insert into database with error: {err}')
+        except self.__storage.Error as err:
+            self.__logger.error("Failed to insert into database with error: %s", err)
+            return 'INVALID', username
 
     # create a new product in the database with the given user and device
     # this method is invoked from public storeProduct method which handles user types
-    def __createProduct(self, user: str, device: str, cursor):
-        query = f"""INSERT INTO products (device_id, user_id) 
-                VALUES ('{device}', 
-                    (SELECT user_id FROM users WHERE username = '{user}'));"""
-
-        cursor.execute(query)
-        self.__PGL_db_connection.commit()
-        print(f'Created product for user: {user} and device_id: {device}')
-        cursor.close()
+    def __createProduct(self, user: str, user_id: int, device: str):
+        with self.__metrics.timeQuery("storeProduct"):
+            self.__storage.insertProduct(device, user_id)
+        self.__index.addProduct(device, user_id)
+        self.__notify("product", (device, user_id, user))
+        self.__logger.debug("Created product for user: %s and device_id: %s", user, device)
+
+        # the user's responses now have to include the new device
+        if self.__result_cache is not None:
+            self.__result_cache.invalidateUser(user)
 
     # store a new product in the database with the given payload
     def storeProduct(self, payload: str) -> str:
         try:
-            cursor = self.__PGL_db_connection.cursor()
             val = tuple(payload.split(';')[:-1])
             user = val[1]
             device_id = val[0]
 
             # get user type
-            query = f"SELECT usertype FROM users WHERE username = '{user}';"
-            cursor.execute(query)
-            usertype = cursor.fetchone()[0]
+            user_id, usertype = self.__resolveUser(user, "storeProduct") or (None, None)
+
+            # the device is already linked to the user
+            if usertype is not None and self.__index.owns(user_id, device_id):
+                self.__logger.debug("Product already exists for user: %s and device_id: %s", user, device_id)
+                return 'INVALID', user
 
             # if user is caregiver then create product
             if usertype == 'caregiver':
-                self.__createProduct(user, device_id, cursor)
+                self.__createProduct(user, user_id, device_id)
                 return 'VALID', user
 
             # if user is resident then check if a product exists
             elif usertype == 'resident':
-                query = f"""SELECT COUNT(device_id) FROM products 
-                                WHERE user_id = (SELECT user_id FROM users WHERE username = '{user}');"""
-                cursor.execute(query)
-                product_count = cursor.fetchone()[0]
-                if product_count == 0:
-                    self.__createProduct(user, device_id, cursor)
+                if not self.__index.userDevices(user_id):
+                    self.__createProduct(user, user_id, device_id)
                     return 'VALID', user
                 else:
-                    print(f'Product already exists for resident-user: {user}')
+                    self.__logger.debug("Product already exists for resident-user: %s", user)
                     return 'INVALID', user
-                
+
             # invalid usertype or user not found
             else:
                 return 'INVALID', user
 
-        except mysql.Error as err:
-            print(f'Failed to insert into database with error: {err}')
+        except self.__storage.Error as err:
+            self.__logger.error("Failed to insert into database with error: %s", err)
             return 'INVALID', user
 
 # endregion
 
     # convert data with row_headers_count to json
-    def __eventsToJson(self, data, row_headers_count) -> str:
+    # the default format is a list with an object per row. The columnar format is
+    # {"columns": [...], "rows": [[...], ...]} and is encoded straight from the cursor tuples
+    def __eventsToJson(self, data, row_headers_count, columnar: bool = False) -> str | bytes:
+        if columnar:
+            return self.__dumps({"columns": row_headers_count, "rows": data})
         events = []
         for row in data:
             events.append(dict(zip(row_headers_count, row)))
-        events_json = json.dumps(events)
+        events_json = self.__dumps(events)
         return events_json
 
+    # encode obj as json with orjson if it is installed (returns bytes), otherwise with json (returns str)
+    def __dumps(self, obj) -> str | bytes:
+        if orjson is not None:
+            return orjson.dumps(obj, default=self.__jsonDefault,
+                                option=orjson.OPT_PASSTHROUGH_DATETIME)
+        return json.dumps(obj, default=self.__jsonDefault)
+
+    # json encoding of values the encoder can't handle: timestamps are sent in the PI format
+    def __jsonDefault(self, value) -> str:
+        if isinstance(value, datetime):
+            return value.strftime(self.__DATETIME_FORMAT)
+        raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
 # region Get data from database
 
-    # get journeys from database corresponding to the given payload
-    def getJourneys(self, payload: str) -> str:
-        payload_in = tuple(payload.split(';')[:-1])  # get payload as tuple
+    # split a get_events/get_emergencies payload into username, device_id and options
+    # payload format: 'username;[device_id;][option=value;...]'
+    # supported options: 'page_size' (rows per chunk), 'after' (id of the last row already received)
+    # 'from'/'to' (inclusive time bounds), 'format' ('rows' (default) or 'columns')
+    # and 'archive' (1 to include the rows moved to the archive by the retention job)
+    def __parseEventsRequest(self, payload: str) -> tuple[str, str | None, dict]:
+        payload_in = payload.split(';')[:-1]         # get payload as list
         username = payload_in[0]                     # get username from payload
 
-        if len(payload_in) > 1:
-            # get device_id from payload if available
-            device_id = payload_in[1]
-        else:
-            device_id = 0
-
-        # return ALL data related to user. Returns empty list if no data
-        if device_id == 0:
-            cursor = self.__PGL_db_connection.cursor()
-            query = f"""SELECT * FROM {self.__JOURNEY_TABLE_NAME} 
-                                JOIN {self.__PRODUCT_TABLE_NAME} ON journey.device_id = products.device_id 
-                                    WHERE products.user_id = 
-                                        (SELECT user_id FROM {self.__USERS_TABLE_NAME} 
-                                            WHERE username = '{username}')"""
-            cursor.execute(query)
-            all_data = cursor.fetchall()    # fetch all data in format [(row1), (row2), ... row(row_headers)]
-            # this will extract row headers
-            row_headers = [x[0] for x in cursor.description]
-            return self.__eventsToJson(all_data, row_headers), username
-
-        # return data related to specific device and user. Returns empty list if no data
-        elif device_id != 0:
-            cursor = self.__PGL_db_connection.cursor()
-            query = f"""SELECT * FROM {self.__JOURNEY_TABLE_NAME} 
-                                JOIN {self.__PRODUCT_TABLE_NAME} ON journey.device_id = products.device_id 
-                                    WHERE products.user_id = 
-                                        (SELECT user_id FROM {self.__USERS_TABLE_NAME} WHERE username = '{username}') 
-                                            AND products.device_id = '{device_id}'"""
-            cursor.execute(query)
-            all_data = cursor.fetchall()
-            # this will extract row headers
+        device_id = None
+        options = {}
+        for field in payload_in[1:]:
+            if '=' in field:
+                key, value = field.split('=', 1)
+                options[key.strip()] = value.strip()
+            elif field != '':
+                # get device_id from payload if available
+                device_id = field
+
+        return username, device_id, options
+
+    # integer value of option key, default if the option is not given. Raises ValueError if it is not an integer
+    def __intOption(self, options: dict, key: str, default: int | None = None) -> int | None:
+        if key not in options:
+            return default
+        try:
+            return int(options[key])
+        except ValueError:
+            raise ValueError(f'Invalid {key}: {options[key]}') from None
+
+    # timestamp of option key, None if the option is not given. Raises ValueError if it is not a timestamp
+    def __datetimeOption(self, options: dict, key: str) -> datetime | None:
+        if key not in options:
+            return None
+        try:
+            return self.parseDatetime(options[key])
+        except ValueError:
+            raise ValueError(f'Invalid {key}: {options[key]}') from None
+
+    # stream the rows of cursor in chunks of page_size rows using fetchmany
+    # every chunk is a json object with the rows in 'data' (or 'columns' and 'rows' if columnar),
+    # the id of its last row in 'cursor' and 'end' set on the last chunk.
+    # At most two chunks are held in memory at a time
+    def __eventChunks(self, cursor, page_size: int, columnar: bool = False):
+        try:
             row_headers = [x[0] for x in cursor.description]
-            return self.__eventsToJson(all_data, row_headers), username
+
+            rows = cursor.fetchmany(page_size)
+            while True:
+                # read ahead so the end of the stream is known when the current chunk is sent
+                next_rows = cursor.fetchmany(page_size) if len(rows) == page_size else []
+                end = len(next_rows) == 0
+                if columnar:
+                    chunk = {"columns": row_headers, "rows": rows}
+                else:
+                    chunk = {"data": [dict(zip(row_headers, row))
+                                      for row in rows]}
+                chunk["cursor"] = rows[-1][0] if rows else None
+                chunk["end"] = end
+                yield self.__dumps(chunk)
+                if end:
+                    break
+                rows = next_rows
+        finally:
+            cursor.close()
+
+    # get events from table for the given payload
+    # returns the events as a single json document, or, if 'page_size' is given in the payload,
+    # a generator of json chunks (see __eventChunks)
+    # non-paginated results are served from the result cache if it is enabled
+    # method is the model method the query timings are recorded under
+    def __getEvents(self, method: str, table: str, id_column: str, payload: str):
+        username, device_id, options = self.__parseEventsRequest(payload)
+        # all options are checked before anything is read, so an invalid request raises ValueError right away
+        page_size = self.__intOption(options, 'page_size')
+        after = self.__intOption(options, 'after')
+        start = self.__datetimeOption(options, 'from')
+        end = self.__datetimeOption(options, 'to')
+        response_format = options.get('format', 'rows')
+        if response_format not in ('rows', 'columns'):
+            raise ValueError(f'Unknown response format: {response_format}')
+        columnar = response_format == 'columns'
+        include_archive = options.get('archive', '0') not in ('0', 'false')
+        if include_archive and self.__archive is None:
+            raise ValueError('The archive is not enabled')
+
+        cache_key = (table, username, device_id, after, start, end, response_format, include_archive)
+        if self.__result_cache is not None and page_size is None:
+            cached = self.__result_cache.get(cache_key)
+            if cached is not None:
+                return cached, username
+
+        user_id, device_ids, selected = self.__requestDevices(username, device_id, method)
+        if self.__result_cache is not None and page_size is None:
+            # devices are tracked before querying, so writes made during the query invalidate its result
+            generation = self.__result_cache.track(username, device_ids)
+
+        self.flushBatch(force=True)                  # make pending writes visible to the query
+
+        if page_size is not None:
+            page_size = max(1, page_size)
+            # pages are always ordered by id, so the cursor of a chunk can be passed as after
+            after = after if after is not None else 0
+            with self.__metrics.timeQuery(method):
+                cursor = self.__storage.selectEvents(
+                    table, id_column, user_id, selected, after, start, end)
+                if include_archive:
+                    cursor = self.__withArchive(cursor, table, user_id, selected, after, start, end)
+            return self.__eventChunks(cursor, page_size, columnar), username
+
+        # return ALL data related to user (and device if given) within the time bounds and after the given id
+        # Returns empty list if no data
+        with self.__metrics.timeQuery(method):
+            cursor = self.__storage.selectEvents(
+                table, id_column, user_id, selected, after, start, end)
+            if include_archive:
+                cursor = self.__withArchive(cursor, table, user_id, selected, after, start, end)
+            all_data = cursor.fetchall()    # fetch all data in format [(row1), (row2), ... row(row_headers)]
+        # this will extract row headers
+        row_headers = [x[0] for x in cursor.description]
+        cursor.close()
+        events_json = self.__eventsToJson(all_data, row_headers, columnar)
+
+        if self.__result_cache is not None:
+            self.__result_cache.put(cache_key, username, generation, events_json)
+        return events_json, username
+
+    # put the archived rows of device_ids in front of the rows of cursor
+    # the archived rows get the columns of the products row of their device, like the rows of selectEvents
+    # the rows of the devices are merged by id as they are read, so a page only reads the archive up to its last row
+    def __withArchive(self, cursor, table: str, user_id: int, device_ids: list[str],
+                      after: int | None, start: datetime | None, end: datetime | None):
+        archived = heapq.merge(*(self.__archivedRows(table, user_id, device_id, after, start, end)
+                                 for device_id in device_ids), key=lambda row: row[0])
+        return PGLEventManagerArchiveResult(cursor, archived, ordered=after is not None)
+
+    def __archivedRows(self, table: str, user_id: int, device_id: str,
+                       after: int | None, start: datetime | None, end: datetime | None):
+        for row in self.__archive.read(table, device_id, start, end, after):
+            yield row + (device_id, user_id)
+
+    # hit/miss/eviction counters of the result cache, and of the credential cache under 'credentials', as json
+    def getCacheStats(self) -> str:
+        if self.__result_cache is None:
+            stats = {"enabled": False}
+        else:
+            stats = {"enabled": True, **self.__result_cache.stats()}
+        if self.__credential_cache is None:
+            stats["credentials"] = {"enabled": False}
+        else:
+            stats["credentials"] = {"enabled": True, **self.__credential_cache.stats()}
+        return json.dumps(stats)
+
+    # get journeys from database corresponding to the given payload
+    def getJourneys(self, payload: str):
+        return self.__getEvents("getJourneys", self.__storage.JOURNEY_TABLE_NAME, "journey_id", payload)
 
     # get emergencies from database corresponding to the given payload
-    def getEmergencies(self, payload: str) -> str:
-        payload_in = tuple(payload.split(';')[:-1])  # get payload as tuple
-        # get username from payload
-        username = payload_in[0]
-
-        if len(payload_in) > 1:
-            # get device_id from payload if available
-            device_id = payload_in[1]
+    def getEmergencies(self, payload: str):
+        return self.__getEvents("getEmergencies", self.__storage.EMERGENCY_TABLE_NAME, "emergency_id", payload)
+
+    # get the hourly or daily stats of the user's devices from the rollups
+    # payload format: 'username;[device_id;][option=value;...]'
+    # supported options: 'period' ('hour' or 'day' (default)) and 'from'/'to' (inclusive bounds of the buckets)
+    # returns a json list with an object per device and bucket, the averages are null if no value was numeric
+    def getStats(self, payload: str):
+        username, device_id, options = self.__parseEventsRequest(payload)
+        period = options.get('period', 'day')
+        if period not in self.__storage.ROLLUP_PERIODS:
+            raise ValueError(f'Unknown stats period: {period}')
+        start = self.__datetimeOption(options, 'from')
+        end = self.__datetimeOption(options, 'to')
+
+        _, _, selected = self.__requestDevices(username, device_id, "getStats")
+        self.flushBatch(force=True)                  # make pending writes visible to the rollups
+        with self.__metrics.timeQuery("getStats"):
+            rows = self.__storage.selectRollups(selected, period, start, end)
+
+        stats = []
+        for device, bucket, journeys, rtt_count, rtt_sum, tt_count, tt_sum, emergencies in rows:
+            stats.append({"device_id": device,
+                          "bucket": bucket,
+                          "journeys": journeys,
+                          "rtt_avg": rtt_sum / rtt_count if rtt_count else None,
+                          "tt_avg": tt_sum / tt_count if tt_count else None,
+                          "emergencies": emergencies})
+        return self.__dumps(stats), username
+
+    # retention job: move the journeys and emergencies with a datetime before the given one from the database
+    # to the archive, a chunk at a time. Every chunk is synced to the archive files before it is deleted, so
+    # rows are never lost; a chunk that was archived but not deleted when the job stopped is archived again
+    # by the next run. Only the archived rows are deleted, by id, so a row with an old datetime that is stored
+    # while the job runs (e.g. by an import or the spool replay) is archived by a later chunk, not deleted with this
+    # one. The rollups are kept, so get_stats still covers the archived events.
+    # Can run next to the workers. Returns the number of archived rows per table
+    def archiveEvents(self, before: datetime) -> dict:
+        if self.__archive is None:
+            raise ValueError('The archive is not enabled')
+
+        self.flushBatch(force=True)
+        counts = {}
+        for table in (self.__storage.JOURNEY_TABLE_NAME, self.__storage.EMERGENCY_TABLE_NAME):
+            counts[table] = 0
+            while True:
+                with self.__metrics.timeQuery("archiveEvents"):
+                    rows = self.__storage.selectExpiredEvents(table, before, self.__ARCHIVE_CHUNK_SIZE)
+                if not rows:
+                    break
+                self.__archive.append(table, rows)
+                with self.__metrics.timeQuery("archiveEvents"):
+                    self.__storage.deleteEvents(table, [row[0] for row in rows])
+                for device_id in {row[-1] for row in rows}:
+                    self.__invalidateDevice(device_id)
+                    self.__notify("device", (device_id,))
+                counts[table] += len(rows)
+            self.__logger.info("Archived %d %s rows from before %s", counts[table], table, before)
+        return counts
+
+    # rebuild the rollups from all journeys and emergencies in the database and, if the archive is enabled, in the
+    # archive, e.g. after upgrading a database that has events from before the rollups were added. The rollups of
+    # archived events are rebuilt from the archive, so get_stats keeps covering them; without the archive they are
+    # lost. Events stored while the rollups are rebuilt are counted twice or not at all, so run it while nothing
+    # is being stored, and the rows of a retention run that stopped before deleting them are counted twice, so
+    # finish it first. Returns the number of journeys and emergencies that were rolled up
+    def backfillRollups(self) -> dict:
+        self.flushBatch(force=True)
+        totals = {}
+        counts = {}
+        with self.__metrics.timeQuery("backfillRollups"):
+            for table in (self.__storage.JOURNEY_TABLE_NAME, self.__storage.EMERGENCY_TABLE_NAME):
+                counts[table] = 0
+                cursor = self.__storage.scanEvents(table)
+                try:
+                    rows = cursor.fetchmany(self.__BACKFILL_CHUNK_SIZE)
+                    while rows:
+                        counts[table] += self.__addToRollups(totals, table, rows)
+                        rows = cursor.fetchmany(self.__BACKFILL_CHUNK_SIZE)
+                finally:
+                    cursor.close()
+
+                if self.__archive is not None:
+                    for device_id in self.__archive.devices(table):
+                        # archived rows start with their id, which is left out
+                        archived = (row[1:] for row in self.__archive.read(table, device_id))
+                        rows = list(islice(archived, self.__BACKFILL_CHUNK_SIZE))
+                        while rows:
+                            counts[table] += self.__addToRollups(totals, table, rows)
+                            rows = list(islice(archived, self.__BACKFILL_CHUNK_SIZE))
+            self.__storage.replaceRollups(self.__storage.rollupRows(totals))
+        return counts
+
+    # add rows of table in the layout of insertEvents to totals. Returns the number of rows
+    def __addToRollups(self, totals: dict, table: str, rows: list) -> int:
+        if table == self.__storage.JOURNEY_TABLE_NAME:
+            self.__storage.addToRollups(totals, rows, [])
         else:
-            device_id = 0
-
-        # return ALL emergencies related to user. Returns empty list if no data
-        if device_id == 0:
-            cursor = self.__PGL_db_connection.cursor()
-            query = f"""SELECT * FROM {self.__EMERGENCY_TABLE_NAME}
-                            JOIN {self.__PRODUCT_TABLE_NAME} ON emergency.device_id = products.device_id
-                                WHERE products.user_id =
-                                    (SELECT user_id FROM {self.__USERS_TABLE_NAME} 
-                                        WHERE username = '{username}')"""
-
-            cursor.execute(query)
-            all_data = cursor.fetchall()
-            # this will extract row headers
-            row_headers = [x[0] for x in cursor.description]
-            return self.__eventsToJson(all_data, row_headers), username
-
-        elif device_id != 0:
-            cursor = self.__PGL_db_connection.cursor()
-            query = f"""SELECT * FROM {self.__EMERGENCY_TABLE_NAME} 
-                            JOIN {self.__PRODUCT_TABLE_NAME} ON emergency.device_id = products.device_id 
-                                WHERE products.user_id = 
-                                    (SELECT user_id FROM {self.__USERS_TABLE_NAME} WHERE username = '{username}') 
-                                        AND products.device_id = '{device_id}'"""
-            cursor.execute(query)
-            all_data = cursor.fetchall()
-            # this will extract row headers
-            row_headers = [x[0] for x in cursor.description]
-            return self.__eventsToJson(all_data, row_headers), username
+            self.__storage.addToRollups(totals, [], rows)
+        return len(rows)
+
+    # bulk import: store journeys or emergencies, rows of (datetime, ..., device_id) in the column order of table,
+    # in transactions of __IMPORT_CHUNK_SIZE rows. Devices that don't exist yet are created once.
+    # rows can be any iterable, it is read a chunk at a time. Returns the number of stored rows
+    def importEvents(self, table: str, rows) -> int:
+        if table not in (self.__storage.JOURNEY_TABLE_NAME, self.__storage.EMERGENCY_TABLE_NAME):
+            raise ValueError(f'Unknown event table: {table}')
+        journeys = table == self.__storage.JOURNEY_TABLE_NAME
+
+        self.flushBatch(force=True)
+        count = 0
+        rows = iter(rows)
+        chunk = list(islice(rows, self.__IMPORT_CHUNK_SIZE))
+        while chunk:
+            device_ids = {row[-1] for row in chunk}
+            for device_id in device_ids:
+                self.__ensureDevice(device_id)
+            with self.__metrics.timeQuery("importEvents"):
+                if journeys:
+                    self.__storage.insertEvents(chunk, [])
+                else:
+                    self.__storage.insertEvents([], chunk)
+            for device_id in device_ids:
+                self.__invalidateDevice(device_id)
+                self.__notify("device", (device_id,))
+            count += len(chunk)
+            chunk = list(islice(rows, self.__IMPORT_CHUNK_SIZE))
+        return count
+
+    # write the journeys or emergencies of the user's devices, or of device_id (of the user if both are given),
+    # to out as json lines ordered by id: an object per row with the columns of table and the datetime in ISO 8601.
+    # Rows are read __EXPORT_CHUNK_SIZE at a time, so the history is never in memory as a whole.
+    # Returns the number of written rows
+    def exportEvents(self, table: str, out, username: str | None = None, device_id: str | None = None,
+                     start: datetime | None = None, end: datetime | None = None) -> int:
+        id_columns = {self.__storage.JOURNEY_TABLE_NAME: "journey_id",
+                      self.__storage.EMERGENCY_TABLE_NAME: "emergency_id"}
+        if table not in id_columns:
+            raise ValueError(f'Unknown event table: {table}')
+        if username is not None:
+            user_id, _, selected = self.__requestDevices(username, device_id, "exportEvents")
+            if user_id is None:
+                raise ValueError(f'Unknown user: {username}')
+        elif device_id is not None:
+            user_id, selected = None, [device_id]
+        else:
+            raise ValueError('A user or device is needed to export events')
+
+        self.flushBatch(force=True)
+        count = 0
+        # after=0 selects all rows, ordered by id
+        cursor = self.__storage.selectEvents(table, id_columns[table], user_id, selected, 0, start, end)
+        try:
+            # the rows end with the device_id and user_id of the products row, which are left out
+            columns = [column[0] for column in cursor.description][:-2]
+            rows = cursor.fetchmany(self.__EXPORT_CHUNK_SIZE)
+            while rows:
+                lines = []
+                for row in rows:
+                    record = dict(zip(columns, row))
+                    if isinstance(record["datetime"], datetime):
+                        record["datetime"] = record["datetime"].isoformat(" ")
+                    lines.append(json.dumps(record) + "\n")
+                out.writelines(lines)
+                count += len(rows)
+                rows = cursor.fetchmany(self.__EXPORT_CHUNK_SIZE)
+        finally:
+            cursor.close()
+        return count
 
     # validate user with given credentials
     def validateUser(self, credentials: str) -> str:
@@ -373,21 +938,23 @@ class PGLEventManagerModel:
             pass_ = payload_in[1]
             client_id = payload_in[2]
 
-            cursor = self.__PGL_db_connection.cursor()
-            query = f'SELECT COUNT(*) FROM {self.__USERS_TABLE_NAME} WHERE username = "{user}" AND password = "{pass_}"'
+            if self.__credential_cache is not None:
+                valid = self.__credential_cache.get(user, pass_)
+                if valid is not None:
+                    return ('VALID' if valid else 'INVALID'), user
+                generation = self.__credential_cache.track(user)
 
-            cursor.execute(query)
-            rows = cursor.fetchone()
-            count = rows[0]
-            cursor.reset()
-            cursor.close()
+            with self.__metrics.timeQuery("validateUser"):
+                count = self.__storage.countCredentials(user, pass_)
+            if self.__credential_cache is not None:
+                self.__credential_cache.put(user, pass_, generation, count > 0)
             if (count > 0):
                 return 'VALID', user
             else:
                 return 'INVALID', user
 
-        except mysql.Error as err:
-            Warning.warn("Failed to validate user")
+        except self.__storage.Error as err:
+            self.__logger.error("Failed to validate user with error: %s", err)
             return 'INVALID', user
 
 # endregion
@@ -0,0 +1,417 @@
+import logging
+import mysql.connector as mysql
+from mysql.connector import pooling
+from datetime import datetime
+from threading import local
+
+from PGLEventManagerStorage import PGLEventManagerStorage
+
+
+class PGLEventManagerMySQLStorage(PGLEventManagerStorage):
+    """Storage backend for a MySQL/MariaDB server.
+    Worker threads get their connections from a connection pool."""
+
+    Error = mysql.Error
+    RowError = (mysql.DataError, mysql.IntegrityError)
+
+    __logger = logging.getLogger("PGL.storage")
+
+    # table descriptions
+    __USERS_TABLE_DESCRIPTION: str = """users
+                                       (user_id int NOT NULL AUTO_INCREMENT,
+                                        username VARCHAR(320) UNIQUE NOT NULL,
+                                        password VARCHAR(255) NOT NULL,
+                                        usertype VARCHAR(30) NOT NULL,
+                                        PRIMARY KEY(user_id) )"""
+
+    __JOURNEY_TABLE_DESCRIPTION: str = """journey
+                                        (journey_id int NOT NULL AUTO_INCREMENT,
+                                        datetime DATETIME NOT NULL,
+                                        rtt VARCHAR(30) NOT NULL,
+                                        tt  VARCHAR(30),
+                                        device_id VARCHAR(255) NOT NULL,
+                                        PRIMARY KEY (journey_id),
+                                        INDEX device_datetime (device_id, datetime),
+                                        FOREIGN KEY (device_id) REFERENCES devices(device_id))"""
+
+    __EMERGENCY_TABLE_DESCRIPTION: str = """emergency
+                                        (emergency_id int NOT NULL AUTO_INCREMENT,
+                                        datetime DATETIME NOT NULL,
+                                        et VARCHAR(30) NOT NULL,
+                                        device_id VARCHAR(255) NOT NULL,
+                                        PRIMARY KEY (emergency_id),
+                                        INDEX device_datetime (device_id, datetime),
+                                        FOREIGN KEY (device_id) REFERENCES devices(device_id))"""
+
+    __PRODUCTS_TABLE_DESCRIPTION: str = """products (
+                                            device_id VARCHAR(255) NOT NULL,
+                                            user_id int NOT NULL,
+                                            PRIMARY KEY (device_id, user_id),
+                                            FOREIGN KEY (device_id) REFERENCES devices(device_id),
+                                            FOREIGN KEY (user_id) REFERENCES users(user_id))"""
+
+    __DEVICES_TABLE_DESCRIPTION: str = """devices
+                                          (device_id VARCHAR(255) NOT NULL,
+                                          PRIMARY KEY (device_id)) """
+
+    __ROLLUPS_TABLE_DESCRIPTION: str = """rollups
+                                          (device_id VARCHAR(255) NOT NULL,
+                                          period VARCHAR(8) NOT NULL,
+                                          bucket DATETIME NOT NULL,
+                                          journeys int NOT NULL,
+                                          rtt_count int NOT NULL,
+                                          rtt_sum DOUBLE NOT NULL,
+                                          tt_count int NOT NULL,
+                                          tt_sum DOUBLE NOT NULL,
+                                          emergencies int NOT NULL,
+                                          PRIMARY KEY (device_id, period, bucket),
+                                          FOREIGN KEY (device_id) REFERENCES devices(device_id))"""
+
+    # in order of creation, tables come after the tables their foreign keys reference
+    __TABLE_DESCRIPTIONS = [__USERS_TABLE_DESCRIPTION, __DEVICES_TABLE_DESCRIPTION, __JOURNEY_TABLE_DESCRIPTION,
+                            __EMERGENCY_TABLE_DESCRIPTION, __PRODUCTS_TABLE_DESCRIPTION, __ROLLUPS_TABLE_DESCRIPTION]
+
+    # statements, run as server side prepared statements (see __execute)
+    __SELECT_DEVICES = "SELECT device_id FROM devices"
+    __INSERT_DEVICE = "INSERT IGNORE INTO devices (device_id) VALUES (%s)"
+    __INSERT_JOURNEY = "INSERT INTO journey (datetime, rtt, tt, device_id) VALUES (%s, %s, %s, %s)"
+    __INSERT_EMERGENCY = "INSERT INTO emergency (datetime, et, device_id) VALUES (%s, %s, %s)"
+    __SELECT_USERS = "SELECT user_id, username, usertype FROM users"
+    __SELECT_PRODUCTS = "SELECT device_id, user_id FROM products"
+    __SELECT_USER = "SELECT user_id, usertype FROM users WHERE username = %s"
+    __SELECT_USER_DEVICES = "SELECT device_id FROM products WHERE user_id = %s"
+    __INSERT_USER = "INSERT INTO users (username, password, usertype) VALUES (%s, %s, %s)"
+    __INSERT_PRODUCT = "INSERT INTO products (device_id, user_id) VALUES (%s, %s)"
+    __COUNT_CREDENTIALS = "SELECT COUNT(*) FROM users WHERE username = %s AND password = %s"
+    __UPSERT_ROLLUP = """INSERT INTO rollups
+                            (device_id, period, bucket, journeys, rtt_count, rtt_sum, tt_count, tt_sum, emergencies)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            ON DUPLICATE KEY UPDATE
+                                journeys = journeys + VALUES(journeys),
+                                rtt_count = rtt_count + VALUES(rtt_count),
+                                rtt_sum = rtt_sum + VALUES(rtt_sum),
+                                tt_count = tt_count + VALUES(tt_count),
+                                tt_sum = tt_sum + VALUES(tt_sum),
+                                emergencies = emergencies + VALUES(emergencies)"""
+    __DELETE_ROLLUPS = "DELETE FROM rollups"
+    __SCAN_EVENTS = {"journey": "SELECT datetime, rtt, tt, device_id FROM journey",
+                     "emergency": "SELECT datetime, et, device_id FROM emergency"}
+    __SELECT_EXPIRED_EVENTS = {"journey": "SELECT * FROM journey WHERE datetime < %s ORDER BY journey_id LIMIT %s",
+                               "emergency": "SELECT * FROM emergency WHERE datetime < %s ORDER BY emergency_id LIMIT %s"}
+    __DELETE_EVENTS = {"journey": "DELETE FROM journey WHERE journey_id IN ({})",
+                       "emergency": "DELETE FROM emergency WHERE emergency_id IN ({})"}
+
+    def __init__(self, host, database: str, user: str, password: str) -> None:
+        super().__init__()
+        self.__host = host
+        self.__database_name = database
+        self.__user = user
+        self.__password = password
+        self.__PGL_db_connection = None
+
+        # pool of connections handed out to the controller's workers, one per worker thread
+        self.__PGL_db_pool = None
+
+        # prepared cursors of the calling thread's connection, by statement
+        self.__prepared = local()
+        # selectEvents and selectRollups statements, by variant
+        self.__event_statements = {}
+
+# region Connections
+    # raises the driver's error if the database can't be reached or set up, and if the pool can't be created,
+    # as worker threads must not share the main connection
+    def connect(self, pool_size: int = 1) -> None:
+        if pool_size > pooling.CNX_POOL_MAXSIZE:
+            raise ValueError(f'At most {pooling.CNX_POOL_MAXSIZE} pooled connections are supported, '
+                             f'{pool_size} were requested')
+
+        # establish database connection
+        self.__PGL_db_connection = mysql.connect(host=self.__host,
+                                                 user=self.__user,
+                                                 password=self.__password)
+        try:
+            self.__PGL_db_connection.cursor().execute(
+                f"USE {self.__database_name}")
+        except mysql.Error as err:
+            # If the database doesn't exist, then create it.
+            if err.errno != mysql.errorcode.ER_BAD_DB_ERROR:
+                raise
+            self.__logger.info("Database does not exist. Will be created.")
+            self.__createDatabase()
+            self.__logger.info("Database %s created successfully.", self.__database_name)
+        self.__logger.info("Connected to database succesfully")
+
+        self.__migrateDatetimeColumns()
+        # databases created before the rollups were added
+        self.__PGL_db_connection.cursor().execute(
+            f"CREATE TABLE IF NOT EXISTS {self.__ROLLUPS_TABLE_DESCRIPTION}")
+
+        self.__PGL_db_pool = pooling.MySQLConnectionPool(pool_name="PGL",
+                                                         pool_size=pool_size,
+                                                         host=self.__host,
+                                                         user=self.__user,
+                                                         password=self.__password,
+                                                         database=self.__database_name)
+
+    # disconnect from the database
+    def disconnect(self) -> None:
+        self.__PGL_db_connection.disconnect()
+
+    def mainConnection(self):
+        return self.__PGL_db_connection
+
+    # take a connection from the pool
+    def openConnection(self):
+        if self.__PGL_db_pool is None:
+            raise mysql.errors.PoolError("Not connected, there is no connection pool")
+        return self.__PGL_db_pool.get_connection()
+
+    # creates database with parameters from __init__ and switches the main connection to it
+    def __createDatabase(self) -> None:
+        cursor = self.__PGL_db_connection.cursor()
+        try:
+            cursor.execute(
+                f"CREATE DATABASE {self.__database_name} DEFAULT CHARACTER SET 'utf8'")
+
+            # move cursor to work in this database
+            cursor.execute(f'USE {self.__database_name}')
+
+            # create tables
+            for table in self.__TABLE_DESCRIPTIONS:
+                cursor.execute(f"CREATE TABLE {table}")
+        finally:
+            cursor.close()
+
+    # migrate the datetime columns of journey and emergency from VARCHAR to DATETIME
+    # and add the (device_id, datetime) indexes. Does nothing for tables that are already migrated
+    def __migrateDatetimeColumns(self) -> None:
+        cursor = self.__PGL_db_connection.cursor()
+        for table in [self.JOURNEY_TABLE_NAME, self.EMERGENCY_TABLE_NAME]:
+            cursor.execute("""SELECT DATA_TYPE FROM information_schema.COLUMNS
+                                WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = 'datetime'""",
+                           (self.__database_name, table))
+            row = cursor.fetchone()
+            if row is None or row[0].lower() != 'varchar':
+                continue
+
+            self.__logger.info("Migrating %s.datetime to DATETIME", table)
+            # PI timestamps are converted explicitly, ISO formatted timestamps are converted by MODIFY
+            cursor.execute(f"""UPDATE {table}
+                                SET datetime = DATE_FORMAT(STR_TO_DATE(datetime, '%m/%d/%Y, %H:%i:%s'), '%Y-%m-%d %H:%i:%s')
+                                    WHERE datetime LIKE '__/__/____, %'""")
+            cursor.execute(f"""ALTER TABLE {table}
+                                MODIFY datetime DATETIME NOT NULL,
+                                ADD INDEX device_datetime (device_id, datetime)""")
+            self.__PGL_db_connection.commit()
+        cursor.close()
+# endregion
+
+# region Queries
+    # run statement on the prepared cursor for it on the calling thread's connection
+    # cursors are created on first use and kept, so every statement is parsed by the server once per
+    # connection. Statements have to be the same string objects each time (the constants above),
+    # as the cursor only prepares again when it gets a different object
+    def __execute(self, statement: str, params: tuple = ()):
+        connection = self.connection()
+        if getattr(self.__prepared, 'connection', None) is not connection:
+            self.__prepared.connection = connection
+            self.__prepared.cursors = {}
+
+        cursor = self.__prepared.cursors.get(statement)
+        if cursor is None:
+            cursor = connection.cursor(prepared=True)
+            self.__prepared.cursors[statement] = cursor
+        cursor.execute(statement, params)
+        return cursor
+
+    # close the prepared cursors of the calling thread before its connection is closed
+    def closeConnection(self, connection) -> None:
+        if getattr(self.__prepared, 'connection', None) is connection:
+            for cursor in self.__prepared.cursors.values():
+                cursor.close()
+            self.__prepared.connection = None
+            self.__prepared.cursors = {}
+        connection.close()
+
+    def loadDevices(self) -> set[str]:
+        return {row[0] for row in self.__execute(self.__SELECT_DEVICES).fetchall()}
+
+    # INSERT IGNORE makes this idempotent, so concurrent creators of the same device do not race
+    def insertDevice(self, device_id: str) -> None:
+        self.__execute(self.__INSERT_DEVICE, (device_id,))
+        self.connection().commit()
+
+    # single rows use the prepared statements. Batches use a plain cursor, whose executemany
+    # sends all rows in one multi-row INSERT instead of executing the prepared statement per row
+    def insertEvents(self, journeys: list[tuple], emergencies: list[tuple]) -> None:
+        rollups = self.rollupRows(self.addToRollups({}, journeys, emergencies))
+        try:
+            if len(journeys) + len(emergencies) == 1:
+                if journeys:
+                    self.__execute(self.__INSERT_JOURNEY, journeys[0])
+                else:
+                    self.__execute(self.__INSERT_EMERGENCY, emergencies[0])
+                for rollup in rollups:
+                    self.__execute(self.__UPSERT_ROLLUP, rollup)
+            else:
+                cursor = self.connection().cursor()
+                if journeys:
+                    cursor.executemany(self.__INSERT_JOURNEY, journeys)
+                if emergencies:
+                    cursor.executemany(self.__INSERT_EMERGENCY, emergencies)
+                if rollups:
+                    cursor.executemany(self.__UPSERT_ROLLUP, rollups)
+                cursor.close()
+            self.connection().commit()
+
+        except mysql.Error:
+            self.connection().rollback()
+            raise
+
+    def loadUsers(self) -> list[tuple]:
+        return self.__execute(self.__SELECT_USERS).fetchall()
+
+    def loadProducts(self) -> list[tuple]:
+        return self.__execute(self.__SELECT_PRODUCTS).fetchall()
+
+    def selectUser(self, username: str) -> tuple | None:
+        rows = self.__execute(self.__SELECT_USER, (username,)).fetchall()
+        return tuple(rows[0]) if rows else None
+
+    def selectUserDevices(self, user_id: int) -> list[str]:
+        return [row[0] for row in self.__execute(self.__SELECT_USER_DEVICES, (user_id,)).fetchall()]
+
+    def insertUser(self, username: str, password: str, usertype: str) -> int:
+        user_id = self.__execute(self.__INSERT_USER, (username, password, usertype)).lastrowid
+        self.connection().commit()
+        return user_id
+
+    def insertProduct(self, device_id: str, user_id: int) -> None:
+        self.__execute(self.__INSERT_PRODUCT, (device_id, user_id))
+        self.connection().commit()
+
+    # a lookup of every device in the device_datetime index
+    # the query text only depends on the number of devices and which filters are set. Every variant is
+    # built once and kept, so it is run on the same prepared cursor each time.
+    # Rows are only transferred from the server when they are fetched
+    def selectEvents(self, table: str, id_column: str, user_id: int, device_ids: list[str],
+                     after: int | None, start: datetime | None, end: datetime | None):
+        # a user without devices matches no rows
+        device_ids = device_ids or [None]
+        variant = (table, id_column, len(device_ids),
+                   start is not None, end is not None, after is not None)
+        query = self.__event_statements.get(variant)
+        if query is None:
+            query = self.__eventsQuery(*variant)
+            query = self.__event_statements.setdefault(variant, query)
+
+        params = [user_id, *device_ids]
+        for value in (start, end, after):
+            if value is not None:
+                params.append(value)
+
+        return PGLPreparedResult(self.__execute(query, tuple(params)))
+
+    # build the select statement for a variant of selectEvents
+    def __eventsQuery(self, table: str, id_column: str, device_count: int, has_start: bool,
+                      has_end: bool, has_after: bool) -> str:
+        query = f"""SELECT {table}.*, {table}.device_id, %s AS user_id FROM {table}
+                        WHERE {table}.device_id IN ({", ".join(["%s"] * device_count)})"""
+        if has_start:
+            query += f" AND {table}.datetime >= %s"
+        if has_end:
+            query += f" AND {table}.datetime <= %s"
+        if has_after:
+            query += f" AND {table}.{id_column} > %s ORDER BY {table}.{id_column}"
+        return query
+
+    def countCredentials(self, username: str, password: str) -> int:
+        return self.__execute(self.__COUNT_CREDENTIALS, (username, password)).fetchall()[0][0]
+
+    def scanEvents(self, table: str):
+        return PGLPreparedResult(self.__execute(self.__SCAN_EVENTS[table]))
+
+    # the primary key (device_id, period, bucket) makes this a range scan per device
+    # variants are kept like the selectEvents statements
+    def selectRollups(self, device_ids: list[str], period: str,
+                      start: datetime | None, end: datetime | None) -> list[tuple]:
+        device_ids = device_ids or [None]
+        variant = (self.ROLLUPS_TABLE_NAME, len(device_ids), start is not None, end is not None)
+        query = self.__event_statements.get(variant)
+        if query is None:
+            query = self.__event_statements.setdefault(variant, self.__rollupsQuery(*variant[1:]))
+
+        params = [*device_ids, period]
+        for value in (start, end):
+            if value is not None:
+                params.append(value)
+
+        return self.__execute(query, tuple(params)).fetchall()
+
+    # build the select statement for a variant of selectRollups
+    def __rollupsQuery(self, device_count: int, has_start: bool, has_end: bool) -> str:
+        query = f"""SELECT device_id, bucket, journeys, rtt_count, rtt_sum, tt_count, tt_sum, emergencies
+                        FROM {self.ROLLUPS_TABLE_NAME}
+                            WHERE device_id IN ({", ".join(["%s"] * device_count)}) AND period = %s"""
+        if has_start:
+            query += " AND bucket >= %s"
+        if has_end:
+            query += " AND bucket <= %s"
+        return query + " ORDER BY device_id, bucket"
+
+    def selectExpiredEvents(self, table: str, before: datetime, limit: int) -> list[tuple]:
+        return self.__execute(self.__SELECT_EXPIRED_EVENTS[table], (before, limit)).fetchall()
+
+    # a single statement with all ids. Its text depends on the number of ids, so it runs on a plain cursor
+    def deleteEvents(self, table: str, ids: list[int]) -> int:
+        if not ids:
+            return 0
+        try:
+            cursor = self.connection().cursor()
+            cursor.execute(self.__DELETE_EVENTS[table].format(", ".join(["%s"] * len(ids))), ids)
+            deleted = cursor.rowcount
+            cursor.close()
+            self.connection().commit()
+            return deleted
+
+        except mysql.Error:
+            self.connection().rollback()
+            raise
+
+    def replaceRollups(self, rows: list[tuple]) -> None:
+        try:
+            cursor = self.connection().cursor()
+            cursor.execute(self.__DELETE_ROLLUPS)
+            if rows:
+                cursor.executemany(self.__UPSERT_ROLLUP, rows)
+            cursor.close()
+            self.connection().commit()
+
+        except mysql.Error:
+            self.connection().rollback()
+            raise
+# endregion
+
+
+class PGLPreparedResult:
+    """Result of selectEvents, read from a cached prepared cursor.
+    Closing it reads the remaining rows instead of closing the cursor, so the prepared statement stays usable.
+    The rows are read and dropped a chunk at a time, so closing a stream that was abandoned early does not load
+    the rest of the result into memory."""
+
+    # rows read at a time when the remaining rows are dropped
+    __DRAIN_SIZE = 1000
+
+    def __init__(self, cursor) -> None:
+        self.__cursor = cursor
+        self.description = cursor.description
+
+    def fetchmany(self, size: int = 1) -> list:
+        return self.__cursor.fetchmany(size)
+
+    def fetchall(self) -> list:
+        return self.__cursor.fetchall()
+
+    def close(self) -> None:
+        while self.__cursor.fetchmany(self.__DRAIN_SIZE):
+            pass
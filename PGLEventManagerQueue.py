@@ -0,0 +1,195 @@
+from collections import deque
+from itertools import count
+from queue import Empty
+from threading import Condition, Lock
+from time import monotonic
+
+
+class PGLEventManagerQueue:
+    """Bounded worker queue with priority lanes and a policy for when it is full.
+    Items are (time of arrival, message) tuples and are put in a lane. The urgent lane, if there is one, is served
+    whenever it has items. get serves the other lanes by weighted round robin: every lane has a credit of weight
+    items per round, the highest priority lane that has items and credit left is served first, and a new round
+    starts when no lane with items has credit left. Under load every lane gets its weighted share, and a lane is
+    served ahead of the weights as soon as its oldest item has waited max_wait seconds.
+
+    When the queue holds maxsize items (0 is unbounded), the overload policy decides what happens to a new item:
+    'block' makes offer wait until there is room, which blocks the MQTT network thread and so pushes back on the broker.
+    'drop_oldest' drops the oldest droppable item (telemetry) to make room. If none is queued, an incoming
+    droppable item is dropped instead, and any other item waits for room like with 'block'.
+    'reject' refuses the incoming item.
+
+    Like queue.Queue, every item that was put in the queue has to be marked done with taskDone once it is
+    handled, so join can wait until the items are handled and not just taken from the queue."""
+
+    POLICIES = ("block", "drop_oldest", "reject")
+
+    # lanes is a dict of lane name to weight, in order of priority
+    # droppable is called with an item and returns True if the drop_oldest policy may drop it
+    # urgent is the name of a lane that is not in lanes and goes before all of them
+    def __init__(self, lanes: dict[str, int], maxsize: int = 0, policy: str = "block", droppable=None,
+                 max_wait: float = 1.0, urgent: str | None = None) -> None:
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown overload policy: {policy}')
+        if any(weight <= 0 for weight in lanes.values()):
+            raise ValueError(f'Lane weights must be positive: {lanes}')
+        if urgent is not None and urgent in lanes:
+            raise ValueError(f'The urgent lane has no weight: {urgent}')
+        self.__weights = dict(lanes)
+        self.__urgent = urgent
+        # every lane keeps its droppable items apart from the others, so drop_oldest finds the oldest droppable
+        # item without a scan. Entries are (sequence number, item), the sequence numbers keep a lane in order
+        self.__lanes = {lane: (deque(), deque()) for lane in ([urgent] if urgent is not None else []) + list(lanes)}
+        self.__sequence = count()
+        self.__credits = dict(self.__weights)
+        self.__maxsize = maxsize
+        self.__policy = policy
+        self.__droppable = droppable if droppable is not None else (lambda item: False)
+        self.__max_wait = max_wait
+        self.__size = 0
+        self.__unfinished = 0       # items put in the queue and not yet marked done
+        self.__closed = False
+
+        lock = Lock()
+        self.__not_empty = Condition(lock)
+        self.__not_full = Condition(lock)
+        self.__all_done = Condition(lock)
+
+    def empty(self) -> bool:
+        with self.__not_empty:
+            return self.__size == 0
+
+    # put item in lane, applying the overload policy if the queue is full
+    # returns the item that was dropped or rejected instead of being handled, or None
+    def offer(self, item, lane: str):
+        with self.__not_full:
+            dropped = None
+            if self.__full():
+                match self.__policy:
+                    case "reject":
+                        return item
+                    case "drop_oldest":
+                        dropped = self.__dropOldest()
+                        if dropped is None and self.__droppable(item):
+                            return item
+
+            # block until there is room
+            while self.__full():
+                self.__not_full.wait()
+
+            kept, droppable = self.__lanes[lane]
+            (droppable if self.__droppable(item) else kept).append((next(self.__sequence), item))
+            self.__size += 1
+            self.__unfinished += 1
+            self.__not_empty.notify()
+            return dropped
+
+    # remove and return the next item as (lane, item)
+    # raises queue.Empty if no item arrives within timeout seconds, or right away if the queue is closed and empty
+    def get(self, timeout: float | None = None) -> tuple[str, tuple]:
+        with self.__not_empty:
+            self.__not_empty.wait_for(lambda: self.__size > 0 or self.__closed, timeout)
+            if self.__size == 0:
+                raise Empty
+
+            lane = self.__nextLane()
+            _, item = self.__head(lane).popleft()
+            self.__size -= 1
+            self.__not_full.notify()
+            return lane, item
+
+    # mark an item returned by get as handled
+    def taskDone(self) -> None:
+        with self.__all_done:
+            self.__done(1)
+
+    # wait until every item put in the queue is handled. Returns False on timeout
+    def join(self, timeout: float | None = None) -> bool:
+        with self.__all_done:
+            return self.__all_done.wait_for(lambda: self.__unfinished == 0, timeout)
+
+    # wake up the threads waiting in get, which no longer wait for items
+    def close(self) -> None:
+        with self.__not_empty:
+            self.__closed = True
+            self.__not_empty.notify_all()
+
+    # remove the items that are still queued and return how many there were
+    def clear(self) -> int:
+        with self.__not_full:
+            cleared = self.__size
+            for kept, droppable in self.__lanes.values():
+                kept.clear()
+                droppable.clear()
+            self.__size = 0
+            self.__done(cleared)
+            self.__not_full.notify_all()
+            return cleared
+
+    # depth and age in seconds of the oldest item, of the queue and of every lane
+    def stats(self) -> dict:
+        now = monotonic()
+        with self.__not_empty:
+            lanes = {}
+            for lane, (kept, droppable) in self.__lanes.items():
+                head = self.__head(lane)
+                lanes[lane] = {"depth": len(kept) + len(droppable),
+                               "oldest_age": now - head[0][1][0] if head is not None else 0.0}
+        return {"depth": sum(lane["depth"] for lane in lanes.values()),
+                "oldest_age": max(lane["oldest_age"] for lane in lanes.values()),
+                "lanes": lanes}
+
+    # must be called with the lock held
+    def __done(self, count: int) -> None:
+        self.__unfinished -= count
+        if self.__unfinished == 0:
+            self.__all_done.notify_all()
+
+    # must be called with the lock held
+    def __full(self) -> bool:
+        return 0 < self.__maxsize <= self.__size
+
+    # lane to serve next, see the class docstring. Must be called with the lock held and an item queued
+    def __nextLane(self) -> str:
+        if self.__urgent is not None and self.__head(self.__urgent) is not None:
+            return self.__urgent
+        now = monotonic()
+        heads = {lane: self.__head(lane) for lane in self.__weights}
+
+        # starvation protection: the weighted lane whose oldest item is the most overdue goes first
+        overdue = [(head[0][1][0], lane) for lane, head in heads.items()
+                   if head is not None and now - head[0][1][0] >= self.__max_wait]
+        if overdue:
+            return min(overdue)[1]
+
+        for _ in range(2):
+            for lane, head in heads.items():
+                if head is not None and self.__credits[lane] > 0:
+                    self.__credits[lane] -= 1
+                    return lane
+            # every lane with items has used its credit, start a new round
+            self.__credits = dict(self.__weights)
+
+    # the deque of lane that holds its next item, None if the lane is empty. Must be called with the lock held
+    def __head(self, lane: str) -> deque | None:
+        kept, droppable = self.__lanes[lane]
+        if not droppable:
+            return kept if kept else None
+        if not kept or droppable[0][0] < kept[0][0]:
+            return droppable
+        return kept
+
+    # remove and return the oldest droppable item, None if no queued item is droppable
+    # only the first droppable item of every lane is looked at. Must be called with the lock held
+    def __dropOldest(self):
+        oldest = None
+        for _, droppable in self.__lanes.values():
+            if droppable and (oldest is None or droppable[0][1][0] < oldest[0][1][0]):
+                oldest = droppable
+
+        if oldest is None:
+            return None
+        _, item = oldest.popleft()
+        self.__size -= 1
+        self.__done(1)
+        return item
@@ -0,0 +1,76 @@
+"""Retention job: moves journeys and emergencies older than a number of days from the database to the archive,
+compressed files per device and month that get_events/get_emergencies can still read with the archive=1 option.
+Keeping only recent events in the database keeps the journey and emergency tables (and their indexes) small.
+It can run while the event manager is running, e.g. daily from cron:
+
+    python PGLEventManagerRetention.py --days 90 --archive archive --backend mysql --database PGL
+
+The running managers cache responses, so the job publishes the devices whose events it archived on PGL/sync
+of the broker at --mqtt-host, and the managers drop their cached responses of those devices. With --no-notify,
+or if the broker can't be reached, restart the managers after the job so they don't serve stale responses."""
+
+import argparse
+import json
+from datetime import datetime, timedelta
+
+from paho.mqtt.client import Client as MqttClient
+
+from PGLEventManagerLogging import setupLogging
+from PGLEventManagerModel import PGLEventManagerModel
+from PGLEventManagerStorage import addStorageArguments, storageArguments
+
+# topic the managers apply the changes of other managers from, see PGLEventManagerController
+SYNC_TOPIC = "PGL/sync"
+
+
+# publish the devices whose events were archived on SYNC_TOPIC. Returns False if the broker can't be reached
+def notifyManagers(host: str, port: int, device_ids: list[str], timeout: float = 10) -> bool:
+    client = MqttClient(protocol=5)
+    try:
+        client.connect(host, port)
+    except OSError:
+        return False
+    client.loop_start()
+    try:
+        info = client.publish(SYNC_TOPIC, json.dumps([["device", [device_id]] for device_id in device_ids]), qos=1)
+        info.wait_for_publish(timeout)
+        return info.is_published()
+    except (RuntimeError, ValueError):
+        return False
+    finally:
+        client.disconnect()
+        client.loop_stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old events of PGLEventManager")
+    parser.add_argument("--days", type=float, required=True, help="age in days of the events to archive")
+    parser.add_argument("--archive", default="archive", help="archive directory")
+    addStorageArguments(parser)
+    parser.add_argument("--mqtt-host", default="test.mosquitto.org", help="broker of the managers")
+    parser.add_argument("--mqtt-port", type=int, default=1883)
+    parser.add_argument("--no-notify", action="store_true",
+                        help="don't tell the running managers which devices were archived")
+    args = parser.parse_args()
+
+    log_listener = setupLogging()
+    model = PGLEventManagerModel(**storageArguments(args), archive_path=args.archive)
+    archived_devices = {}
+    model.setChangeListener(lambda kind, fields: archived_devices.setdefault(fields[0]))
+    model.connectDB()
+    try:
+        counts = model.archiveEvents(datetime.now() - timedelta(days=args.days))
+    finally:
+        model.disconnectDB()
+        log_listener.stop()
+
+    print(f"Archived {counts['journey']} journeys and {counts['emergency']} emergencies")
+    if archived_devices and not args.no_notify:
+        if notifyManagers(args.mqtt_host, args.mqtt_port, list(archived_devices)):
+            print(f"Notified the managers of {len(archived_devices)} devices")
+        else:
+            print(f"Could not reach {args.mqtt_host}, restart the managers to drop their cached responses")
+
+
+if __name__ == "__main__":
+    main()
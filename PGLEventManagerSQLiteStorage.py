@@ -0,0 +1,267 @@
+import logging
+import sqlite3
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from threading import Lock
+
+from PGLEventManagerStorage import PGLEventManagerStorage
+
+# timestamps are stored as ISO 8601 text, which sorts chronologically, and are read back as datetime
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter(
+    "DATETIME", lambda value: datetime.fromisoformat(value.decode()))
+
+
+class PGLEventManagerSQLiteStorage(PGLEventManagerStorage):
+    """Embedded storage backend that keeps the database in a local SQLite file.
+    Tuned for ingest throughput: the WAL journal lets readers run next to the writer,
+    synchronous=NORMAL only syncs at checkpoints instead of at every commit, and all statements
+    are constant strings, so each is prepared once per connection and reused from sqlite3's statement cache.
+    Every worker thread gets its own connection, except for in-memory databases ':memory:', where all
+    threads share the main connection and take turns using it."""
+
+    Error = sqlite3.Error
+    RowError = (sqlite3.DataError, sqlite3.IntegrityError)
+
+    __logger = logging.getLogger("PGL.storage")
+
+    __STATEMENT_CACHE_SIZE = 256
+    __BUSY_TIMEOUT = 30
+
+    # table descriptions
+    __TABLE_DESCRIPTIONS = ["""users
+                                (user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                username TEXT UNIQUE NOT NULL,
+                                password TEXT NOT NULL,
+                                usertype TEXT NOT NULL)""",
+                            """devices
+                                (device_id TEXT PRIMARY KEY NOT NULL)""",
+                            """journey
+                                (journey_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                datetime DATETIME NOT NULL,
+                                rtt TEXT NOT NULL,
+                                tt TEXT,
+                                device_id TEXT NOT NULL REFERENCES devices(device_id))""",
+                            """emergency
+                                (emergency_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                datetime DATETIME NOT NULL,
+                                et TEXT NOT NULL,
+                                device_id TEXT NOT NULL REFERENCES devices(device_id))""",
+                            """products
+                                (device_id TEXT NOT NULL REFERENCES devices(device_id),
+                                user_id INTEGER NOT NULL REFERENCES users(user_id),
+                                PRIMARY KEY (device_id, user_id))""",
+                            """rollups
+                                (device_id TEXT NOT NULL REFERENCES devices(device_id),
+                                period TEXT NOT NULL,
+                                bucket DATETIME NOT NULL,
+                                journeys INTEGER NOT NULL,
+                                rtt_count INTEGER NOT NULL,
+                                rtt_sum REAL NOT NULL,
+                                tt_count INTEGER NOT NULL,
+                                tt_sum REAL NOT NULL,
+                                emergencies INTEGER NOT NULL,
+                                PRIMARY KEY (device_id, period, bucket))"""]
+
+    __INDEX_DESCRIPTIONS = ["journey_device_datetime ON journey (device_id, datetime)",
+                            "emergency_device_datetime ON emergency (device_id, datetime)"]
+
+    # statements
+    __SELECT_DEVICES = "SELECT device_id FROM devices"
+    __INSERT_DEVICE = "INSERT OR IGNORE INTO devices (device_id) VALUES (?)"
+    __INSERT_JOURNEY = "INSERT INTO journey (datetime, rtt, tt, device_id) VALUES (?, ?, ?, ?)"
+    __INSERT_EMERGENCY = "INSERT INTO emergency (datetime, et, device_id) VALUES (?, ?, ?)"
+    __SELECT_USERS = "SELECT user_id, username, usertype FROM users"
+    __SELECT_PRODUCTS = "SELECT device_id, user_id FROM products"
+    __SELECT_USER = "SELECT user_id, usertype FROM users WHERE username = ?"
+    __SELECT_USER_DEVICES = "SELECT device_id FROM products WHERE user_id = ?"
+    __INSERT_USER = "INSERT INTO users (username, password, usertype) VALUES (?, ?, ?)"
+    __INSERT_PRODUCT = "INSERT INTO products (device_id, user_id) VALUES (?, ?)"
+    __COUNT_CREDENTIALS = "SELECT COUNT(*) FROM users WHERE username = ? AND password = ?"
+    __UPSERT_ROLLUP = """INSERT INTO rollups
+                            (device_id, period, bucket, journeys, rtt_count, rtt_sum, tt_count, tt_sum, emergencies)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (device_id, period, bucket) DO UPDATE SET
+                                journeys = journeys + excluded.journeys,
+                                rtt_count = rtt_count + excluded.rtt_count,
+                                rtt_sum = rtt_sum + excluded.rtt_sum,
+                                tt_count = tt_count + excluded.tt_count,
+                                tt_sum = tt_sum + excluded.tt_sum,
+                                emergencies = emergencies + excluded.emergencies"""
+    __DELETE_ROLLUPS = "DELETE FROM rollups"
+    __SCAN_EVENTS = {"journey": "SELECT datetime, rtt, tt, device_id FROM journey",
+                     "emergency": "SELECT datetime, et, device_id FROM emergency"}
+    __SELECT_EXPIRED_EVENTS = {"journey": "SELECT * FROM journey WHERE datetime < ? ORDER BY journey_id LIMIT ?",
+                               "emergency": "SELECT * FROM emergency WHERE datetime < ? ORDER BY emergency_id LIMIT ?"}
+    __DELETE_EVENT = {"journey": "DELETE FROM journey WHERE journey_id = ?",
+                      "emergency": "DELETE FROM emergency WHERE emergency_id = ?"}
+
+    # path is the database file, created if it doesn't exist
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.__path = path
+        self.__main_connection = None
+        # all threads share the main connection of an in-memory database, so its statements and transactions
+        # are run one at a time. Other databases give every worker a connection of its own and need no lock.
+        # The cursors of selectEvents and scanEvents are read outside the lock, which SQLite's own locking of the
+        # connection makes safe
+        self.__lock = Lock() if path == ":memory:" else nullcontext()
+
+# region Connections
+    def connect(self, pool_size: int = 1) -> None:
+        self.__main_connection = self.__open()
+
+        # create tables and indexes
+        for table in self.__TABLE_DESCRIPTIONS:
+            self.__main_connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table}")
+        for index in self.__INDEX_DESCRIPTIONS:
+            self.__main_connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {index}")
+        self.__main_connection.commit()
+        self.__logger.info("Connected to database succesfully")
+
+    def disconnect(self) -> None:
+        self.__main_connection.close()
+
+    def mainConnection(self):
+        return self.__main_connection
+
+    # every worker opens its own connection to the file
+    def openConnection(self):
+        if self.__path == ":memory:":
+            return None
+        return self.__open()
+
+    # transaction on the calling thread's connection, committed on success and rolled back if a statement fails
+    @contextmanager
+    def __transaction(self):
+        connection = self.connection()
+        with self.__lock, connection:
+            yield connection
+
+    # open a connection with the throughput settings
+    def __open(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.__path,
+                                     timeout=self.__BUSY_TIMEOUT,
+                                     detect_types=sqlite3.PARSE_DECLTYPES,
+                                     cached_statements=self.__STATEMENT_CACHE_SIZE,
+                                     check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        return connection
+# endregion
+
+# region Queries
+    def loadDevices(self) -> set[str]:
+        with self.__lock:
+            return {row[0] for row in self.connection().execute(self.__SELECT_DEVICES)}
+
+    def insertDevice(self, device_id: str) -> None:
+        with self.__transaction() as connection:
+            connection.execute(self.__INSERT_DEVICE, (device_id,))
+
+    def insertEvents(self, journeys: list[tuple], emergencies: list[tuple]) -> None:
+        # commits on success and rolls back if an insert fails
+        with self.__transaction() as connection:
+            if journeys:
+                connection.executemany(self.__INSERT_JOURNEY, journeys)
+            if emergencies:
+                connection.executemany(self.__INSERT_EMERGENCY, emergencies)
+            connection.executemany(self.__UPSERT_ROLLUP,
+                                   self.rollupRows(self.addToRollups({}, journeys, emergencies)))
+
+    def loadUsers(self) -> list[tuple]:
+        with self.__lock:
+            return self.connection().execute(self.__SELECT_USERS).fetchall()
+
+    def loadProducts(self) -> list[tuple]:
+        with self.__lock:
+            return self.connection().execute(self.__SELECT_PRODUCTS).fetchall()
+
+    def selectUser(self, username: str) -> tuple | None:
+        with self.__lock:
+            return self.connection().execute(self.__SELECT_USER, (username,)).fetchone()
+
+    def selectUserDevices(self, user_id: int) -> list[str]:
+        with self.__lock:
+            return [row[0] for row in self.connection().execute(self.__SELECT_USER_DEVICES, (user_id,))]
+
+    def insertUser(self, username: str, password: str, usertype: str) -> int:
+        with self.__transaction() as connection:
+            return connection.execute(self.__INSERT_USER,
+                                      (username, password, usertype)).lastrowid
+
+    def insertProduct(self, device_id: str, user_id: int) -> None:
+        with self.__transaction() as connection:
+            connection.execute(self.__INSERT_PRODUCT, (device_id, user_id))
+
+    # a lookup of every device in the (device_id, datetime) index
+    # the query text only depends on the number of devices and which filters are set, so each variant is prepared once
+    def selectEvents(self, table: str, id_column: str, user_id: int, device_ids: list[str],
+                     after: int | None, start: datetime | None, end: datetime | None):
+        # a user without devices matches no rows
+        device_ids = device_ids or [None]
+        query = f"""SELECT {table}.*, {table}.device_id, ? AS user_id FROM {table}
+                        WHERE {table}.device_id IN ({", ".join("?" * len(device_ids))})"""
+        params = [user_id, *device_ids]
+
+        if start is not None:
+            query += f" AND {table}.datetime >= ?"
+            params.append(start)
+
+        if end is not None:
+            query += f" AND {table}.datetime <= ?"
+            params.append(end)
+
+        if after is not None:
+            query += f" AND {table}.{id_column} > ? ORDER BY {table}.{id_column}"
+            params.append(after)
+
+        with self.__lock:
+            return self.connection().execute(query, params)
+
+    def countCredentials(self, username: str, password: str) -> int:
+        with self.__lock:
+            return self.connection().execute(self.__COUNT_CREDENTIALS, (username, password)).fetchone()[0]
+
+    def scanEvents(self, table: str):
+        with self.__lock:
+            return self.connection().execute(self.__SCAN_EVENTS[table])
+
+    # the primary key (device_id, period, bucket) makes this a range scan per device
+    def selectRollups(self, device_ids: list[str], period: str,
+                      start: datetime | None, end: datetime | None) -> list[tuple]:
+        device_ids = device_ids or [None]
+        query = f"""SELECT device_id, bucket, journeys, rtt_count, rtt_sum, tt_count, tt_sum, emergencies
+                        FROM rollups
+                            WHERE device_id IN ({", ".join("?" * len(device_ids))}) AND period = ?"""
+        params = [*device_ids, period]
+
+        if start is not None:
+            query += " AND bucket >= ?"
+            params.append(start)
+
+        if end is not None:
+            query += " AND bucket <= ?"
+            params.append(end)
+
+        query += " ORDER BY device_id, bucket"
+        with self.__lock:
+            return self.connection().execute(query, params).fetchall()
+
+    def selectExpiredEvents(self, table: str, before: datetime, limit: int) -> list[tuple]:
+        with self.__lock:
+            return self.connection().execute(self.__SELECT_EXPIRED_EVENTS[table], (before, limit)).fetchall()
+
+    # a primary key lookup per id, with the statement prepared once
+    def deleteEvents(self, table: str, ids: list[int]) -> int:
+        with self.__transaction() as connection:
+            return connection.executemany(self.__DELETE_EVENT[table], [(row_id,) for row_id in ids]).rowcount
+
+    def replaceRollups(self, rows: list[tuple]) -> None:
+        with self.__transaction() as connection:
+            connection.execute(self.__DELETE_ROLLUPS)
+            connection.executemany(self.__UPSERT_ROLLUP, rows)
+# endregion
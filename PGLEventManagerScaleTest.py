@@ -0,0 +1,352 @@
+"""Test of managers sharing the requests through a shared subscription, see PGLEventManagerLauncher.
+Runs a group of managers against an in-process stand-in for an MQTT v5 broker and a temporary SQLite database.
+Every manager has its own model, index and caches, so apart from the database nothing is shared between them,
+like between the processes the launcher starts. It checks that:
+- every request is handled by exactly one manager, and every manager gets a share of them
+- every journey is stored exactly once and every request is answered exactly once
+- a user, product or journey stored by one manager is in the responses of all the others, cached or not
+
+    python PGLEventManagerScaleTest.py --managers 3 --journeys 600
+
+Exits with status 1 if a check fails."""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from queue import Queue
+from threading import Condition, Lock, Thread
+from time import sleep
+
+from paho.mqtt.client import MQTTMessage, topic_matches_sub
+
+from PGLEventManagerController import PGLEventManagerController
+from PGLEventManagerModel import PGLEventManagerModel
+
+
+class PGLScaleTestBroker:
+    """In-process stand-in for an MQTT v5 broker. Supports the parts of MQTT the managers use:
+    topic filters with wildcards, shared subscriptions ($share/<group>/<filter>, whose messages go to the
+    members of the group in turn) and the noLocal subscription option."""
+
+    __SHARE_PREFIX = "$share/"
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__subscriptions = []   # (client, topic filter, group or None, no_local)
+        self.__turns = {}           # (group, topic filter) -> number of messages handed to the group
+
+    # a new client connected to the broker
+    def client(self) -> "PGLScaleTestClient":
+        return PGLScaleTestClient(self)
+
+    def subscribe(self, client, topic: str, options=None) -> None:
+        group = None
+        if topic.startswith(self.__SHARE_PREFIX):
+            group, topic = topic[len(self.__SHARE_PREFIX):].split("/", 1)
+        no_local = options is not None and options.noLocal
+        with self.__lock:
+            self.__subscriptions.append((client, topic, group, no_local))
+
+    def unsubscribe(self, client, topic: str | None = None) -> None:
+        group = None
+        if topic is not None and topic.startswith(self.__SHARE_PREFIX):
+            group, topic = topic[len(self.__SHARE_PREFIX):].split("/", 1)
+        with self.__lock:
+            self.__subscriptions = [subscription for subscription in self.__subscriptions
+                                    if subscription[0] is not client
+                                    or (topic is not None and subscription[1:3] != (topic, group))]
+
+    # hand a message to every client with a matching subscription, and to one member of every matching group
+    def publish(self, sender, topic: str, payload) -> None:
+        receivers = []
+        with self.__lock:
+            members = {}
+            for client, topic_filter, group, no_local in self.__subscriptions:
+                if not topic_matches_sub(topic_filter, topic) or (no_local and client is sender):
+                    continue
+                if group is None:
+                    if client not in receivers:
+                        receivers.append(client)
+                else:
+                    members.setdefault((group, topic_filter), []).append(client)
+            for key, clients in members.items():
+                turn = self.__turns.get(key, 0)
+                self.__turns[key] = turn + 1
+                receivers.append(clients[turn % len(clients)])
+
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        for client in receivers:
+            client.deliver(topic, payload or b"")
+
+
+class PGLScaleTestClient:
+    """Client of a PGLScaleTestBroker in place of the paho client. Messages are handed to on_message
+    by a thread of the client between loop_start and loop_stop, like the paho network loop does."""
+
+    def __init__(self, broker: PGLScaleTestBroker) -> None:
+        self.on_message = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.__broker = broker
+        self.__inbox = Queue()
+        self.__thread = None
+
+    def connect(self, *args, **kwargs) -> None:
+        pass
+
+    def disconnect(self, *args, **kwargs) -> None:
+        self.__broker.unsubscribe(self)
+
+    def loop_start(self) -> None:
+        self.__thread = Thread(target=self.__loop, daemon=True)
+        self.__thread.start()
+
+    def loop_stop(self) -> None:
+        if self.__thread is not None:
+            self.__inbox.put(None)
+            self.__thread.join()
+            self.__thread = None
+
+    def subscribe(self, topic: str, qos: int = 0, options=None, **kwargs) -> None:
+        self.__broker.subscribe(self, topic, options)
+
+    def unsubscribe(self, topic: str, **kwargs) -> None:
+        self.__broker.unsubscribe(self, topic)
+
+    def publish(self, topic: str, payload=None, *args, **kwargs) -> None:
+        self.__broker.publish(self, topic, payload)
+
+    # called by the broker for every message the client receives
+    def deliver(self, topic: str, payload: bytes) -> None:
+        self.__inbox.put((topic, payload))
+
+    def __loop(self) -> None:
+        item = self.__inbox.get()
+        while item is not None:
+            message = MQTTMessage(topic=item[0].encode("utf-8"))
+            message.payload = item[1]
+            self.on_message(self, None, message)
+            item = self.__inbox.get()
+
+
+class PGLEventManagerScaleTest:
+    """Test of a group of managers sharing the requests, see the module docstring."""
+
+    __DATETIME_FORMAT = "%m/%d/%Y, %H:%M:%S"
+    __SHARE_GROUP = "scale_test"
+    __SYNC_INTERVAL = 0.05
+
+    # seconds to wait for the responses and rows of a step
+    __TIMEOUT = 60
+
+    def __init__(self, managers: int = 3, users: int = 6, journeys: int = 600, worker_count: int = 2) -> None:
+        self.__manager_count = managers
+        self.__user_count = users
+        self.__journey_count = journeys
+        self.__worker_count = worker_count
+        self.__failures = []
+
+        # responses received by the test, by topic
+        self.__condition = Condition()
+        self.__responses = {}
+
+    # run the test, returns the failed checks
+    def run(self) -> list[str]:
+        with tempfile.TemporaryDirectory() as directory:
+            self.__database = os.path.join(directory, "scale_test.db")
+            broker = PGLScaleTestBroker()
+            self.__client = broker.client()
+            self.__client.on_message = self.__onResponse
+            self.__client.subscribe("PGL/response/#")
+            self.__client.loop_start()
+
+            controllers = []
+            for _ in range(self.__manager_count):
+                model = PGLEventManagerModel("localhost", self.__database, "PGL", "PGL", backend="sqlite",
+                                             batch_size=20, batch_latency=0.02, cache_size=64,
+                                             credential_cache_size=64)
+                controller = PGLEventManagerController("localhost", model, worker_count=self.__worker_count,
+                                                       mqtt_client=broker.client(), stats_interval=3600,
+                                                       share_group=self.__SHARE_GROUP,
+                                                       sync_interval=self.__SYNC_INTERVAL)
+                controller.startListening()
+                controllers.append((controller, model))
+
+            try:
+                self.__runSteps()
+            finally:
+                for controller, _ in controllers:
+                    controller.stopListening(timeout=self.__TIMEOUT)
+                self.__client.loop_stop()
+
+            self.__checkShares([model.getMetrics().snapshot()["messages"] for _, model in controllers])
+        return self.__failures
+
+    def __runSteps(self) -> None:
+        users = [f"user{n}" for n in range(self.__user_count)]
+        devices = {user: f"device{n}" for n, user in enumerate(users)}
+
+        # users, stored by different managers
+        for user in users:
+            self.__publish("store_user", f"{user};secret;caregiver;")
+        self.__expectResponses(users, "valid", ["VALID"])
+
+        # every manager indexes every user, without devices so far
+        for user in users:
+            for _ in range(self.__manager_count):
+                self.__publish("get_events", f"{user};")
+        self.__expectResponses(users, "send_events", [b"[]"] * self.__manager_count)
+
+        # products, each stored by one manager, which the others learn about on the sync topic
+        for user in users:
+            self.__publish("new_device", devices[user])
+        self.__expectDevices(len(users))
+        for user in users:
+            self.__publish("store_product", f"{devices[user]};{user};")
+        self.__expectResponses(users, "valid", ["VALID", "VALID"])
+
+        # journeys with a unique rtt each
+        start = datetime(2024, 1, 1)
+        for n in range(self.__journey_count):
+            user = users[n % len(users)]
+            timestamp = (start + timedelta(seconds=n)).strftime(self.__DATETIME_FORMAT)
+            self.__publish("store_event", f"{timestamp};{n};1;{devices[user]};")
+        self.__expectRows(self.__journey_count)
+        self.__expectEvents(users, range(self.__journey_count))
+
+        # one more journey per user, which has to replace the responses cached by every manager
+        for n, user in enumerate(users, self.__journey_count):
+            timestamp = (start + timedelta(seconds=n)).strftime(self.__DATETIME_FORMAT)
+            self.__publish("store_event", f"{timestamp};{n};1;{devices[user]};")
+        total = self.__journey_count + len(users)
+        self.__expectRows(total)
+        sleep(self.__SYNC_INTERVAL * 4)
+        self.__expectEvents(users, range(total))
+
+        # a login is answered once, by one manager
+        for user in users:
+            self.__publish("valid_user", f"{user};secret;client;")
+        self.__expectResponses(users, "valid", ["VALID", "VALID", "VALID"])
+
+    def __publish(self, topic: str, payload: str) -> None:
+        self.__client.publish(f"PGL/request/{topic}", payload)
+
+    def __onResponse(self, client, userdata, message: MQTTMessage) -> None:
+        if message.topic == "PGL/sync":
+            return
+        with self.__condition:
+            self.__responses.setdefault(message.topic, []).append(message.payload)
+            self.__condition.notify_all()
+
+    # wait until every user got as many responses on the topic of kind as expected, and check them.
+    # Responses keep accumulating per topic, so expected holds all responses of the topic so far
+    def __expectResponses(self, users: list[str], kind: str, expected: list) -> None:
+        expected = [value.encode("utf-8") if isinstance(value, str) else value for value in expected]
+        for user in users:
+            topic = f"PGL/response/{kind}/{user}/response"
+            with self.__condition:
+                self.__condition.wait_for(lambda: len(self.__responses.get(topic, ())) >= len(expected),
+                                          self.__TIMEOUT)
+            # responses that were sent twice arrive right after the first
+            sleep(0.01)
+            with self.__condition:
+                received = list(self.__responses.get(topic, ()))
+            if received != expected:
+                self.__failures.append(f"{topic}: expected {expected}, received {received}")
+
+    # ask every manager for the journeys of every user and check that each has the rtt values of the user
+    def __expectEvents(self, users: list[str], rtts: range) -> None:
+        for n, user in enumerate(users):
+            topic = f"PGL/response/send_events/{user}/response"
+            with self.__condition:
+                self.__responses.pop(topic, None)
+            for _ in range(self.__manager_count):
+                self.__publish("get_events", f"{user};")
+
+            with self.__condition:
+                self.__condition.wait_for(lambda: len(self.__responses.get(topic, ())) >= self.__manager_count,
+                                          self.__TIMEOUT)
+                received = list(self.__responses.get(topic, ()))
+            expected = sorted(rtt for rtt in rtts if rtt % len(users) == n)
+            if len(received) != self.__manager_count:
+                self.__failures.append(f"{topic}: expected {self.__manager_count} responses, "
+                                       f"received {len(received)}")
+            for response in received:
+                rows = sorted(int(row["rtt"]) for row in json.loads(response))
+                if rows != expected:
+                    self.__failures.append(f"{topic}: expected {len(expected)} journeys, received {len(rows)}")
+
+    # wait until count devices are in the database
+    def __expectDevices(self, count: int) -> None:
+        stored = self.__waitForRows("devices", count)
+        if stored != count:
+            self.__failures.append(f"devices: expected {count} rows, found {stored}")
+
+    # wait until count journeys are in the database and check that none is stored twice
+    def __expectRows(self, count: int) -> None:
+        stored = self.__waitForRows("journey", count)
+        connection = sqlite3.connect(self.__database, timeout=self.__TIMEOUT)
+        try:
+            duplicates = connection.execute(
+                "SELECT COUNT(*) FROM (SELECT rtt FROM journey GROUP BY rtt HAVING COUNT(*) > 1)").fetchone()[0]
+        finally:
+            connection.close()
+        if stored != count:
+            self.__failures.append(f"journey: expected {count} rows, found {stored}")
+        if duplicates:
+            self.__failures.append(f"journey: {duplicates} journeys were stored more than once")
+
+    # wait until table has count rows, returns the number of rows
+    def __waitForRows(self, table: str, count: int) -> int:
+        connection = sqlite3.connect(self.__database, timeout=self.__TIMEOUT)
+        try:
+            stored = 0
+            for _ in range(self.__TIMEOUT * 20):
+                stored = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                if stored >= count:
+                    break
+                sleep(0.05)
+        finally:
+            connection.close()
+        return stored
+
+    # every request went to exactly one manager, and every manager got some of them
+    def __checkShares(self, messages: list[dict]) -> None:
+        published = {"PGL/request/store_user": self.__user_count,
+                     "PGL/request/new_device": self.__user_count,
+                     "PGL/request/store_product": self.__user_count,
+                     "PGL/request/store_event": self.__journey_count + self.__user_count,
+                     "PGL/request/valid_user": self.__user_count,
+                     "PGL/request/get_events": 3 * self.__user_count * self.__manager_count}
+        for topic, count in published.items():
+            handled = sum(counts.get(topic, 0) for counts in messages)
+            if handled != count:
+                self.__failures.append(f"{topic}: published {count} messages, managers received {handled}")
+        for n, counts in enumerate(messages):
+            if not counts.get("PGL/request/store_event"):
+                self.__failures.append(f"manager {n} received no journeys")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test PGLEventManager managers sharing the requests")
+    parser.add_argument("--managers", type=int, default=3)
+    parser.add_argument("--users", type=int, default=6)
+    parser.add_argument("--journeys", type=int, default=600)
+    parser.add_argument("--workers", type=int, default=2, help="worker threads per manager")
+    args = parser.parse_args()
+
+    failures = PGLEventManagerScaleTest(args.managers, args.users, args.journeys, args.workers).run()
+    for failure in failures:
+        print(f"FAILED {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"OK: {args.managers} managers handled every message exactly once")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import logging
+import mmap
+import os
+from struct import Struct
+from threading import Condition, Event, Thread
+from zlib import crc32
+
+
+class PGLEventManagerSpool:
+    """Append-only spool of records in a memory-mapped file of a fixed size.
+    Records are appended behind a frame of their length and crc32, followed by a zero length that marks the end.
+    The header holds the acknowledged offset: records before it are in the database, records after it still have
+    to be replayed. When the spool is opened, the records after the acknowledged offset are found again by
+    following the frames until the end marker or a frame with a bad checksum (a write cut short by a crash).
+    When there is no room left for a record, the unacknowledged records are moved to the front of the file.
+    Appends only write to the page cache, so records survive a crash of the process. With sync set every append
+    is also flushed to disk, so they survive a crash of the machine."""
+
+    __MAGIC = b"PGLSPOOL"
+    __HEADER = Struct("!8sQ")       # magic, acknowledged offset
+    __FRAME = Struct("!II")         # record length, crc32 of the record
+    __END = Struct("!I")            # zero length after the last record
+
+    def __init__(self, path: str, size: int = 64 * 1024 * 1024, sync: bool = False) -> None:
+        self.__path = path
+        self.__size = size
+        self.__sync = sync
+        self.__condition = Condition()
+        self.__file = None
+        self.__map = None
+        self.__acked = self.__HEADER.size       # offset of the first unacknowledged record
+        self.__written = self.__HEADER.size     # offset behind the last record
+        # bytes appended and acknowledged since the spool was opened. Unlike the offsets they only grow,
+        # so waitAcked can wait for the records that were appended before it was called
+        self.__appended_bytes = 0
+        self.__acked_bytes = 0
+
+    # open (or create) the spool file and find the unacknowledged records
+    def open(self) -> None:
+        exists = os.path.exists(self.__path)
+        self.__file = open(self.__path, "r+b" if exists else "w+b")
+        # a spool that was created with a larger size keeps its size
+        self.__size = max(self.__size, os.fstat(self.__file.fileno()).st_size)
+        self.__file.truncate(self.__size)
+        self.__map = mmap.mmap(self.__file.fileno(), self.__size)
+
+        magic, acked = self.__HEADER.unpack_from(self.__map, 0)
+        if magic != self.__MAGIC or not self.__HEADER.size <= acked <= self.__size:
+            acked = self.__HEADER.size
+            self.__END.pack_into(self.__map, acked, 0)
+        self.__acked = acked
+        self.__written = self.__recover(acked)
+        self.__appended_bytes = self.__written - self.__acked
+        self.__acked_bytes = 0
+        self.__writeHeader()
+
+    def close(self) -> None:
+        with self.__condition:
+            self.__map.flush()
+            self.__map.close()
+            self.__file.close()
+
+    # append record. Returns False if it does not fit in the spool
+    def append(self, record: bytes) -> bool:
+        frame_size = self.__FRAME.size + len(record)
+        with self.__condition:
+            if self.__written + frame_size + self.__END.size > self.__size:
+                self.__compact()
+                if self.__written + frame_size + self.__END.size > self.__size:
+                    return False
+
+            start = self.__written
+            # the end marker is written before the frame, so a record cut short is never followed
+            # by an old record that still has a valid frame
+            self.__END.pack_into(self.__map, start + frame_size, 0)
+            self.__map[start + self.__FRAME.size:start + frame_size] = record
+            self.__FRAME.pack_into(self.__map, start, len(record), crc32(record))
+            self.__written = start + frame_size
+            self.__appended_bytes += frame_size
+            if self.__sync:
+                self.__flush(start, self.__written + self.__END.size)
+
+            self.__condition.notify_all()
+            return True
+
+    # up to max_records unacknowledged records, oldest first, and the number of bytes they take up,
+    # which has to be passed to ack once they are in the database
+    def read(self, max_records: int) -> tuple[list[bytes], int]:
+        with self.__condition:
+            records = []
+            offset = self.__acked
+            while offset < self.__written and len(records) < max_records:
+                length, _ = self.__FRAME.unpack_from(self.__map, offset)
+                offset += self.__FRAME.size
+                records.append(bytes(self.__map[offset:offset + length]))
+                offset += length
+            return records, offset - self.__acked
+
+    # acknowledge the records returned by read, size is the number of bytes read returned
+    def ack(self, size: int) -> None:
+        with self.__condition:
+            self.__acked += size
+            self.__acked_bytes += size
+            # start at the front again when everything is acknowledged
+            if self.__acked == self.__written:
+                self.__acked = self.__written = self.__HEADER.size
+                self.__END.pack_into(self.__map, self.__written, 0)
+            self.__writeHeader()
+            self.__condition.notify_all()
+
+    # bytes of unacknowledged records
+    def pending(self) -> int:
+        with self.__condition:
+            return self.__written - self.__acked
+
+    # wait until there are unacknowledged records. Returns False on timeout
+    def waitPending(self, timeout: float | None = None) -> bool:
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__written > self.__acked, timeout)
+
+    # wait until all records appended before the call are acknowledged. Records appended while waiting are not
+    # waited for, so a steady stream of appends doesn't hold up the caller. Returns False on timeout
+    def waitAcked(self, timeout: float | None = None) -> bool:
+        with self.__condition:
+            appended = self.__appended_bytes
+            return self.__condition.wait_for(lambda: self.__acked_bytes >= appended, timeout)
+
+    # offset behind the last valid frame starting at offset
+    def __recover(self, offset: int) -> int:
+        while offset + self.__FRAME.size <= self.__size:
+            length, checksum = self.__FRAME.unpack_from(self.__map, offset)
+            end = offset + self.__FRAME.size + length
+            if length == 0 or end > self.__size or crc32(self.__map[offset + self.__FRAME.size:end]) != checksum:
+                break
+            offset = end
+        if offset + self.__END.size <= self.__size:
+            self.__END.pack_into(self.__map, offset, 0)
+        return offset
+
+    # move the unacknowledged records to the front of the file. Must be called with the lock held
+    def __compact(self) -> None:
+        if self.__acked == self.__HEADER.size:
+            return
+        pending = self.__written - self.__acked
+        self.__map.move(self.__HEADER.size, self.__acked, pending)
+        self.__acked = self.__HEADER.size
+        self.__written = self.__HEADER.size + pending
+        self.__END.pack_into(self.__map, self.__written, 0)
+        self.__writeHeader()
+        self.__flush(0, self.__written + self.__END.size)
+
+    # must be called with the lock held
+    def __writeHeader(self) -> None:
+        self.__HEADER.pack_into(self.__map, 0, self.__MAGIC, self.__acked)
+        if self.__sync:
+            self.__flush(0, self.__HEADER.size)
+
+    # write the pages of the file between start and end to disk
+    def __flush(self, start: int, end: int) -> None:
+        start -= start % mmap.ALLOCATIONGRANULARITY
+        self.__map.flush(start, min(end, self.__size) - start)
+
+
+class PGLEventManagerSpoolReplayer:
+    """Thread that drains a PGLEventManagerSpool into the database.
+    It reads up to batch_size records at a time and passes them to write, which stores them and raises if the
+    database can't be reached. Records the database rejects have to be skipped by write, as raising retries them.
+    Records are only acknowledged after write returned, so a failed batch is retried every retry_interval seconds
+    until the database is back, and records of a batch that was written right before a crash (or in part before
+    write raised) are written again (at-least-once delivery).
+    thread_setup and thread_teardown are called on the replay thread, to acquire and release its database connection."""
+
+    __logger = logging.getLogger("PGL.spool")
+
+    def __init__(self, spool: PGLEventManagerSpool, write, batch_size: int = 500, retry_interval: float = 1.0,
+                 thread_setup=None, thread_teardown=None) -> None:
+        self.__spool = spool
+        self.__write = write
+        self.__batch_size = batch_size
+        self.__retry_interval = retry_interval
+        self.__thread_setup = thread_setup
+        self.__thread_teardown = thread_teardown
+        self.__stop = Event()
+        self.__thread = Thread(target=self.__replay, name="spool replayer", daemon=True)
+
+    def start(self) -> None:
+        self.__thread.start()
+
+    # stop after the records that are in the spool are written or timeout seconds have passed
+    # records that are left stay in the spool and are replayed after the next start
+    def stop(self, timeout: float | None = None) -> None:
+        self.__spool.waitAcked(timeout)
+        self.__stop.set()
+        self.__thread.join()
+
+    # wait until the records appended before the call are in the database. Returns False on timeout
+    def drain(self, timeout: float | None = None) -> bool:
+        return self.__spool.waitAcked(timeout)
+
+    def __replay(self) -> None:
+        if self.__thread_setup is not None:
+            self.__thread_setup()
+        try:
+            while not self.__stop.is_set():
+                if not self.__spool.waitPending(timeout=0.1):
+                    continue
+
+                records, size = self.__spool.read(self.__batch_size)
+                try:
+                    self.__write(records)
+                except Exception as err:
+                    self.__logger.error("Failed to replay %d spooled records, retrying in %s s: %s",
+                                        len(records), self.__retry_interval, err)
+                    self.__stop.wait(self.__retry_interval)
+                else:
+                    self.__spool.ack(size)
+        finally:
+            if self.__thread_teardown is not None:
+                self.__thread_teardown()
@@ -0,0 +1,233 @@
+from datetime import datetime
+from threading import local
+
+
+class PGLEventManagerStorage:
+    """Interface of the storage backends used by PGLEventManagerModel.
+    A backend owns the database connections and all SQL. Worker threads acquire a connection
+    of their own with acquireConnection, all other threads use the backend's main connection."""
+
+    # error raised by the backend's database driver, caught by the model
+    Error = Exception
+    # errors of Error raised for a row the database rejects (bad data or a violated constraint),
+    # as opposed to errors of the connection, which may succeed when retried
+    RowError = ()
+
+    # table names
+    USERS_TABLE_NAME = "users"
+    JOURNEY_TABLE_NAME = "journey"
+    PRODUCT_TABLE_NAME = "products"
+    DEVICES_TABLE_NAME = "devices"
+    EMERGENCY_TABLE_NAME = "emergency"
+    ROLLUPS_TABLE_NAME = "rollups"
+
+    # periods the rollups are kept for
+    ROLLUP_PERIODS = ("hour", "day")
+
+    def __init__(self) -> None:
+        self.__thread_connection = local()
+
+# region Connections
+    # connect to the database and create it if it doesn't exist
+    # pool_size is the number of connections that can be acquired by worker threads
+    def connect(self, pool_size: int = 1) -> None:
+        raise NotImplementedError
+
+    # disconnect the main connection from the database
+    def disconnect(self) -> None:
+        raise NotImplementedError
+
+    # connection used by threads that did not acquire a connection of their own
+    def mainConnection(self):
+        raise NotImplementedError
+
+    # open a connection for a worker thread. Returns None if the main connection should be used
+    def openConnection(self):
+        raise NotImplementedError
+
+    # close a connection returned by openConnection
+    def closeConnection(self, connection) -> None:
+        connection.close()
+
+    # take a connection for the calling thread
+    # all queries made by this thread use that connection until it is released
+    def acquireConnection(self) -> None:
+        self.__thread_connection.connection = self.openConnection()
+
+    # close the calling thread's connection
+    def releaseConnection(self) -> None:
+        connection = getattr(self.__thread_connection, 'connection', None)
+        if connection is not None:
+            self.closeConnection(connection)
+            self.__thread_connection.connection = None
+
+    # connection for the calling thread: its own connection if it acquired one, otherwise the main connection
+    def connection(self):
+        connection = getattr(self.__thread_connection, 'connection', None)
+        if connection is None:
+            return self.mainConnection()
+        return connection
+# endregion
+
+# region Queries
+    # all device_ids in the devices table
+    def loadDevices(self) -> set[str]:
+        raise NotImplementedError
+
+    # insert a device. Inserting an existing device does nothing
+    def insertDevice(self, device_id: str) -> None:
+        raise NotImplementedError
+
+    # insert journeys (datetime, rtt, tt, device_id) and emergencies (datetime, et, device_id)
+    # and add them to the rollups in a single transaction. The transaction is rolled back if an insert fails
+    def insertEvents(self, journeys: list[tuple], emergencies: list[tuple]) -> None:
+        raise NotImplementedError
+
+    # (user_id, username, usertype) of all users
+    def loadUsers(self) -> list[tuple]:
+        raise NotImplementedError
+
+    # (device_id, user_id) of all products
+    def loadProducts(self) -> list[tuple]:
+        raise NotImplementedError
+
+    # (user_id, usertype) of the given user, None if the user doesn't exist
+    def selectUser(self, username: str) -> tuple | None:
+        raise NotImplementedError
+
+    # device_ids linked to the user with user_id
+    def selectUserDevices(self, user_id: int) -> list[str]:
+        raise NotImplementedError
+
+    # insert a user and return its user_id
+    def insertUser(self, username: str, password: str, usertype: str) -> int:
+        raise NotImplementedError
+
+    # link device_id to the user with user_id
+    def insertProduct(self, device_id: str, user_id: int) -> None:
+        raise NotImplementedError
+
+    # execute the query for all events in table (journey or emergency) of the given devices of the user with
+    # user_id and return the open cursor, which the caller has to close. Rows are a row of table followed by
+    # the products row (device_id, user_id) of its device. start/end bound the datetime column.
+    # If after is given, only rows with an id_column above it are selected, ordered by id_column
+    def selectEvents(self, table: str, id_column: str, user_id: int, device_ids: list[str],
+                     after: int | None, start: datetime | None, end: datetime | None):
+        raise NotImplementedError
+
+    # number of users with the given username and password
+    def countCredentials(self, username: str, password: str) -> int:
+        raise NotImplementedError
+
+    # execute the query for all rows of table (journey or emergency) in the layout of insertEvents
+    # and return the open cursor, which the caller has to close
+    def scanEvents(self, table: str):
+        raise NotImplementedError
+
+    # rollups of the given devices for period, with a bucket between start and end. Rows are
+    # (device_id, bucket, journeys, rtt_count, rtt_sum, tt_count, tt_sum, emergencies), ordered by device and bucket
+    def selectRollups(self, device_ids: list[str], period: str,
+                      start: datetime | None, end: datetime | None) -> list[tuple]:
+        raise NotImplementedError
+
+    # replace all rollups with the rows of rollupRows in a single transaction
+    def replaceRollups(self, rows: list[tuple]) -> None:
+        raise NotImplementedError
+
+    # up to limit rows of table (journey or emergency) with a datetime before the given one, ordered by id
+    def selectExpiredEvents(self, table: str, before: datetime, limit: int) -> list[tuple]:
+        raise NotImplementedError
+
+    # delete the rows of table (journey or emergency) with the given ids in a single transaction,
+    # e.g. the rows returned by selectExpiredEvents. Returns the number of deleted rows
+    def deleteEvents(self, table: str, ids: list[int]) -> int:
+        raise NotImplementedError
+# endregion
+
+# region Rollups
+    # The rollups table holds per device, period and bucket (the start of the hour or day) the number of journeys,
+    # the count and sum of their numeric rtt and tt values and the number of emergencies.
+    # insertEvents adds the rows it inserts to the rollups in the same transaction
+
+    # add journeys and emergencies in the layout of insertEvents to totals, which maps
+    # (device_id, period, bucket) to [journeys, rtt_count, rtt_sum, tt_count, tt_sum, emergencies]
+    def addToRollups(self, totals: dict, journeys: list[tuple], emergencies: list[tuple]) -> dict:
+        for timestamp, rtt, tt, device_id in journeys:
+            rtt = self.__number(rtt)
+            tt = self.__number(tt)
+            for key in self.__rollupKeys(device_id, timestamp):
+                total = totals.setdefault(key, [0, 0, 0.0, 0, 0.0, 0])
+                total[0] += 1
+                if rtt is not None:
+                    total[1] += 1
+                    total[2] += rtt
+                if tt is not None:
+                    total[3] += 1
+                    total[4] += tt
+
+        for timestamp, _, device_id in emergencies:
+            for key in self.__rollupKeys(device_id, timestamp):
+                totals.setdefault(key, [0, 0, 0.0, 0, 0.0, 0])[5] += 1
+        return totals
+
+    # rows of totals (see addToRollups) to insert or add to the rollups table
+    # (device_id, period, bucket, journeys, rtt_count, rtt_sum, tt_count, tt_sum, emergencies)
+    def rollupRows(self, totals: dict) -> list[tuple]:
+        return [(*key, *total) for key, total in totals.items()]
+
+    # (device_id, period, bucket) of every period a row at timestamp falls in
+    def __rollupKeys(self, device_id: str, timestamp: datetime) -> list[tuple]:
+        hour = timestamp.replace(minute=0, second=0, microsecond=0)
+        return [(device_id, "hour", hour), (device_id, "day", hour.replace(hour=0))]
+
+    # rtt, tt are stored as text. Values that are not numbers are left out of the rollups
+    def __number(self, value) -> float | None:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+# endregion
+
+
+# storage backends that can be selected by name
+BACKENDS = ("mysql", "sqlite")
+
+
+# create the storage backend with the given name: "mysql" (a MySQL/MariaDB server at host), "sqlite" (a local
+# SQLite file, database is its path, host/user/password are ignored), or return backend if it is a storage instance
+# backends are imported here, so the driver of a backend is only needed when it is used
+def createStorage(backend, host, database: str, user: str, password: str) -> PGLEventManagerStorage:
+    if isinstance(backend, PGLEventManagerStorage):
+        return backend
+
+    match backend:
+        case "mysql":
+            from PGLEventManagerMySQLStorage import PGLEventManagerMySQLStorage
+            return PGLEventManagerMySQLStorage(host, database, user, password)
+        case "sqlite":
+            from PGLEventManagerSQLiteStorage import PGLEventManagerSQLiteStorage
+            return PGLEventManagerSQLiteStorage(database)
+        case _:
+            raise ValueError(f'Unknown storage backend: {backend}')
+
+
+# database of backend when none is given: the file PGL.db (sqlite) or the database PGL (mysql)
+def defaultDatabase(backend: str) -> str:
+    return "PGL.db" if backend == "sqlite" else "PGL"
+
+
+# add the options that select the storage backend and its database to the argparse parser of a command line tool
+# database_help tells the default of --database, which is defaultDatabase unless the tool handles a missing one
+def addStorageArguments(parser, backend: str = "mysql", database_help: str = "PGL.db or PGL by default") -> None:
+    parser.add_argument("--backend", choices=BACKENDS, default=backend)
+    parser.add_argument("--database", help=f"database file (sqlite) or name (mysql), {database_help}")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="PGL")
+    parser.add_argument("--password", default="PGL")
+
+
+# keyword arguments of PGLEventManagerModel for the options added by addStorageArguments
+def storageArguments(args) -> dict:
+    database = args.database if args.database is not None else defaultDatabase(args.backend)
+    return {"host": args.host, "database": database, "user": args.user, "password": args.password,
+            "backend": args.backend}
@@ -0,0 +1,41 @@
+"""Binary encoding of the journey and emergency messages sent by the PIs.
+The binary topics carry the same information as the text topics ('datetime;rtt;tt;device;' and
+'datetime;et;device;') in a fixed layout: a struct-packed header in network byte order followed by
+the utf-8 encoded device_id, which takes up the rest of the payload.
+
+    journey:   int64 epoch timestamp | uint32 rtt | uint32 tt | device_id
+    emergency: int64 epoch timestamp | uint32 et  | device_id
+
+Timestamps are seconds since the epoch and are converted to local time, like the timestamps of the text format."""
+
+from datetime import datetime
+from struct import Struct
+
+JOURNEY_HEADER = Struct("!qII")
+EMERGENCY_HEADER = Struct("!qI")
+
+
+# encode a journey. Used by the PI firmware (and its tests)
+def encodeJourney(timestamp: datetime, rtt: int, tt: int, device_id: str) -> bytes:
+    return JOURNEY_HEADER.pack(int(timestamp.timestamp()), rtt, tt) + device_id.encode("utf-8")
+
+
+# decode a journey into (timestamp, rtt, tt, device_id)
+# raises struct.error if the payload is shorter than the header
+def decodeJourney(payload: bytes) -> tuple[datetime, int, int, str]:
+    epoch, rtt, tt = JOURNEY_HEADER.unpack_from(payload)
+    device_id = payload[JOURNEY_HEADER.size:].decode("utf-8")
+    return datetime.fromtimestamp(epoch), rtt, tt, device_id
+
+
+# encode an emergency. Used by the PI firmware (and its tests)
+def encodeEmergency(timestamp: datetime, et: int, device_id: str) -> bytes:
+    return EMERGENCY_HEADER.pack(int(timestamp.timestamp()), et) + device_id.encode("utf-8")
+
+
+# decode an emergency into (timestamp, et, device_id)
+# raises struct.error if the payload is shorter than the header
+def decodeEmergency(payload: bytes) -> tuple[datetime, int, str]:
+    epoch, et = EMERGENCY_HEADER.unpack_from(payload)
+    device_id = payload[EMERGENCY_HEADER.size:].decode("utf-8")
+    return datetime.fromtimestamp(epoch), et, device_id